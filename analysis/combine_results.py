@@ -1,4 +1,6 @@
+from collections import Counter
 import json
+import math
 from pathlib import Path
 
 import pandas as pd
@@ -71,6 +73,10 @@ removed_models = [
     # "bm25s"
 ]
 
+# runs of benchmark/harness.py (under results/harness/) have the same steps for every
+# engine; set to True to build the tables from them only, instead of the on_*.py runs
+use_harness_results = False
+
 # Load all results
 results = []
 # get all file (in dir or subdir) with the pattern *-*.json
@@ -79,12 +85,28 @@ for file in results_base_dir.rglob("*-*.json"):
         results.append(json.load(f))
 
 results_processed = []
+# runs on a fraction of the corpus (`--corpus_fraction`), along with the full runs
+results_scaling = []
+# latency histograms of the runs with `--latency`, by model and dataset
+results_latency = {}
 
 # Process them
 for r in results:
+    # skip the tokenizer-only benchmarks, which have no engine timings
+    if "n_threads" not in r:
+        continue
+
     if r['n_threads'] > 1 or r['n_threads'] == -1:
         continue
 
+    if r.get("harness", False) != use_harness_results:
+        continue
+
+    # on a hit of the tokenization cache (`--tokcache`), the corpus is not tokenized,
+    # so the docs/s would not be comparable with the other runs
+    if (r.get("tokcache") or {}).get("corpus") == "hit":
+        continue
+
     index_time_total = r["timing"]["index"]["elapsed"]
     
     # default:
@@ -96,19 +118,28 @@ for r in results:
     elif r['timing'].get('query_numpy') is not None:
         query_time_total = min(query_time_total, r['timing']['query_numpy']['elapsed'])
 
+    # runs with sampled queries (`--samples`): the query time of the full query set,
+    # extrapolated from the sample (all the queries are tokenized before sampling)
+    sampling = r.get("sampling")
+    if sampling is not None:
+        query_time_total = sampling["total_seconds"]
+
     if "tokenize_corpus_(class)" in r["timing"]:
         index_time_total += r["timing"]["tokenize_corpus_(class)"]["elapsed"]
     
     elif "tokenize_corpus" in r["timing"]:
         index_time_total += r["timing"]["tokenize_corpus"]["elapsed"]
 
+    elif "prepare" in r["timing"]:
+        index_time_total += r["timing"]["prepare"]["elapsed"]
+
     if "tokenize_queries_(class)" in r["timing"]:
         query_time_total += r["timing"]["tokenize_queries_(class)"]["elapsed"]
     elif "tokenize_queries" in r["timing"]:
         query_time_total += r["timing"]["tokenize_queries"]["elapsed"]
 
     n_docs = r["stats"]["num_docs"]
-    n_queries = r["stats"]["num_queries"]
+    n_queries = sampling["num_queries"] if sampling is not None else r["stats"]["num_queries"]
 
     if "ndcg" not in r:
         r["ndcg"] = r["scores"]["ndcg"]
@@ -120,23 +151,47 @@ for r in results:
     if r["model"] in removed_models:
         continue
 
-    results_processed.append(
-        {
-            "model": model_abbreviations[r["model"]],
-            "dataset": r["dataset"],
-            "ndcg@10": r["ndcg"]["10"],
-            "r@1000": r["recall"]["1000"],
-            "qps": n_queries / query_time_total,
-            "dps": n_docs / index_time_total,
-            'max_mem_gb': r.get('max_mem_gb', -1)
-        }
-    )
+    row = {
+        "model": model_abbreviations[r["model"]],
+        "dataset": r["dataset"],
+        "ndcg@10": r["ndcg"]["10"],
+        "r@1000": r["recall"]["1000"],
+        "qps": n_queries / query_time_total,
+        "dps": n_docs / index_time_total,
+        'max_mem_gb': r.get('max_mem_gb', -1)
+    }
+
+    corpus_fraction = r.get("corpus_fraction", 1.0)
+    results_scaling.append({**row, "corpus_fraction": corpus_fraction, "num_docs": n_docs})
+    if corpus_fraction == 1:
+        results_processed.append(row)
+        if r.get("latency") is not None:
+            results_latency.setdefault((row["model"], row["dataset"]), []).append(r["latency"])
+
+
+def pooled_percentile(latencies, p):
+    # the histograms of several runs are merged (they share the same buckets), so the
+    # percentile is the one of all their queries rather than a mean of percentiles
+    buckets = Counter()
+    for latency in latencies:
+        for upper_ms, count in latency["buckets"]:
+            buckets[round(upper_ms, 9)] += count
+    rank = max(1, math.ceil(p / 100 * sum(buckets.values())))
+    cumulative = 0
+    for upper_ms in sorted(buckets):
+        cumulative += buckets[upper_ms]
+        if cumulative >= rank:
+            return min(upper_ms, max(latency["max_ms"] for latency in latencies))
+
 
 # Create another table of stats for the datasets
 results_stats = {}
 
 for r in results:
-    if r['model'] != 'bm25s':
+    if r['model'] != 'bm25s' or r.get('corpus_fraction', 1.0) != 1:
+        continue
+    # the harness, load and client runs do not count the tokens
+    if 'num_tokens' not in r['stats']:
         continue
     
     dataset = r['dataset']
@@ -146,6 +201,27 @@ for r in results:
         'num_tokens': r['stats']['num_tokens'],
     }
 
+# Create a table of the tokenization phases (split, stopwords, vocab, stem, reconstruct)
+# for the runs that recorded them with `utils.tokenize(..., timer=timer)`
+tokenize_phases = ["split", "stopwords", "vocab", "stem", "reconstruct"]
+tokenize_counts = ["n_tokens", "n_stopwords", "n_stemmed"]
+results_tokenize = []
+
+for r in results:
+    # as above, the tokenizer-only benchmarks have no engine timings
+    if "n_threads" not in r or "tokenize_corpus/split" not in r.get("timing", {}):
+        continue
+
+    row = {"model": model_abbreviations[r["model"]], "dataset": r["dataset"]}
+    for phase in tokenize_phases:
+        timing = r["timing"].get(f"tokenize_corpus/{phase}", {})
+        row[phase] = timing.get("elapsed")
+        for count in tokenize_counts:
+            if count in timing:
+                row[count] = timing[count]
+
+    results_tokenize.append(row)
+
 # Now, let's combine all the results into a single DataFrame
 df = pd.DataFrame(results_processed)
 
@@ -228,4 +304,76 @@ r_df.to_markdown(save_dir / "markdown" / "r.md")
 r_df.to_latex(save_dir / 'latex' /  "r.tex", float_format="%.4f")
 
 
+if len(results_tokenize) > 0:
+    tokenize_df = (
+        pd.DataFrame(results_tokenize)
+        .groupby(["model", "dataset"])
+        .mean()
+        .reset_index()
+        .round(4)
+    )
+    tokenize_df.to_csv(save_dir / "csv" / "tokenize_phases.csv", index=False)
+    tokenize_df.to_markdown(save_dir / "markdown" / "tokenize_phases.md", index=False)
+    tokenize_df.to_latex(save_dir / 'latex' / "tokenize_phases.tex", index=False, float_format="%.4f")
+
+# Create tables of the p50 and p99 latency (in ms) of the runs with --latency, next to
+# the QPS tables
+if len(results_latency) > 0:
+    latency_df = pd.DataFrame(
+        [
+            {
+                "model": model,
+                "dataset": dataset,
+                "p50_ms": pooled_percentile(latencies, 50),
+                "p99_ms": pooled_percentile(latencies, 99),
+            }
+            for (model, dataset), latencies in results_latency.items()
+        ]
+    )
+    for p in ["p50", "p99"]:
+        p_df = latency_df.pivot(index="dataset", columns="model", values=f"{p}_ms").round(3)
+        p_df.to_csv(save_dir / "csv" / f"latency_{p}.csv")
+        p_df.to_markdown(save_dir / "markdown" / f"latency_{p}.md")
+        p_df.to_latex(save_dir / 'latex' / f"latency_{p}.tex", float_format="%.3f")
+
+# Create a table (and plots, if matplotlib is installed) of QPS, docs/s and peak memory
+# against the number of documents, for the datasets that were run with --corpus_fraction
+scaling_df = pd.DataFrame(results_scaling)
+if len(scaling_df) > 0 and (scaling_df["corpus_fraction"] != 1).any():
+    swept = scaling_df.loc[scaling_df["corpus_fraction"] != 1, "dataset"].unique()
+    scaling_df = (
+        scaling_df[scaling_df["dataset"].isin(swept)]
+        .groupby(["dataset", "model", "corpus_fraction"])
+        .agg({"num_docs": "mean", "qps": "mean", "dps": "mean", "max_mem_gb": "max"})
+        .reset_index()
+        .round(4)
+    )
+    scaling_df.to_csv(save_dir / "csv" / "scaling.csv", index=False)
+    scaling_df.to_markdown(save_dir / "markdown" / "scaling.md", index=False)
+    scaling_df.to_latex(save_dir / 'latex' / "scaling.tex", index=False, float_format="%.2f")
+
+    try:
+        import matplotlib.pyplot as plt
+    except ImportError:
+        plt = None
+
+    if plt is not None:
+        (save_dir / "plots").mkdir(parents=True, exist_ok=True)
+        metrics = {"qps": "Queries / s", "dps": "Docs / s (index)", "max_mem_gb": "Max memory (GB)"}
+        for dataset, dataset_df in scaling_df.groupby("dataset"):
+            fig, axes = plt.subplots(1, len(metrics), figsize=(5 * len(metrics), 4))
+            for ax, (metric, label) in zip(axes, metrics.items()):
+                for model, model_df in dataset_df.groupby("model"):
+                    model_df = model_df.sort_values("num_docs")
+                    ax.plot(model_df["num_docs"], model_df[metric], marker="o", label=model)
+                ax.set_xscale("log")
+                ax.set_xlabel("Number of documents")
+                ax.set_ylabel(label)
+            axes[0].legend()
+            fig.suptitle(dataset)
+            fig.tight_layout()
+            fig.savefig(save_dir / "plots" / f"scaling-{dataset}.png", dpi=150)
+            plt.close(fig)
+
+
 print("Results saved to analysis/out")
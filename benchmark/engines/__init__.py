@@ -0,0 +1,13 @@
+"""
+The engines benchmarked by `benchmark/harness.py`, `on_load.py` and `on_clients.py`,
+behind a common `Engine` interface (see `base.py`). Importing this package registers
+every engine in `ENGINES`; a new engine subclasses `Engine` in its own module, is
+decorated with `@register`, and is imported below.
+"""
+from .base import ENGINES, Engine, get_engine, register, top_k_from_scores
+from .bm25s import BM25SEngine
+from .rank_bm25 import RankBM25Engine
+from .bm25_pt import BM25PTEngine
+from .pyserini import PyseriniEngine
+from .pisa import PisaEngine
+from .elastic import ElasticEngine
@@ -0,0 +1,87 @@
+import numpy as np
+
+ENGINES = {}
+
+
+def register(cls):
+    """
+    Class decorator adding an `Engine` subclass to `ENGINES`, under its `name`.
+    """
+    if cls.name in ENGINES:
+        raise ValueError(f"An engine is already registered as {cls.name}")
+    ENGINES[cls.name] = cls
+    return cls
+
+
+def get_engine(name, **kwargs) -> "Engine":
+    if name not in ENGINES:
+        raise ValueError(f"Unknown engine: {name}, choose from {list(ENGINES)}")
+    return ENGINES[name](**kwargs)
+
+
+def top_k_from_scores(scores, k):
+    """
+    Return the indices and scores of the `k` highest scores, by decreasing score.
+    """
+    scores = np.asarray(scores)
+    k = min(k, len(scores))
+    top_n = np.argpartition(scores, -k)[-k:]
+    top_n = top_n[np.argsort(scores[top_n])[::-1]]
+    return top_n, scores[top_n]
+
+
+class Engine:
+    """
+    A BM25 engine, as run by `benchmark/harness.py`, `on_load.py` and `on_clients.py`.
+    The harness times each step, so an engine only does the work:
+    - `prepare(data_path, corpus_ids, corpus_lst)`: turn the corpus into the input of
+      the engine (e.g. tokenize it, or write it to the files its indexer reads)
+    - `index()`: build the index from the prepared corpus
+    - `load(mmap=False)`: reopen the index from disk, memory-mapped if possible, so
+      forked processes share its pages; engines whose index lives on disk or in a
+      server already do and keep the default
+    - `search_batch(query_ids, queries)`: run all the queries, the way the engine runs
+      them fastest (with `n_threads`), and return a `RetrievalResults`
+    - `search_one(query)`: run a single query on one thread, from its raw text to the
+      top-k; it may be called from several threads at once
+    - `close()`: free what the engine holds outside of python
+
+    Engines that cannot be forked after `index` set `fork_safe = False`, and the ones
+    that must reconnect in a forked process do it in `after_fork`. The engine libraries
+    are imported when an engine is created, so only the ones being run need to be
+    installed.
+    """
+
+    name = None
+    fork_safe = True
+
+    def __init__(self, top_k=1000, n_threads=1, **kwargs):
+        self.top_k = top_k
+        self.n_threads = n_threads
+
+    def prepare(self, data_path, corpus_ids, corpus_lst):
+        raise NotImplementedError
+
+    def index(self):
+        raise NotImplementedError
+
+    def load(self, mmap=False):
+        pass
+
+    def search_batch(self, query_ids, queries):
+        raise NotImplementedError
+
+    def search_one(self, query):
+        raise NotImplementedError
+
+    def after_fork(self):
+        pass
+
+    def close(self):
+        pass
+
+    def params(self):
+        """
+        Parameters of the engine saved with the results, besides `top_k` and `n_threads`.
+        """
+        return {}
@@ -0,0 +1,44 @@
+import numpy as np
+
+from utils.results import RetrievalResults
+
+from .base import Engine, register, top_k_from_scores
+
+
+@register
+class BM25PTEngine(Engine):
+    name = "bm25-pt"
+
+    def __init__(self, top_k=1000, n_threads=1, batch_size=32, **kwargs):
+        super().__init__(top_k=top_k, n_threads=n_threads)
+        import bm25_pt
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained("bert-base-uncased")
+        self.model = bm25_pt.BM25(tokenizer=tokenizer, device="cpu")
+        self.batch_size = batch_size
+
+    def params(self):
+        return {"batch_size": self.batch_size}
+
+    def prepare(self, data_path, corpus_ids, corpus_lst):
+        # bm25-pt tokenizes the corpus as part of its index
+        self.corpus_ids = corpus_ids
+        self.corpus_lst = corpus_lst
+
+    def index(self):
+        self.model.index(self.corpus_lst)
+        del self.corpus_lst
+
+    def search_batch(self, query_ids, queries):
+        indices, scores = [], []
+        for i in range(0, len(queries), self.batch_size):
+            raw_scores_batch = self.model.score_batch(queries[i : i + self.batch_size]).cpu().numpy()
+            for raw_scores in raw_scores_batch:
+                top_n, top_scores = top_k_from_scores(raw_scores, self.top_k)
+                indices.append(top_n)
+                scores.append(top_scores)
+        return RetrievalResults(np.array(indices), np.array(scores), query_ids, self.corpus_ids)
+
+    def search_one(self, query):
+        return top_k_from_scores(self.model.score_batch([query]).cpu().numpy()[0], self.top_k)
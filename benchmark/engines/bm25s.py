@@ -0,0 +1,66 @@
+from pathlib import Path
+
+from utils.results import RetrievalResults
+
+from .base import Engine, register
+
+
+@register
+class BM25SEngine(Engine):
+    name = "bm25s"
+
+    def __init__(
+        self, top_k=1000, n_threads=1, method="lucene", k1=1.5, b=0.75, delta=0.5, backend="numba", **kwargs
+    ):
+        super().__init__(top_k=top_k, n_threads=n_threads)
+        import bm25s
+        import Stemmer
+
+        self.bm25s = bm25s
+        self.stemmer = Stemmer.Stemmer("english")
+        self.method, self.k1, self.b, self.delta = method, k1, b, delta
+        # numba by default, the backend of the query time reported by on_bm25s.py
+        self.backend = backend
+        self.model = bm25s.BM25(method=method, k1=k1, b=b, delta=delta)
+
+    def params(self):
+        return {"method": self.method, "k1": self.k1, "b": self.b, "delta": self.delta, "backend": self.backend}
+
+    def _tokenize(self, texts, **kwargs):
+        return self.bm25s.tokenize(texts, stopwords="en", stemmer=self.stemmer, **kwargs)
+
+    def prepare(self, data_path, corpus_ids, corpus_lst):
+        self.data_path = data_path
+        self.corpus_ids = corpus_ids
+        self.corpus_tokenized = self._tokenize(corpus_lst, leave=False)
+
+    def index(self):
+        self.model.index(self.corpus_tokenized, leave_progress=False)
+        del self.corpus_tokenized
+        self.model.backend = self.backend
+
+    def _index_dir(self):
+        # one index per scoring method, so runs with other parameters don't reuse it
+        return Path(self.data_path) / "bm25s-index" / f"{self.method}-{self.k1:g}-{self.b:g}-{self.delta:g}"
+
+    def load(self, mmap=False):
+        # save the index and reload it, memory-mapped, so its arrays are pages of the
+        # page cache shared by all the processes, rather than anonymous memory
+        index_dir = self._index_dir()
+        self.model.save(index_dir)
+        self.model = self.bm25s.BM25.load(index_dir, mmap=mmap)
+        self.model.backend = self.backend
+
+    def search_batch(self, query_ids, queries):
+        # the query strings are mapped to ids with the index vocab
+        query_tokens = self._tokenize(queries, return_ids=False, leave=False)
+        indices, scores = self.model.retrieve(
+            query_tokens, k=self.top_k, return_as="tuple", n_threads=self.n_threads
+        )
+        return RetrievalResults(indices, scores, query_ids, self.corpus_ids)
+
+    def search_one(self, query):
+        query_tokens = self._tokenize([query], return_ids=False, show_progress=False)
+        return self.model.retrieve(
+            query_tokens, k=self.top_k, return_as="tuple", n_threads=1, show_progress=False
+        )
@@ -0,0 +1,74 @@
+from utils.results import RetrievalResults
+
+from .base import Engine, register
+
+
+# the same similarity and analyzer as on_elastic.py
+def es_bm25_settings(k1, b):
+    return {
+        "settings": {
+            "index": {"similarity": {"default": {"type": "BM25", "k1": k1, "b": b}}},
+            "analysis": {
+                "analyzer": {
+                    "custom_analyzer": {
+                        "type": "standard",
+                        "max_token_length": 1_000_000,
+                        "stopwords": "_english_",
+                        "filter": ["lowercase", "custom_snowball"],
+                    }
+                },
+                "filter": {"custom_snowball": {"type": "snowball", "language": "English"}},
+            },
+        }
+    }
+
+
+@register
+class ElasticEngine(Engine):
+    name = "elastic-bm25"
+
+    def __init__(self, top_k=1000, n_threads=1, index_name="bm25-benchmark", hostname="localhost", k1=1.2, b=0.75, **kwargs):
+        super().__init__(top_k=top_k, n_threads=n_threads)
+        self.k1, self.b = k1, b
+        self.index_name, self.hostname = index_name, hostname
+        self.model = self._connect()
+
+    def params(self):
+        return {"k1": self.k1, "b": self.b}
+
+    def _connect(self):
+        from beir.retrieval.search.lexical import BM25Search
+
+        return BM25Search(
+            index_name=self.index_name, hostname=self.hostname, language="english", number_of_shards=1, initialize=False
+        )
+
+    def prepare(self, data_path, corpus_ids, corpus_lst):
+        # the title is already part of the text, as in the other engines
+        self.corpus_ids = corpus_ids
+        self.corpus = {key: {"title": "", "text": text} for key, text in zip(corpus_ids, corpus_lst)}
+
+    def index(self):
+        self.model.initialise()
+        self.model.index(self.corpus)
+
+        es = self.model.es.es
+        es.indices.close(index=self.index_name)
+        es.indices.put_settings(index=self.index_name, body=es_bm25_settings(self.k1, self.b))
+        es.indices.open(index=self.index_name)
+
+    def search_batch(self, query_ids, queries):
+        results = self.model.search(
+            corpus=self.corpus, queries=dict(zip(query_ids, queries)), top_k=self.top_k
+        )
+        return RetrievalResults.from_beir_dict(results, self.corpus_ids, query_ids=query_ids)
+
+    def search_one(self, query):
+        return self.model.search(corpus=self.corpus, queries={"q": query}, top_k=self.top_k)
+
+    def after_fork(self):
+        # the connections of the parent's client cannot be shared
+        self.model = self._connect()
+
+    def close(self):
+        self.model.es.delete_index()
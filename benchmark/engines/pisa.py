@@ -0,0 +1,59 @@
+from pathlib import Path
+
+from utils.results import RetrievalResults
+
+from .base import Engine, register
+
+
+@register
+class PisaEngine(Engine):
+    name = "pisa"
+
+    def __init__(self, top_k=1000, n_threads=1, k1=1.2, b=0.75, **kwargs):
+        super().__init__(top_k=top_k, n_threads=n_threads)
+        self.k1, self.b = k1, b
+
+    def params(self):
+        return {"k1": self.k1, "b": self.b}
+
+    def prepare(self, data_path, corpus_ids, corpus_lst):
+        self.corpus_ids = corpus_ids
+        self.index_dir = Path(data_path) / "index.pisa"
+        self.corpus_records = [
+            {"docno": key, "text": text} for key, text in zip(corpus_ids, corpus_lst)
+        ]
+
+    def index(self):
+        from benchmark.on_pisa import build_pisa_index
+
+        self.bm25 = build_pisa_index(
+            corpus_records=self.corpus_records,
+            index_dir=self.index_dir,
+            n_threads=self.n_threads,
+            k1=self.k1,
+            b=self.b,
+        )
+        del self.corpus_records
+        self.bm25.num_results = self.top_k
+        # single queries run on one thread, only the batches use n_threads
+        self.bm25.threads = 1
+
+    def search_batch(self, query_ids, queries):
+        import pandas as pd
+
+        self.bm25.threads = self.n_threads
+        try:
+            hits = self.bm25(pd.DataFrame({"qid": query_ids, "query": queries}))
+        finally:
+            self.bm25.threads = 1
+
+        return RetrievalResults.from_run(
+            hits["qid"].tolist(),
+            hits["docno"].tolist(),
+            hits["score"].to_numpy(),
+            query_ids=query_ids,
+            corpus_ids=self.corpus_ids,
+        )
+
+    def search_one(self, query):
+        return self.bm25.search(query)
@@ -0,0 +1,58 @@
+import json
+from pathlib import Path
+
+from utils.results import RetrievalResults
+
+from .base import Engine, register
+
+
+@register
+class PyseriniEngine(Engine):
+    name = "pyserini"
+    # the JVM started by pyserini does not survive a fork
+    fork_safe = False
+
+    def __init__(self, top_k=1000, n_threads=1, k1=1.2, b=0.75, **kwargs):
+        super().__init__(top_k=top_k, n_threads=n_threads)
+        self.k1, self.b = k1, b
+
+    def params(self):
+        return {"k1": self.k1, "b": self.b}
+
+    def prepare(self, data_path, corpus_ids, corpus_lst):
+        self.corpus_ids = corpus_ids
+        self.pyserini_data_dir = Path(data_path) / "pyserini"
+        self.pyserini_data_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.pyserini_data_dir / "corpus.json", "w") as f:
+            json.dump(
+                [{"id": key, "contents": text} for key, text in zip(corpus_ids, corpus_lst)], f
+            )
+
+    def index(self):
+        from benchmark.on_pyserini import build_pyserini_index
+
+        build_pyserini_index(input_dir=self.pyserini_data_dir, n_threads=self.n_threads)
+        self.load()
+
+    def load(self, mmap=False):
+        # lucene memory-maps the index files by default
+        from pyserini.search import LuceneSearcher
+
+        self.searcher = LuceneSearcher(str(self.pyserini_data_dir / "index"))
+        self.searcher.set_bm25(k1=self.k1, b=self.b)
+
+    def search_batch(self, query_ids, queries):
+        hits = self.searcher.batch_search(queries, qids=query_ids, k=self.top_k, threads=self.n_threads)
+        return RetrievalResults.from_run(
+            [qid for qid, hit_list in hits.items() for _ in hit_list],
+            [hit.docid for hit_list in hits.values() for hit in hit_list],
+            [hit.score for hit_list in hits.values() for hit in hit_list],
+            query_ids=query_ids,
+            corpus_ids=self.corpus_ids,
+        )
+
+    def search_one(self, query):
+        return self.searcher.search(query, k=self.top_k)
+
+    def close(self):
+        self.searcher.close()
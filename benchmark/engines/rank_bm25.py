@@ -0,0 +1,56 @@
+import numpy as np
+
+from utils.results import RetrievalResults
+
+from .base import Engine, register, top_k_from_scores
+
+
+@register
+class RankBM25Engine(Engine):
+    name = "rank-bm25"
+
+    def __init__(self, top_k=1000, n_threads=1, method="rank", **kwargs):
+        super().__init__(top_k=top_k, n_threads=n_threads)
+        import rank_bm25
+        import Stemmer
+
+        self.rank_bm25 = rank_bm25
+        self.stemmer = Stemmer.Stemmer("english")
+        self.method = method
+
+    def params(self):
+        return {"method": self.method}
+
+    def _tokenize(self, texts):
+        import utils
+
+        return utils.tokenize(texts, stopwords="en", stemmer=self.stemmer)
+
+    def prepare(self, data_path, corpus_ids, corpus_lst):
+        self.corpus_ids = corpus_ids
+        self.tokenized_corpus = self._tokenize(corpus_lst)
+
+    def index(self):
+        # the same parameters as on_rank_bm25.py
+        if self.method == "rank":
+            self.model = self.rank_bm25.BM25Okapi(corpus=self.tokenized_corpus, epsilon=0.0, k1=1.5, b=0.75)
+        elif self.method == "bm25l":
+            self.model = self.rank_bm25.BM25L(corpus=self.tokenized_corpus, k1=1.5, b=0.75, delta=0.5)
+        elif self.method == "bm25+":
+            self.model = self.rank_bm25.BM25Plus(corpus=self.tokenized_corpus, k1=1.5, b=0.75, delta=0.5)
+        else:
+            raise ValueError(f"Unknown method: {self.method}")
+        del self.tokenized_corpus
+
+    def _top_k(self, query_tokens):
+        return top_k_from_scores(self.model.get_scores(query_tokens), self.top_k)
+
+    def search_batch(self, query_ids, queries):
+        # rank-bm25 scores one query at a time
+        results = [self._top_k(q) for q in self._tokenize(queries)]
+        indices = np.array([r[0] for r in results])
+        scores = np.array([r[1] for r in results])
+        return RetrievalResults(indices, scores, query_ids, self.corpus_ids)
+
+    def search_one(self, query):
+        return self._top_k(self._tokenize([query])[0])
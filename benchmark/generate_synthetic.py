@@ -0,0 +1,115 @@
+"""
+Generate a synthetic Zipfian dataset (see `utils.synthetic`) in the BEIR layout, to run
+the engine benchmarks at corpus sizes that no BEIR dataset has, e.g.:
+
+    python -m benchmark.generate_synthetic --fit_from msmarco -n 50_000_000
+    python -m benchmark.on_bm25s -d synthetic-msmarco-50000000
+"""
+from utils.beir import DatasetRegistry, default_split
+from utils.synthetic import ZipfConfig, fit_from_dataset, generate_dataset
+
+
+def main(
+    num_docs=1_000_000,
+    name=None,
+    fit_from=None,
+    fit_max_docs=1_000_000,
+    num_queries=None,
+    vocab_size=None,
+    zipf_exponent=None,
+    doc_length_mean=None,
+    query_length_mean=None,
+    seed=42,
+    save_dir="datasets",
+    mirror_dir=None,
+    chunk_size=100_000,
+):
+    if fit_from is not None:
+        data_path = DatasetRegistry(save_dir, mirror_dir=mirror_dir).resolve(fit_from)
+        config = fit_from_dataset(data_path, split=default_split(fit_from), max_docs=fit_max_docs)
+        print(f"Fitted on {fit_from}: {config}")
+        config = config.scale_to(num_docs)
+    else:
+        config = ZipfConfig(num_docs=num_docs)
+
+    overrides = dict(
+        num_queries=num_queries,
+        vocab_size=vocab_size,
+        zipf_exponent=zipf_exponent,
+        doc_length_mean=doc_length_mean,
+        query_length_mean=query_length_mean,
+    )
+    config = config._replace(seed=seed, **{k: v for k, v in overrides.items() if v is not None})
+
+    if name is None:
+        name = f"synthetic-{fit_from or 'zipf'}-{num_docs}"
+
+    print(f"Generating {name}: {config}")
+    path = generate_dataset(name, config, save_dir=save_dir, chunk_size=chunk_size, verbose=True)
+    print(f"Saved to {path}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic Zipfian dataset in the BEIR layout.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "-n",
+        "--num_docs",
+        type=lambda s: int(s.replace("_", "")),
+        default=1_000_000,
+        help="Number of documents to generate.",
+    )
+    parser.add_argument(
+        "--name",
+        type=str,
+        default=None,
+        help="Name of the dataset (default: synthetic-<fit_from or zipf>-<num_docs>).",
+    )
+    parser.add_argument(
+        "--fit_from",
+        type=str,
+        default=None,
+        help="BEIR dataset to fit the distribution on; the vocabulary is scaled to num_docs.",
+    )
+    parser.add_argument(
+        "--fit_max_docs",
+        type=int,
+        default=1_000_000,
+        help="Number of documents of fit_from to fit on.",
+    )
+    parser.add_argument("--num_queries", type=int, default=None, help="Override the number of queries.")
+    parser.add_argument("--vocab_size", type=int, default=None, help="Override the vocabulary size.")
+    parser.add_argument("--zipf_exponent", type=float, default=None, help="Override the Zipf exponent.")
+    parser.add_argument(
+        "--doc_length_mean", type=float, default=None, help="Override the mean number of tokens per doc."
+    )
+    parser.add_argument(
+        "--query_length_mean", type=float, default=None, help="Override the mean number of tokens per query."
+    )
+    parser.add_argument("--seed", type=int, default=42, help="Random seed.")
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=100_000,
+        help="Number of documents generated at a time.",
+    )
+    parser.add_argument(
+        "--save_dir",
+        type=str,
+        default="datasets",
+        help="Directory to save datasets.",
+    )
+    parser.add_argument(
+        "--mirror_dir",
+        type=str,
+        default=None,
+        help="Directory with the dataset zips and their checksums.json, to unpack datasets from instead of downloading them.",
+    )
+
+    kwargs = vars(parser.parse_args())
+    main(**kwargs)
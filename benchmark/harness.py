@@ -0,0 +1,315 @@
+"""
+Run any registered engine (see `benchmark/engines`) on a dataset with the same steps,
+timing, memory tracking, evaluation and result format, so the numbers of the engines
+are comparable and a new measurement lands once for all of them:
+
+    python -m benchmark.harness -e bm25s -d scifact
+    python -m benchmark.harness -e pyserini -d nq --latency --corpus_fraction 0.1 1
+
+The steps are timed as `prepare` (reading the corpus into the engine's input, e.g.
+tokenizing it), `index`, `query` (all the queries with `search_batch`, including their
+tokenization), and optionally `latency` (one query at a time with `search_one`). With
+`--samples`, only a stratified sample of the queries is run, and each one is also
+timed with `search_one` (`sampled`) to extrapolate the query time of the full set. The
+result file has the layout of the `on_*.py` scripts, with `"harness": true`.
+"""
+from collections import Counter
+import json
+import os
+from pathlib import Path
+import time
+
+from benchmark.engines import ENGINES, get_engine
+import utils
+from utils.benchmark import get_max_memory_usage, measure_latency, MemorySampler, SpanTimer
+from utils.beir import (
+    DatasetRegistry,
+    clean_results_keys,
+    default_split,
+    iter_corpus,
+    load_queries_and_qrels,
+    merge_cqa_dupstack,
+)
+from utils.evaluation import load_qrels_compiled
+from utils.sampling import (
+    doc_frequencies,
+    extrapolate_throughput,
+    query_costs,
+    stratified_sample,
+    subsample_corpus,
+)
+
+
+def load_dataset(dataset, save_dir="datasets", mirror_dir=None, corpus_fraction=1.0):
+    """
+    Resolve a dataset like the `on_*.py` scripts do (cqadupstack merged, subsampled to
+    `corpus_fraction`) and return its path, corpus ids and texts, query ids and texts,
+    and qrels.
+    """
+    data_path = DatasetRegistry(save_dir, mirror_dir=mirror_dir).resolve(dataset)
+    if dataset == "cqadupstack":
+        merge_cqa_dupstack(data_path)
+    split = default_split(dataset)
+    # keeps the relevant documents of the split, and is written once per fraction
+    data_path = subsample_corpus(data_path, corpus_fraction, split=split)
+
+    corpus_ids, corpus_lst = [], []
+    for doc_id, text in iter_corpus(data_path):
+        corpus_ids.append(doc_id)
+        corpus_lst.append(text)
+
+    queries, qrels = load_queries_and_qrels(data_path, split=split)
+    return data_path, corpus_ids, corpus_lst, list(queries.keys()), list(queries.values()), qrels
+
+
+def sample_queries(corpus_lst, queries_lst, samples, chunk_size=10_000, seed=42):
+    """
+    Sample `samples` queries with `stratified_sample`. Their costs are computed with the
+    default tokenizer of `utils` rather than the one of each engine, so every engine runs
+    the same sample. The corpus is tokenized in chunks against the vocab of the queries,
+    so only the document frequencies of the query tokens are kept in memory.
+    """
+    queries_tokenized = utils.tokenize(queries_lst, stopwords="en", return_ids=True)
+    df = Counter()
+    for chunk in utils._iter_chunks(corpus_lst, chunk_size):
+        chunk_tokenized = utils.tokenize(chunk, stopwords="en", return_ids=True, vocab=queries_tokenized.vocab)
+        df.update(doc_frequencies(chunk_tokenized.ids))
+    num_tokens, postings = query_costs(queries_tokenized.ids, df)
+    return stratified_sample(num_tokens, postings, samples, seed=seed)
+
+
+def time_queries(search_one, queries, warmup=10):
+    """
+    Run the queries one at a time with `search_one` and return the time of each, in
+    seconds. The first `warmup` queries are run once before, like in `measure_latency`.
+    """
+    for query in queries[:warmup]:
+        search_one(query)
+
+    query_seconds = []
+    for query in queries:
+        start = time.perf_counter()
+        search_one(query)
+        query_seconds.append(time.perf_counter() - start)
+    return query_seconds
+
+
+def main(
+    engine,
+    dataset,
+    save_dir="datasets",
+    mirror_dir=None,
+    result_dir="results",
+    n_threads=1,
+    top_k=1000,
+    evaluator="beir",
+    corpus_fraction=1.0,
+    latency=False,
+    samples=0,
+    hostname="localhost",
+):
+    data_path, corpus_ids, corpus_lst, qids, queries_lst, qrels = load_dataset(
+        dataset, save_dir=save_dir, mirror_dir=mirror_dir, corpus_fraction=corpus_fraction
+    )
+    num_docs = len(corpus_ids)
+
+    query_sample = None
+    if 0 < samples < len(queries_lst):
+        # stratified by the cost of each query, so the throughput of the full query set
+        # can be extrapolated from the sample
+        query_sample = sample_queries(corpus_lst, queries_lst, samples)
+        qids = query_sample.select(qids)
+        queries_lst = query_sample.select(queries_lst)
+    num_queries = len(queries_lst)
+
+    print("=" * 50)
+    print("Dataset: ", dataset)
+    print(f"Engine: {engine}")
+    print(f"Corpus Size: {num_docs:,}")
+    print(f"Queries Size: {num_queries:,}")
+    if query_sample is not None:
+        print(f"Sampled Queries: {num_queries:,} of {query_sample.num_queries:,}")
+    print(f"Number of Threads: {n_threads}")
+
+    # the peak and delta memory of each phase are saved with its timing
+    memory = MemorySampler().start()
+    timer = SpanTimer(f"[{engine}]", memory=memory)
+    model = get_engine(engine, top_k=top_k, n_threads=n_threads, index_name=dataset, hostname=hostname)
+
+    with timer.span("Prepare", show=True, n_total=num_docs):
+        model.prepare(data_path, corpus_ids, corpus_lst)
+    del corpus_lst
+
+    with timer.span("Index", show=True, n_total=num_docs):
+        model.index()
+
+    with timer.span("Query", show=True, n_total=num_queries):
+        results = model.search_batch(qids, queries_lst)
+
+    latency_stats = None
+    if latency:
+        with timer.span("Latency", show=True, n_total=num_queries):
+            histogram = measure_latency(model.search_one, queries_lst)
+        histogram.show(f"[{engine}]")
+        latency_stats = {"mode": "one_at_a_time", **histogram.to_dict()}
+
+    sampling = None
+    if query_sample is not None:
+        # one query at a time, so each sampled query has its own time
+        with timer.span("Sampled", show=True, n_total=num_queries):
+            query_seconds = time_queries(model.search_one, queries_lst)
+        sampling = extrapolate_throughput(query_sample, query_seconds)
+        qps_high = sampling["qps_high"]
+        qps_high = "inf" if qps_high is None else f"{qps_high:.2f}"
+        print(
+            f"Extrapolated Query (all {sampling['num_queries']:,}): {sampling['total_seconds']:.4f}s "
+            f"({sampling['qps']:.2f}/s, {sampling['confidence']:.0%} CI: "
+            f"{sampling['qps_low']:.2f}-{qps_high}/s)"
+        )
+
+    with timer.span("Evaluate", show=True, n_total=num_queries):
+        if evaluator == "numpy":
+            # compiled once per dataset and split, and memory-mapped afterwards
+            qrels = load_qrels_compiled(data_path, split=default_split(dataset), corpus_ids=corpus_ids)
+        ndcg, _map, recall, precision = results.evaluate(qrels, [1, 10, 100, 1000])
+
+    model.close()
+    memory.stop()
+    max_mem_gb = get_max_memory_usage("GB")
+
+    print("=" * 50)
+    print(f"Max Memory Usage: {max_mem_gb:.4f} GB")
+    print("-" * 50)
+    print(ndcg)
+    print(recall)
+    print("=" * 50)
+
+    save_dict = {
+        "model": engine,
+        "harness": True,
+        "dataset": dataset,
+        **model.params(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "n_threads": n_threads,
+        "top_k": top_k,
+        "corpus_fraction": corpus_fraction,
+        "latency": latency_stats,
+        "samples": samples,
+        "sampling": sampling,
+        "evaluator": evaluator,
+        "max_mem_gb": max_mem_gb,
+        "stats": {
+            "num_docs": num_docs,
+            "num_queries": num_queries,
+        },
+        "timing": timer.to_dict(underscore=True, lowercase=True),
+        "scores": {
+            "ndcg": clean_results_keys(ndcg),
+            "map": clean_results_keys(_map),
+            "recall": clean_results_keys(recall),
+            "precision": clean_results_keys(precision),
+        },
+    }
+
+    result_dir = Path(result_dir) / "harness" / engine
+    result_dir.mkdir(parents=True, exist_ok=True)
+    save_path = Path(result_dir) / f"{dataset}-{os.urandom(8).hex()}.json"
+    with open(save_path, "w") as f:
+        json.dump(save_dict, f, indent=2)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark a registered engine on a dataset.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "-e", "--engine",
+        type=str,
+        required=True,
+        choices=list(ENGINES),
+        help="Engine to benchmark.",
+    )
+    parser.add_argument(
+        "-d", "--dataset",
+        type=str,
+        default="scifact",
+        help="Dataset to benchmark on.",
+    )
+    parser.add_argument(
+        "--save_dir",
+        type=str,
+        default="datasets",
+        help="Directory to save datasets.",
+    )
+    parser.add_argument(
+        "--mirror_dir",
+        type=str,
+        default=None,
+        help="Directory with the dataset zips and their checksums.json, to unpack datasets from instead of downloading them.",
+    )
+    parser.add_argument(
+        "--result_dir",
+        type=str,
+        default="results",
+        help="Directory to save results (under harness/<engine>).",
+    )
+    parser.add_argument(
+        "--n_threads",
+        type=int,
+        default=1,
+        help="Number of threads to index and to run the batch of queries with.",
+    )
+    parser.add_argument(
+        "--top_k",
+        type=int,
+        default=1000,
+        help="Number of top-k documents to retrieve.",
+    )
+    parser.add_argument(
+        "--num_runs",
+        type=int,
+        default=1,
+        help="Number of runs to repeat main.",
+    )
+    parser.add_argument(
+        "--evaluator",
+        type=str,
+        default="beir",
+        choices=["beir", "numpy"],
+        help="Compute the metrics with BEIR's EvaluateRetrieval, or from the result arrays with utils.evaluation.",
+    )
+    parser.add_argument(
+        "--corpus_fraction",
+        type=float,
+        nargs="+",
+        default=[1.0],
+        help="Fractions of the corpus to benchmark on, from smallest to largest (documents of the qrels are always kept).",
+    )
+    parser.add_argument(
+        "--latency",
+        action="store_true",
+        help="After the batch run, issue the queries one at a time and save the percentiles of their latency.",
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=0,
+        help="Number of queries to sample, stratified by query cost, to extrapolate the throughput of the full query set from their one-at-a-time times. If 0, use all queries.",
+    )
+    parser.add_argument(
+        "--hostname",
+        type=str,
+        default="localhost",
+        help="Hostname of the Elasticsearch server, for elastic-bm25.",
+    )
+
+    kwargs = vars(parser.parse_args())
+    num_runs = kwargs.pop("num_runs")
+    # smallest first, so the peak memory of each run is not hidden by a larger one
+    for corpus_fraction in sorted(kwargs.pop("corpus_fraction")):
+        for _ in range(num_runs):
+            main(**kwargs, corpus_fraction=corpus_fraction)
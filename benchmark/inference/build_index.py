@@ -7,8 +7,11 @@ import bm25s
 from bm25s.utils.beir import BASE_URL
 from bm25s.utils.benchmark import get_max_memory_usage, Timer
 
+import utils
+from utils.tokcache import tokenize_cached
 
-def main(save_dir, index_dir, dataset):
+
+def main(save_dir, index_dir, dataset, flat_ids=False, tokcache=False):
     data_path = beir.util.download_and_unzip(BASE_URL.format(dataset), save_dir)
     corpus, queries, qrels = GenericDataLoader(data_folder=data_path).load(split="test")
     num_docs = len(corpus)
@@ -20,7 +23,26 @@ def main(save_dir, index_dir, dataset):
         corpus_records.append({'id': key, 'title': val["title"], 'text': val["text"]})
 
     stemmer = Stemmer.Stemmer("english")
-    corpus_tokenized = bm25s.tokenize(corpus_lst, stopwords="en", stemmer=stemmer)
+    if tokcache:
+        corpus_tokenized, _, cache_hit = tokenize_cached(
+            corpus_lst,
+            save_dir=save_dir,
+            dataset=dataset,
+            tokenizer="utils" if flat_ids else "bm25s",
+            stopwords="en",
+            stemmer=stemmer,
+            stemmer_name="snowball",
+        )
+        print(f"Tokenization cache: {'hit' if cache_hit else 'miss'}")
+    elif flat_ids:
+        corpus_tokenized = utils.tokenize(
+            corpus_lst, stopwords="en", stemmer=stemmer, return_ids=True, flat=True
+        )
+        ids_gb = corpus_tokenized.ids.nbytes / 1024**3
+        lists_gb = corpus_tokenized.ids.nbytes_as_lists() / 1024**3
+        print(f"Flat ids: {ids_gb:.2f} GB (vs. {lists_gb:.2f} GB as lists, {lists_gb - ids_gb:.2f} GB saved)")
+    else:
+        corpus_tokenized = bm25s.tokenize(corpus_lst, stopwords="en", stemmer=stemmer)
 
     model = bm25s.BM25(corpus=corpus_records)
     model.index(corpus_tokenized)
@@ -37,6 +59,8 @@ def parse_args():
     parser.add_argument("--save_dir", type=str, default="datasets", help="Directory where we save the dataset")
     parser.add_argument("--index_dir", type=str, default="bm25s_indices", help="Directory where the index is saved")
     parser.add_argument("-d", "--dataset", type=str, default="quora", help="Dataset to use for benchmarking")
+    parser.add_argument("--flat_ids", action="store_true", help="Index from flat int32 ids (utils.tokenize) instead of lists")
+    parser.add_argument("--tokcache", action="store_true", help="Load the tokenized corpus from the on-disk cache under save_dir/<dataset>/tokcache")
     return parser.parse_args()
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import argparse
+import gc
 import json
 import resource
 
@@ -6,11 +7,14 @@ import Stemmer
 import numpy as np
 
 import bm25s
-from bm25s.utils.benchmark import get_max_memory_usage, Timer
+from utils.benchmark import MemorySampler, SpanTimer
 
 
 def main(save_dir, dataset):
-    timer = Timer("[BM25S]")
+    # the peak of each phase is tracked on its own, so the in-memory figures are not
+    # hidden by the peak of the mmap run before them (as with ru_maxrss)
+    memory = MemorySampler().start()
+    timer = SpanTimer("[BM25S]", memory=memory)
     # now, load the index
     t = timer.start("Loading index (mmap)")
     model = bm25s.BM25.load(f"{save_dir}/{dataset}", mmap=True, load_corpus=True)
@@ -31,9 +35,9 @@ def main(save_dir, dataset):
     res = model.retrieve(query_tokenized, k=5)
     timer.stop(t, show=True)
 
-    max_mem_gb = get_max_memory_usage("GB")
-
-    print(f"Max Memory Usage (mmap): {max_mem_gb:.2f} GB")
+    # free the mmap index before loading the in-memory one
+    del model
+    gc.collect()
     print()
 
     # now, do the same thing with no mmap, then compare the memory usage and results
@@ -45,8 +49,18 @@ def main(save_dir, dataset):
     res_no_mmap = model_no_mmap.retrieve(query_tokenized, k=5)
     timer.stop(t, show=True)
 
-    max_mem_gb2 = get_max_memory_usage("GB")
-    print(f"Max Memory Usage (in-memory): {max_mem_gb2:.2f} GB")
+    memory.stop()
+
+    # PSS splits the pages shared with other processes (e.g. the same index mapped by
+    # several workers) between them, RSS counts them fully in each
+    for mode in ["mmap", "in-memory"]:
+        load = timer.results[f"Loading index ({mode})"]["memory"]
+        retrieve = timer.results[f"Retrieving documents ({mode})"]["memory"]
+        print(
+            f"Memory ({mode}): load +{load.get('peak_delta_rss_gb', 0):.2f} GB rss "
+            f"(+{load.get('peak_delta_pss_gb', 0):.2f} GB pss), retrieve peak "
+            f"{retrieve.get('peak_rss_gb', 0):.2f} GB rss ({retrieve.get('peak_pss_gb', 0):.2f} GB pss)"
+        )
 
     d1 = res.documents[0].tolist()
     d2 = res_no_mmap.documents[0].tolist()
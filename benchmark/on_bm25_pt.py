@@ -3,22 +3,22 @@ import os
 from pathlib import Path
 import time
 
-import beir.util
 from beir.datasets.data_loader import GenericDataLoader
-from beir.retrieval.evaluation import EvaluateRetrieval
 import numpy as np
 from tqdm.auto import tqdm
 import Stemmer
 import bm25_pt
 from transformers import AutoTokenizer
 
-from utils.benchmark import get_max_memory_usage, Timer
+from utils.benchmark import get_max_memory_usage, measure_latency, MemorySampler, SpanTimer
 import utils.huggingface
+from utils.evaluation import load_qrels_compiled
+from utils.results import RetrievalResults
+from utils.sampling import subsample_corpus
 from utils.beir import (
-    BASE_URL,
+    DatasetRegistry,
     clean_results_keys,
     merge_cqa_dupstack,
-    postprocess_results_for_eval,
 )
 
 def get_batches(lst, batch_size=32):
@@ -48,9 +48,9 @@ def compute_top_k_from_scores(scores, corpus=None, k=10, sorting=False, with_sco
     else:
         return results
 
-def main(dataset, n_threads=1, top_k=1000, batch_size=32, save_dir="datasets", result_dir="results", verbose=False):
-    #### Download dataset and unzip the dataset
-    data_path = beir.util.download_and_unzip(BASE_URL.format(dataset), save_dir)
+def main(dataset, n_threads=1, top_k=1000, batch_size=32, save_dir="datasets", mirror_dir=None, result_dir="results", evaluator="beir", corpus_fraction=1.0, latency=False, verbose=False):
+    #### Resolve the dataset (downloaded, or unpacked from the mirror, on first use)
+    data_path = DatasetRegistry(save_dir, mirror_dir=mirror_dir).resolve(dataset)
 
     if dataset == "cqadupstack":
         merge_cqa_dupstack(data_path)
@@ -59,6 +59,10 @@ def main(dataset, n_threads=1, top_k=1000, batch_size=32, save_dir="datasets", r
         split = "dev"
     else:
         split = "test"
+
+    # keeps the relevant documents of the split, and is written once per fraction
+    data_path = subsample_corpus(data_path, corpus_fraction, split=split)
+
     
     corpus, queries, qrels = GenericDataLoader(data_folder=data_path).load(split=split)
 
@@ -77,7 +81,9 @@ def main(dataset, n_threads=1, top_k=1000, batch_size=32, save_dir="datasets", r
     print(f"Corpus Size: {len(corpus_lst):,}")
     print(f"Queries Size: {len(queries_lst):,}")
 
-    timer = Timer("[bm25-pt]")
+    # the peak and delta memory of each phase are saved with its timing
+    memory = MemorySampler().start()
+    timer = SpanTimer("[bm25-pt]", memory=memory)
 
     tokenizer = AutoTokenizer.from_pretrained("bert-base-uncased")
     t = timer.start("Tokenize Corpus")
@@ -118,7 +124,7 @@ def main(dataset, n_threads=1, top_k=1000, batch_size=32, save_dir="datasets", r
         raw_scores_batch = raw_scores_batch.cpu().numpy()
         for raw_scores in raw_scores_batch:
             result, score = compute_top_k_from_scores(
-                raw_scores, corpus=corpus_ids, k=top_k, with_scores=True
+                raw_scores, k=top_k, with_scores=True
             )
             results.append(result)
             scores.append(score)
@@ -137,11 +143,26 @@ def main(dataset, n_threads=1, top_k=1000, batch_size=32, save_dir="datasets", r
     timer.show("Score", n_total=len(queries_lst))
     timer.show("Query", n_total=len(queries_lst))
 
-    results_dict = postprocess_results_for_eval(queried_results, queried_scores, qids)
-    ndcg, _map, recall, precision = EvaluateRetrieval.evaluate(
-        qrels, results_dict, [1, 10, 100, 1000]
-    )
+    latency_stats = None
+    if latency:
+        # batches of a single query, tokenized by score_batch
+        def search_one(query):
+            raw_scores = model.score_batch([query]).cpu().numpy()[0]
+            return compute_top_k_from_scores(raw_scores, k=top_k, with_scores=True)
+
+        with timer.span("Latency", show=True, n_total=len(queries_lst)):
+            histogram = measure_latency(search_one, queries_lst)
+        histogram.show("[BM25-PT]")
+        latency_stats = {"mode": "one_at_a_time", **histogram.to_dict()}
+
+    t = timer.start("Evaluate")
+    results = RetrievalResults(queried_results, queried_scores, qids, corpus_ids)
+    if evaluator == "numpy":
+        qrels = load_qrels_compiled(data_path, split=split, corpus_ids=corpus_ids)
+    ndcg, _map, recall, precision = results.evaluate(qrels, [1, 10, 100, 1000])
+    timer.stop(t, show=True, n_total=len(queries_lst))
 
+    memory.stop()
     max_mem_gb = get_max_memory_usage("GB")
 
     print("-" * 50)
@@ -158,7 +179,10 @@ def main(dataset, n_threads=1, top_k=1000, batch_size=32, save_dir="datasets", r
         "tokenizer": "skl",
         "date": time.strftime("%Y-%m-%d %H:%M:%S"),
         "n_threads": n_threads,
+        "evaluator": evaluator,
         "top_k": top_k,
+        "corpus_fraction": corpus_fraction,
+        "latency": latency_stats,
         "max_mem_gb": max_mem_gb,
         "stats": {
             "num_docs": len(corpus_lst),
@@ -235,27 +259,58 @@ if __name__ == "__main__":
         default="datasets",
         help="Directory to save datasets.",
     )
+    parser.add_argument(
+        "--mirror_dir",
+        type=str,
+        default=None,
+        help="Directory with the dataset zips and their checksums.json, to unpack datasets from instead of downloading them.",
+    )
     parser.add_argument(
         "--batch_size",
         type=int,
         default=32,
         help="Batch size for scoring.",
     )
+    parser.add_argument(
+        "--evaluator",
+        type=str,
+        default="beir",
+        choices=["beir", "numpy"],
+        help="Compute the metrics with BEIR's EvaluateRetrieval, or from the result arrays with utils.evaluation.",
+    )
+
+    parser.add_argument(
+        "--corpus_fraction",
+        type=float,
+        nargs="+",
+        default=[1.0],
+        help="Fractions of the corpus to benchmark on, from smallest to largest (documents of the qrels are always kept).",
+    )
+
+    parser.add_argument(
+        "--latency",
+        action="store_true",
+        help="After the batch runs, issue the queries one at a time and save the percentiles of their latency.",
+    )
 
     kwargs = vars(parser.parse_args())
     profile = kwargs.pop("profile")
     num_runs = kwargs.pop("num_runs")
+    # smallest first, so the peak memory of each run is not hidden by a larger one
+    corpus_fractions = sorted(kwargs.pop("corpus_fraction"))
 
     if profile:
         import cProfile
         import pstats
 
-        if num_runs > 1:
+        if num_runs > 1 or len(corpus_fractions) > 1:
             raise ValueError("Cannot profile with multiple runs.")
 
+        kwargs["corpus_fraction"] = corpus_fractions[0]
         cProfile.run("main(**kwargs)", filename="bm25pt.prof")
         p = pstats.Stats("bm25pt.prof")
         p.sort_stats("time").print_stats(50)
     else:
-        for _ in range(num_runs):
-            main(**kwargs)
+        for corpus_fraction in corpus_fractions:
+            for _ in range(num_runs):
+                main(**kwargs, corpus_fraction=corpus_fraction)
@@ -3,23 +3,25 @@ import os
 from pathlib import Path
 import time
 
-import beir.util
 from beir.datasets.data_loader import GenericDataLoader
-from beir.retrieval.evaluation import EvaluateRetrieval
 import numpy as np
 from tqdm.auto import tqdm
 import Stemmer
 from numba import njit
 
 import bm25s
-from bm25s.utils.benchmark import get_max_memory_usage, Timer
 from bm25s.utils.beir import (
-    BASE_URL,
     GH_URL,
     clean_results_keys,
     merge_cqa_dupstack,
-    postprocess_results_for_eval,
 )
+import utils
+from utils.benchmark import get_max_memory_usage, measure_latency, MemorySampler, SpanTimer
+from utils.beir import DatasetRegistry, load_columnar_corpus, load_queries_and_qrels
+from utils.evaluation import load_qrels_compiled
+from utils.results import RetrievalResults
+from utils.sampling import subsample_corpus
+from utils.tokcache import tokenize_cached
 
 
 def main(
@@ -28,6 +30,7 @@ def main(
     top_k=1000,
     method="lucene",
     save_dir="datasets",
+    mirror_dir=None,
     result_dir="results",
     stopwords="en",
     stemmer_name="snowball",
@@ -36,9 +39,15 @@ def main(
     delta=0.5,
     skip_scoring=False,
     skip_numpy_retrieval=False,
+    tokcache=False,
+    flat_ids=False,
+    corpus_loader="beir",
+    evaluator="beir",
+    corpus_fraction=1.0,
+    latency=False,
 ):
-    #### Download dataset and unzip the dataset
-    data_path = beir.util.download_and_unzip(BASE_URL.format(dataset), save_dir)
+    #### Resolve the dataset (downloaded, or unpacked from the mirror, on first use)
+    data_path = DatasetRegistry(save_dir, mirror_dir=mirror_dir).resolve(dataset)
 
     if dataset == "cqadupstack":
         merge_cqa_dupstack(data_path)
@@ -48,13 +57,23 @@ def main(
     else:
         split = "test"
 
-    corpus, queries, qrels = GenericDataLoader(data_folder=data_path).load(split=split)
-    num_docs = len(corpus)
+    # keeps the relevant documents of the split, and is written once per fraction
+    data_path = subsample_corpus(data_path, corpus_fraction, split=split)
 
-    corpus_ids, corpus_lst = [], []
-    for key, val in corpus.items():
-        corpus_ids.append(key)
-        corpus_lst.append(val["title"] + " " + val["text"])
+    if corpus_loader == "columnar":
+        queries, qrels = load_queries_and_qrels(data_path, split=split)
+        corpus = load_columnar_corpus(data_path)
+        num_docs = len(corpus)
+        corpus_ids = corpus.doc_ids()
+        corpus_lst = list(corpus.iter_texts())
+    else:
+        corpus, queries, qrels = GenericDataLoader(data_folder=data_path).load(split=split)
+        num_docs = len(corpus)
+
+        corpus_ids, corpus_lst = [], []
+        for key, val in corpus.items():
+            corpus_ids.append(key)
+            corpus_lst.append(val["title"] + " " + val["text"])
 
     corpus_ids = np.array(corpus_ids)
     del corpus
@@ -74,7 +93,9 @@ def main(
     stopwords = None if stopwords == "none" else stopwords
     stemmer = Stemmer.Stemmer("english") if stemmer_name == "snowball" else None
     
-    timer = Timer("[BM25S]")
+    # the peak and delta memory of each phase are saved with its timing
+    memory = MemorySampler().start()
+    timer = SpanTimer("[BM25S]", memory=memory)
 
     # tokenizer class
     tokenizer = bm25s.tokenization.Tokenizer(
@@ -82,24 +103,48 @@ def main(
         stemmer=stemmer,
     )
 
-    t = timer.start("Tokenize Corpus (class)")
-    corpus_tokenized_cls = tokenizer.tokenize(corpus_lst, update_vocab=True, return_as="tuple")
-    timer.stop(t, show=True, n_total=num_docs)
-
-    t = timer.start("Tokenize Queries (class)")
-    queries_ids = tokenizer.tokenize(queries_lst, update_vocab=False, return_as="ids")
-    timer.stop(t, show=True, n_total=len(queries_lst))
+    # With the tokenization cache or flat ids, the index is built from those ids, so the
+    # class tokenizer (whose vocab the query ids depend on) is skipped
+    if not (tokcache or flat_ids):
+        t = timer.start("Tokenize Corpus (class)")
+        corpus_tokenized_cls = tokenizer.tokenize(corpus_lst, update_vocab=True, return_as="tuple")
+        timer.stop(t, show=True, n_total=num_docs)
 
+        t = timer.start("Tokenize Queries (class)")
+        queries_ids = tokenizer.tokenize(queries_lst, update_vocab=False, return_as="ids")
+        timer.stop(t, show=True, n_total=len(queries_lst))
 
+    tokcache_status = None
     t = timer.start("Tokenize Corpus")
-    corpus_tokenized = bm25s.tokenize(
-        corpus_lst,
-        stopwords=stopwords,
-        stemmer=stemmer,
-        leave=False,
-        return_ids=True,
-    )
+    if tokcache:
+        corpus_tokenized, _, cache_hit = tokenize_cached(
+            corpus_lst,
+            save_dir=save_dir,
+            dataset=dataset,
+            tokenizer="utils" if flat_ids else "bm25s",
+            stopwords=stopwords,
+            stemmer=stemmer,
+            stemmer_name=stemmer_name,
+            corpus_fraction=corpus_fraction,
+            leave=False,
+        )
+        tokcache_status = {"corpus": "hit" if cache_hit else "miss"}
+    elif flat_ids:
+        # the int32 ids are filled while splitting, without the lists of ids
+        corpus_tokenized = utils.tokenize(
+            corpus_lst, stopwords=stopwords, stemmer=stemmer, return_ids=True, flat=True
+        )
+    else:
+        corpus_tokenized = bm25s.tokenize(
+            corpus_lst,
+            stopwords=stopwords,
+            stemmer=stemmer,
+            leave=False,
+            return_ids=True,
+        )
     timer.stop(t, show=True, n_total=num_docs)
+    if tokcache_status is not None:
+        print(f"Tokenization cache: {tokcache_status['corpus']}")
 
     t = timer.start("Tokenize Queries")
     queries_tokenized = bm25s.tokenize(
@@ -113,7 +158,10 @@ def main(
 
     del corpus_lst
 
-    num_tokens = sum(len(doc) for doc in corpus_tokenized.ids)
+    if isinstance(corpus_tokenized.ids, utils.FlatIds):
+        num_tokens = len(corpus_tokenized.ids.data)
+    else:
+        num_tokens = sum(len(doc) for doc in corpus_tokenized.ids)
     num_query_tokens = sum(len(q) for q in queries_tokenized)
     num_queries = len(queries_lst)
     print(f"Number of Corpus Tokens: {num_tokens:,}")
@@ -124,7 +172,12 @@ def main(
     t = timer.start("Index")
     model = bm25s.BM25(method=method, k1=k1, b=b, delta=delta)
     # model.index((corpus_tokenized.ids, corpus_tokenized.vocab), leave_progress=False)
-    model.index(corpus_tokenized_cls, leave_progress=False)
+    if tokcache or flat_ids:
+        model.index(corpus_tokenized, leave_progress=False)
+        # the query strings are mapped to ids with the index vocab
+        queries_ids = queries_tokenized
+    else:
+        model.index(corpus_tokenized_cls, leave_progress=False)
     timer.stop(t, show=True, n_total=num_docs)
     _compute_relevance_from_scores = model._compute_relevance_from_scores
 
@@ -176,10 +229,11 @@ def main(
     # model.retrieve(queries_tokenized[0:2], sorted=True)
     model.retrieve(queries_ids[:2])
     t = timer.start("Query numba")
+    # the document indices are kept in the results container, which only maps them
+    # to the corpus ids (as retrieve does with corpus=corpus_ids) if BEIR needs them
     queried_results_nbs, queried_scores_nbs = model.retrieve(
         # query_tokens=queries_tokenized,
         query_tokens=queries_ids,
-        corpus=corpus_ids,
         k=top_k,
         return_as="tuple",
         n_threads=n_threads
@@ -188,6 +242,22 @@ def main(
     timer.stop(t, show=True, n_total=len(queries_lst))
     assert np.allclose(queried_scores, queried_scores_nbs, atol=1e-6)
 
+    latency_stats = None
+    if latency:
+        # one query at a time with the numba backend, from the raw text to the top-k
+        def search_one(query):
+            query_tokens = bm25s.tokenize(
+                [query], stopwords=stopwords, stemmer=stemmer, return_ids=False, show_progress=False
+            )
+            return model.retrieve(
+                query_tokens, k=top_k, return_as="tuple", n_threads=1, show_progress=False
+            )
+
+        with timer.span("Latency", show=True, n_total=len(queries_lst)):
+            histogram = measure_latency(search_one, queries_lst)
+        histogram.show("[BM25S]")
+        latency_stats = {"mode": "one_at_a_time", **histogram.to_dict()}
+
     model.backend = "numpy"
 
     if not skip_numpy_retrieval:
@@ -210,11 +280,15 @@ def main(
     queried_results = queried_results_nbs
     queried_scores = queried_scores_nbs
     
-    results_dict = postprocess_results_for_eval(queried_results, queried_scores, qids)
-    ndcg, _map, recall, precision = EvaluateRetrieval.evaluate(
-        qrels, results_dict, [1, 10, 100, 1000]
-    )
+    t = timer.start("Evaluate")
+    results = RetrievalResults(queried_results, queried_scores, qids, corpus_ids)
+    if evaluator == "numpy":
+        # compiled once per dataset and split, and memory-mapped afterwards
+        qrels = load_qrels_compiled(data_path, split=split, corpus_ids=corpus_ids)
+    ndcg, _map, recall, precision = results.evaluate(qrels, [1, 10, 100, 1000])
+    timer.stop(t, show=True, n_total=len(queries_lst))
 
+    memory.stop()
     max_mem_gb = get_max_memory_usage("GB")
 
     print("=" * 50)
@@ -238,6 +312,12 @@ def main(
         "date": time.strftime("%Y-%m-%d %H:%M:%S"),
         "n_threads": n_threads,
         "top_k": top_k,
+        "corpus_fraction": corpus_fraction,
+        "latency": latency_stats,
+        "tokcache": tokcache_status,
+        "flat_ids": flat_ids,
+        "corpus_loader": corpus_loader,
+        "evaluator": evaluator,
         "max_mem_gb": max_mem_gb,
         "stats": {
             "num_docs": num_docs,
@@ -330,6 +410,12 @@ if __name__ == "__main__":
         default="datasets",
         help="Directory to save datasets.",
     )
+    parser.add_argument(
+        "--mirror_dir",
+        type=str,
+        default=None,
+        help="Directory with the dataset zips and their checksums.json, to unpack datasets from instead of downloading them.",
+    )
     parser.add_argument(
         "--k1",
         type=float,
@@ -360,21 +446,67 @@ if __name__ == "__main__":
         help="Skip numpy retrieval step.",
     )
 
+    parser.add_argument(
+        "--tokcache",
+        action="store_true",
+        help="Load the tokenized corpus from the on-disk cache under save_dir/<dataset>/tokcache (and fill it on a miss).",
+    )
+
+    parser.add_argument(
+        "--flat_ids",
+        action="store_true",
+        help="Index from flat int32 ids (utils.tokenize with flat=True) instead of the lists of the class tokenizer.",
+    )
+
+    parser.add_argument(
+        "--corpus_loader",
+        type=str,
+        default="beir",
+        choices=["beir", "columnar"],
+        help="How to load the corpus. 'columnar' memory-maps a columnar copy of corpus.jsonl (built on first use).",
+    )
+
+    parser.add_argument(
+        "--evaluator",
+        type=str,
+        default="beir",
+        choices=["beir", "numpy"],
+        help="Compute the metrics with BEIR's EvaluateRetrieval, or from the result arrays with utils.evaluation.",
+    )
+
+    parser.add_argument(
+        "--corpus_fraction",
+        type=float,
+        nargs="+",
+        default=[1.0],
+        help="Fractions of the corpus to benchmark on, from smallest to largest (documents of the qrels are always kept).",
+    )
+
+    parser.add_argument(
+        "--latency",
+        action="store_true",
+        help="After the batch runs, issue the queries one at a time and save the percentiles of their latency.",
+    )
+
 
     kwargs = vars(parser.parse_args())
     profile = kwargs.pop("profile")
     num_runs = kwargs.pop("num_runs")
+    # smallest first, so the peak memory of each run is not hidden by a larger one
+    corpus_fractions = sorted(kwargs.pop("corpus_fraction"))
 
     if profile:
         import cProfile
         import pstats
 
-        if num_runs > 1:
+        if num_runs > 1 or len(corpus_fractions) > 1:
             raise ValueError("Cannot profile with multiple runs.")
 
+        kwargs["corpus_fraction"] = corpus_fractions[0]
         cProfile.run("main(**kwargs)", filename="bm25s.prof")
         p = pstats.Stats("bm25s.prof")
         p.sort_stats("time").print_stats(50)
     else:
-        for _ in range(num_runs):
-            main(**kwargs)
+        for corpus_fraction in corpus_fractions:
+            for _ in range(num_runs):
+                main(**kwargs, corpus_fraction=corpus_fraction)
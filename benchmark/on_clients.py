@@ -0,0 +1,208 @@
+"""
+Concurrent-client benchmark: N clients (threads, or forked processes) share one loaded
+index and each issue one query at a time, like the independent requests of a server,
+for N from 1 to the number of cores. The aggregate QPS and the latency of each client
+are reported for each N (see `utils.loadgen.run_clients`), e.g.:
+
+    python -m benchmark.on_clients -e bm25s -d nq --mode process
+    python -m benchmark.on_clients -e pisa -d nq --mode thread --clients 1 2 4 8
+
+With `--mode process`, bm25s saves its index and reloads it with `BM25.load(mmap=True)`
+before forking, so all the clients read the same pages.
+"""
+import json
+import os
+from pathlib import Path
+import time
+
+from benchmark.engines import ENGINES, get_engine
+from benchmark.harness import load_dataset
+from utils.benchmark import MemorySampler, SpanTimer
+from utils.loadgen import run_clients, show_clients
+
+
+def default_client_counts(max_clients=None):
+    # powers of two up to the number of cores, and the number of cores itself
+    max_clients = max_clients or os.cpu_count()
+    counts = [1]
+    while counts[-1] * 2 <= max_clients:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != max_clients:
+        counts.append(max_clients)
+    return counts
+
+
+def main(
+    engine,
+    dataset,
+    save_dir="datasets",
+    mirror_dir=None,
+    result_dir="results",
+    top_k=1000,
+    mode="thread",
+    clients=None,
+    duration=10.0,
+    warmup=10,
+    corpus_fraction=1.0,
+    hostname="localhost",
+):
+    data_path, corpus_ids, corpus_lst, qids, queries_lst, _ = load_dataset(
+        dataset, save_dir=save_dir, mirror_dir=mirror_dir, corpus_fraction=corpus_fraction
+    )
+    clients = sorted(clients) if clients else default_client_counts()
+
+    print("=" * 50)
+    print("Dataset: ", dataset)
+    print(f"Engine: {engine}")
+    print(f"Corpus Size: {len(corpus_ids):,}")
+    print(f"Queries Size: {len(queries_lst):,}")
+    print(f"Clients: {clients} ({mode})")
+
+    memory = MemorySampler().start()
+    timer = SpanTimer(f"[{engine}]", memory=memory)
+    model = get_engine(engine, top_k=top_k, index_name=dataset, hostname=hostname)
+    if mode == "process" and not model.fork_safe:
+        raise ValueError(f"{engine} cannot be forked, use --mode thread")
+
+    with timer.span("Prepare", show=True, n_total=len(corpus_ids)):
+        model.prepare(data_path, corpus_ids, corpus_lst)
+    del corpus_lst
+    with timer.span("Index", show=True, n_total=len(corpus_ids)):
+        model.index()
+
+    if mode == "process":
+        # reopened memory-mapped where the engine can, so the clients share its pages
+        with timer.span("Load", show=True):
+            model.load(mmap=True)
+
+    for query in queries_lst[:warmup]:
+        model.search_one(query)
+
+    print("-" * 50)
+    runs = []
+    with timer.span("Clients"):
+        for num_clients in clients:
+            runs.append(
+                run_clients(
+                    model.search_one,
+                    queries_lst,
+                    num_clients,
+                    mode=mode,
+                    duration=duration,
+                    after_fork=model.after_fork,
+                )
+            )
+            show_clients(runs[-1], prefix="[Clients]")
+    model.close()
+    memory.stop()
+
+    save_dict = {
+        "model": engine,
+        "mode": f"clients_{mode}",
+        "dataset": dataset,
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "top_k": top_k,
+        "duration": duration,
+        "cpu_count": os.cpu_count(),
+        "corpus_fraction": corpus_fraction,
+        "stats": {
+            "num_docs": len(corpus_ids),
+            "num_queries": len(queries_lst),
+        },
+        "timing": timer.to_dict(underscore=True, lowercase=True),
+        "runs": runs,
+    }
+
+    result_dir = Path(result_dir) / "clients" / engine
+    result_dir.mkdir(parents=True, exist_ok=True)
+    save_path = Path(result_dir) / f"{dataset}-{os.urandom(8).hex()}.json"
+    with open(save_path, "w") as f:
+        json.dump(save_dict, f, indent=2)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Throughput and latency of N concurrent clients issuing single queries.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "-e", "--engine",
+        type=str,
+        required=True,
+        choices=list(ENGINES),
+        help="Engine to benchmark.",
+    )
+    parser.add_argument(
+        "-d", "--dataset",
+        type=str,
+        default="scifact",
+        help="Dataset to index and query.",
+    )
+    parser.add_argument(
+        "--save_dir",
+        type=str,
+        default="datasets",
+        help="Directory to save datasets.",
+    )
+    parser.add_argument(
+        "--mirror_dir",
+        type=str,
+        default=None,
+        help="Directory with the dataset zips and their checksums.json, to unpack datasets from instead of downloading them.",
+    )
+    parser.add_argument(
+        "--result_dir",
+        type=str,
+        default="results",
+        help="Directory to save results (under clients/<engine>).",
+    )
+    parser.add_argument(
+        "--top_k",
+        type=int,
+        default=1000,
+        help="Number of top-k documents to retrieve.",
+    )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        default="thread",
+        choices=["thread", "process"],
+        help="Run the clients as threads of one process, or as forked processes.",
+    )
+    parser.add_argument(
+        "--clients",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Numbers of clients to run (default: 1, 2, 4, ... up to the number of cores).",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=10.0,
+        help="Time each client issues queries for, in seconds.",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=10,
+        help="Number of queries run before the clients start.",
+    )
+    parser.add_argument(
+        "--corpus_fraction",
+        type=float,
+        default=1.0,
+        help="Fraction of the corpus to index (documents of the qrels are always kept).",
+    )
+    parser.add_argument(
+        "--hostname",
+        type=str,
+        default="localhost",
+        help="Hostname of the Elasticsearch server, for elastic-bm25.",
+    )
+
+    kwargs = vars(parser.parse_args())
+    main(**kwargs)
@@ -3,15 +3,16 @@ import os
 from pathlib import Path
 import time
 
-import beir.util
 from beir.datasets.data_loader import GenericDataLoader
-from beir.retrieval.evaluation import EvaluateRetrieval
 import numpy as np
 from tqdm.auto import tqdm
 from beir.retrieval.search.lexical import BM25Search
 
-from utils.benchmark import get_max_memory_usage, Timer
-from utils.beir import merge_cqa_dupstack, clean_results_keys
+from utils.benchmark import get_max_memory_usage, measure_latency, MemorySampler, SpanTimer
+from utils.beir import DatasetRegistry, merge_cqa_dupstack, clean_results_keys
+from utils.evaluation import load_qrels_compiled
+from utils.results import RetrievalResults
+from utils.sampling import subsample_corpus
 
 def compute_top_k_from_scores(
     scores, corpus=None, k=10, sorting=False, with_scores=False
@@ -42,14 +43,17 @@ def main(
     n_threads=1,
     top_k=1000,
     save_dir="datasets",
+    mirror_dir=None,
     result_dir="results",
     hostname = "localhost",
     k1=1.2,
     b=0.75,
+    evaluator="beir",
+    corpus_fraction=1.0,
+    latency=False,
 ):
-    #### Download dataset and unzip the dataset
-    base_url = "https://public.ukp.informatik.tu-darmstadt.de/thakur/BEIR/datasets/{}.zip"
-    data_path = beir.util.download_and_unzip(base_url.format(dataset), save_dir)
+    #### Resolve the dataset (downloaded, or unpacked from the mirror, on first use)
+    data_path = DatasetRegistry(save_dir, mirror_dir=mirror_dir).resolve(dataset)
 
     if dataset == "msmarco":
         split = "dev"
@@ -59,15 +63,21 @@ def main(
     if dataset == "cqadupstack":
         merge_cqa_dupstack(data_path)
 
+    # keeps the relevant documents of the split, and is written once per fraction
+    data_path = subsample_corpus(data_path, corpus_fraction, split=split)
+
     corpus, queries, qrels = GenericDataLoader(data_folder=data_path).load(split=split)
     num_docs = len(corpus)
     num_queries = len(queries)
+    corpus_ids = list(corpus.keys())
 
     print("=" * 50)
     print("Dataset: ", dataset)
     print(f"Corpus Size: {num_docs:,}")
     print(f"Queries Size: {num_queries:,}")
-    timer = Timer("[Elastic-BM25]")
+    # the peak and delta memory of each phase are saved with its timing
+    memory = MemorySampler().start()
+    timer = SpanTimer("[Elastic-BM25]", memory=memory)
     
     model = BM25Search(
         index_name=dataset, hostname=hostname, language="english", number_of_shards=1, initialize=False
@@ -115,10 +125,25 @@ def main(
     results = model.search(corpus=corpus, queries=queries, top_k=top_k)    
     timer.stop(t_query, show=True, n_total=num_queries)
 
-    ndcg, _map, recall, precision = EvaluateRetrieval.evaluate(
-        qrels, results, [1, 10, 100, 1000]
-    )
-
+    latency_stats = None
+    if latency:
+        # a multisearch request with a single query, analyzed by elasticsearch
+        def search_one(qid):
+            return model.search(corpus=corpus, queries={qid: queries[qid]}, top_k=top_k)
+
+        with timer.span("Latency", show=True, n_total=num_queries):
+            histogram = measure_latency(search_one, list(queries))
+        histogram.show("[Elastic-BM25]")
+        latency_stats = {"mode": "one_at_a_time", **histogram.to_dict()}
+
+    t = timer.start("Evaluate")
+    results = RetrievalResults.from_beir_dict(results, corpus_ids)
+    if evaluator == "numpy":
+        qrels = load_qrels_compiled(data_path, split=split, corpus_ids=corpus_ids)
+    ndcg, _map, recall, precision = results.evaluate(qrels, [1, 10, 100, 1000])
+    timer.stop(t, show=True, n_total=num_queries)
+
+    memory.stop()
     max_mem_gb = get_max_memory_usage("GB")
 
     print("=" * 50)
@@ -140,6 +165,9 @@ def main(
         "date": time.strftime("%Y-%m-%d %H:%M:%S"),
         "n_threads": n_threads,
         "top_k": top_k,
+        "corpus_fraction": corpus_fraction,
+        "latency": latency_stats,
+        "evaluator": evaluator,
         "max_mem_gb": max_mem_gb,
         "stats": {
             "num_docs": num_docs,
@@ -212,6 +240,12 @@ if __name__ == "__main__":
         default="datasets",
         help="Directory to save datasets.",
     )
+    parser.add_argument(
+        "--mirror_dir",
+        type=str,
+        default=None,
+        help="Directory with the dataset zips and their checksums.json, to unpack datasets from instead of downloading them.",
+    )
 
     parser.add_argument(
         "--hostname",
@@ -234,20 +268,46 @@ if __name__ == "__main__":
         help="BM25 b parameter.",
     )
 
+    parser.add_argument(
+        "--evaluator",
+        type=str,
+        default="beir",
+        choices=["beir", "numpy"],
+        help="Compute the metrics with BEIR's EvaluateRetrieval, or from the result arrays with utils.evaluation.",
+    )
+
+    parser.add_argument(
+        "--corpus_fraction",
+        type=float,
+        nargs="+",
+        default=[1.0],
+        help="Fractions of the corpus to benchmark on, from smallest to largest (documents of the qrels are always kept).",
+    )
+
+    parser.add_argument(
+        "--latency",
+        action="store_true",
+        help="After the batch runs, issue the queries one at a time and save the percentiles of their latency.",
+    )
+
     kwargs = vars(parser.parse_args())
     profile = kwargs.pop("profile")
     num_runs = kwargs.pop("num_runs")
+    # smallest first, so the peak memory of each run is not hidden by a larger one
+    corpus_fractions = sorted(kwargs.pop("corpus_fraction"))
 
     if profile:
         import cProfile
         import pstats
 
-        if num_runs > 1:
+        if num_runs > 1 or len(corpus_fractions) > 1:
             raise ValueError("Cannot profile with multiple runs.")
 
+        kwargs["corpus_fraction"] = corpus_fractions[0]
         cProfile.run("main(**kwargs)", filename="rankbm25.prof")
         p = pstats.Stats("rankbm25.prof")
         p.sort_stats("time").print_stats(50)
     else:
-        for _ in range(num_runs):
-            main(**kwargs)
+        for corpus_fraction in corpus_fractions:
+            for _ in range(num_runs):
+                main(**kwargs, corpus_fraction=corpus_fraction)
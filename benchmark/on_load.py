@@ -0,0 +1,234 @@
+"""
+Open-loop load test of an engine: the queries of a BEIR dataset are replayed as a
+Poisson stream at a target rate (see `utils.loadgen`), and the achieved throughput,
+queueing delay and latency percentiles are reported at each rate. Without `--rate`,
+the rate is doubled from `--start_rate` until the engine saturates, e.g.:
+
+    python -m benchmark.on_load -e bm25s -d scifact --num_workers 4
+    python -m benchmark.on_load -e pyserini -d scifact --rate 50 100 200
+"""
+import json
+import os
+from pathlib import Path
+import time
+
+from benchmark.engines import ENGINES, get_engine
+from benchmark.harness import load_dataset
+from utils.benchmark import MemorySampler, SpanTimer
+from utils.loadgen import run_open_loop, show_run, sweep_rates
+
+
+def main(
+    engine,
+    dataset,
+    save_dir="datasets",
+    mirror_dir=None,
+    result_dir="results",
+    top_k=1000,
+    rate=None,
+    start_rate=1.0,
+    factor=2.0,
+    max_rate=None,
+    refine=2,
+    duration=30.0,
+    num_workers=1,
+    max_queue_delay=1.0,
+    warmup=10,
+    seed=42,
+    corpus_fraction=1.0,
+    hostname="localhost",
+):
+    data_path, corpus_ids, corpus_lst, qids, queries_lst, _ = load_dataset(
+        dataset, save_dir=save_dir, mirror_dir=mirror_dir, corpus_fraction=corpus_fraction
+    )
+
+    print("=" * 50)
+    print("Dataset: ", dataset)
+    print(f"Engine: {engine}")
+    print(f"Corpus Size: {len(corpus_ids):,}")
+    print(f"Queries Size: {len(queries_lst):,}")
+    print(f"Number of Workers: {num_workers}")
+
+    memory = MemorySampler().start()
+    timer = SpanTimer(f"[{engine}]", memory=memory)
+    model = get_engine(engine, top_k=top_k, index_name=dataset, hostname=hostname)
+    with timer.span("Prepare", show=True, n_total=len(corpus_ids)):
+        model.prepare(data_path, corpus_ids, corpus_lst)
+    del corpus_lst
+    with timer.span("Index", show=True, n_total=len(corpus_ids)):
+        model.index()
+
+    for query in queries_lst[:warmup]:
+        model.search_one(query)
+
+    load_kwargs = dict(
+        duration=duration, num_workers=num_workers, seed=seed, max_queue_delay=max_queue_delay
+    )
+    print("-" * 50)
+    with timer.span("Load"):
+        if rate:
+            runs = []
+            for r in sorted(rate):
+                runs.append(run_open_loop(model.search_one, queries_lst, r, **load_kwargs))
+                show_run(runs[-1], prefix="[Load]")
+            sweep = {"runs": runs}
+        else:
+            sweep = sweep_rates(
+                model.search_one,
+                queries_lst,
+                start_rate,
+                factor=factor,
+                max_rate=max_rate,
+                refine=refine,
+                **load_kwargs,
+            )
+    model.close()
+    memory.stop()
+
+    print("=" * 50)
+    if sweep.get("max_sustained_qps") is not None:
+        print(f"Max Sustained Rate: {sweep['max_sustained_qps']:.2f} q/s")
+    if sweep.get("saturation_qps") is not None:
+        print(f"Throughput at Saturation: {sweep['saturation_qps']:.2f} q/s")
+
+    save_dict = {
+        "model": engine,
+        "mode": "open_loop",
+        "dataset": dataset,
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "num_workers": num_workers,
+        "top_k": top_k,
+        "duration": duration,
+        "max_queue_delay": max_queue_delay,
+        "corpus_fraction": corpus_fraction,
+        "stats": {
+            "num_docs": len(corpus_ids),
+            "num_queries": len(queries_lst),
+        },
+        "timing": timer.to_dict(underscore=True, lowercase=True),
+        **sweep,
+    }
+
+    result_dir = Path(result_dir) / "load" / engine
+    result_dir.mkdir(parents=True, exist_ok=True)
+    save_path = Path(result_dir) / f"{dataset}-{os.urandom(8).hex()}.json"
+    with open(save_path, "w") as f:
+        json.dump(save_dict, f, indent=2)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Open-loop load test of an engine at a target arrival rate.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "-e", "--engine",
+        type=str,
+        required=True,
+        choices=list(ENGINES),
+        help="Engine to load test.",
+    )
+    parser.add_argument(
+        "-d", "--dataset",
+        type=str,
+        default="scifact",
+        help="Dataset to replay the queries of.",
+    )
+    parser.add_argument(
+        "--save_dir",
+        type=str,
+        default="datasets",
+        help="Directory to save datasets.",
+    )
+    parser.add_argument(
+        "--mirror_dir",
+        type=str,
+        default=None,
+        help="Directory with the dataset zips and their checksums.json, to unpack datasets from instead of downloading them.",
+    )
+    parser.add_argument(
+        "--result_dir",
+        type=str,
+        default="results",
+        help="Directory to save results (under load/<engine>).",
+    )
+    parser.add_argument(
+        "--top_k",
+        type=int,
+        default=1000,
+        help="Number of top-k documents to retrieve.",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        nargs="+",
+        default=None,
+        help="Arrival rates (queries/s) to run at. If not given, the rates are swept until saturation.",
+    )
+    parser.add_argument(
+        "--start_rate",
+        type=float,
+        default=1.0,
+        help="First rate of the sweep (queries/s).",
+    )
+    parser.add_argument(
+        "--factor",
+        type=float,
+        default=2.0,
+        help="Factor between the rates of the sweep.",
+    )
+    parser.add_argument(
+        "--max_rate",
+        type=float,
+        default=None,
+        help="Stop the sweep above this rate (queries/s).",
+    )
+    parser.add_argument(
+        "--refine",
+        type=int,
+        default=2,
+        help="Number of bisections between the last sustained rate and the first saturated one.",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=30.0,
+        help="Duration of the arrivals at each rate, in seconds.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="Number of worker threads serving the queries.",
+    )
+    parser.add_argument(
+        "--max_queue_delay",
+        type=float,
+        default=1.0,
+        help="A rate is saturated if the p99 queueing delay exceeds this (seconds).",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=10,
+        help="Number of queries run before the load test.",
+    )
+    parser.add_argument("--seed", type=int, default=42, help="Random seed of the arrivals.")
+    parser.add_argument(
+        "--corpus_fraction",
+        type=float,
+        default=1.0,
+        help="Fraction of the corpus to index (documents of the qrels are always kept).",
+    )
+    parser.add_argument(
+        "--hostname",
+        type=str,
+        default="localhost",
+        help="Hostname of the Elasticsearch server, for elastic-bm25.",
+    )
+
+    kwargs = vars(parser.parse_args())
+    main(**kwargs)
@@ -15,14 +15,16 @@ from typing import List, Dict
 import multiprocessing as mp
 
 from tqdm.auto import tqdm
-import beir.util
 from beir.datasets.data_loader import GenericDataLoader
-from beir.retrieval.evaluation import EvaluateRetrieval
 from pyterrier_pisa import PisaIndex
 import pyterrier as pt
 
-from bm25s.utils.benchmark import get_max_memory_usage, Timer
+from utils.benchmark import get_max_memory_usage, measure_latency, MemorySampler, SpanTimer
 from bm25s.utils.beir import merge_cqa_dupstack
+from utils.beir import DatasetRegistry
+from utils.evaluation import load_qrels_compiled
+from utils.results import RetrievalResults
+from utils.sampling import subsample_corpus
 
 def format_beir_result_keys(beir_results):
     return {
@@ -51,26 +53,27 @@ def build_pisa_index(
     return index.bm25(k1=k1, b=b, threads=n_threads, query_algorithm='block_max_maxscore', precompute_impact=True)
 
 
-def main(dataset, save_dir="datasets", result_dir="results", n_threads=1, top_k=1000, k1=1.2, b=0.75):
+def main(dataset, save_dir="datasets", mirror_dir=None, result_dir="results", n_threads=1, top_k=1000, k1=1.2, b=0.75, evaluator="beir", corpus_fraction=1.0, latency=False):
     warnings.filterwarnings("ignore", category=UserWarning)
 
-    #### Download dataset and unzip the dataset
-    base_url = "https://public.ukp.informatik.tu-darmstadt.de/thakur/BEIR/datasets/{}.zip"
-
-    url = base_url.format(dataset)
-    data_dir = Path(save_dir)
-    data_path = beir.util.download_and_unzip(url, str(data_dir))
+    #### Resolve the dataset (downloaded, or unpacked from the mirror, on first use)
+    data_path = DatasetRegistry(save_dir, mirror_dir=mirror_dir).resolve(dataset)
     if dataset == "cqadupstack":
             merge_cqa_dupstack(data_path)
-    
+
     if dataset == "msmarco":
         split = "dev"
     else:
         split = "test"
+
+    # keeps the relevant documents of the split, and is written once per fraction
+    data_path = subsample_corpus(data_path, corpus_fraction, split=split)
+    
     
     corpus, queries, qrels = GenericDataLoader(data_folder=data_path).load(split=split)
     
     num_docs = len(corpus)
+    corpus_ids = list(corpus.keys())
     corpus_records = [
         {'docno': key, 'text': val['title'] + " " + val['text']} for key, val in corpus.items()
     ]
@@ -78,9 +81,13 @@ def main(dataset, save_dir="datasets", result_dir="results", n_threads=1, top_k=
 
     query_frame = pd.DataFrame(queries.items(), columns=['qid', 'query'])
 
-    t0 = time.time()
-    bm25 = build_pisa_index(corpus_records=corpus_records, index_dir=data_dir/dataset/'index.pisa', n_threads=n_threads, k1=k1, b=b)
-    time_index = time.time() - t0
+    # the wall and CPU time of each phase are recorded, so waiting shows as wall >> cpu,
+    # along with the peak and delta memory of the phase
+    memory = MemorySampler().start()
+    timer = SpanTimer("[PISA]", memory=memory)
+    with timer.span("Index"):
+        bm25 = build_pisa_index(corpus_records=corpus_records, index_dir=Path(data_path)/'index.pisa', n_threads=n_threads, k1=k1, b=b)
+    time_index = timer.elapsed("Index")
 
     print('='*50)
     print(f"[PISA] Index: {time_index:.4f}s ({num_docs / time_index:.2f}/s)")
@@ -94,23 +101,37 @@ def main(dataset, save_dir="datasets", result_dir="results", n_threads=1, top_k=
     # results's format: {query_id: {doc_id: score, doc_id: score, ...}, ...}
     k_values = [1,10,100,1000]
 
-    t0 = time.time()
-    bm25.num_results = top_k
-    bm25.threads = n_threads
-    hits = bm25(query_frame)
-    time_search = time.time() - t0
+    with timer.span("Query"):
+        bm25.num_results = top_k
+        bm25.threads = n_threads
+        hits = bm25(query_frame)
+    time_search = timer.elapsed("Query")
     print(f"[PISA] Query: {time_search:.4f}s ({len(query_frame) / time_search:.2f}/s)")
-    print('-'*50)
 
-    results = {}
-    for qid, docno, score in hits[['qid', 'docno', 'score']].itertuples(index=False):
-        if qid not in results:
-            results[qid] = {}
-        results[qid][docno] = score
+    latency_stats = None
+    if latency:
+        # a single-row query frame per call, on one thread
+        bm25.threads = 1
+        with timer.span("Latency", show=True, n_total=len(query_frame)):
+            histogram = measure_latency(bm25.search, query_frame['query'].tolist())
+        histogram.show("[PISA]")
+        latency_stats = {"mode": "one_at_a_time", **histogram.to_dict()}
+    print('-'*50)
 
-    ndcg, _map, recall, precision = EvaluateRetrieval.evaluate(qrels, results, k_values)
+    run_qids = hits['qid'].tolist()
+    results = RetrievalResults.from_run(
+        run_qids,
+        hits['docno'].tolist(),
+        hits['score'].to_numpy(),
+        query_ids=list(dict.fromkeys(run_qids)),
+        corpus_ids=corpus_ids,
+    )
+    if evaluator == "numpy":
+        qrels = load_qrels_compiled(data_path, split=split, corpus_ids=corpus_ids)
+    ndcg, _map, recall, precision = results.evaluate(qrels, k_values)
 
 
+    memory.stop()
     max_mem_gb = get_max_memory_usage("GB")
 
     print("=" * 50)
@@ -133,14 +154,15 @@ def main(dataset, save_dir="datasets", result_dir="results", n_threads=1, top_k=
         "date": time.strftime("%Y-%m-%d %H:%M:%S"),
         "n_threads": n_threads,
         "top_k": top_k,
+        "corpus_fraction": corpus_fraction,
+        "latency": latency_stats,
+        "evaluator": evaluator,
+        "max_mem_gb": max_mem_gb,
         "stats": {
             "num_docs": num_docs,
             "num_queries": len(query_frame),
         },
-        "timing": {
-            "index": {"elapsed": round(time_index, 4)},
-            "query": {"elapsed": round(time_search, 4)},
-        },
+        "timing": timer.to_dict(underscore=True, lowercase=True),
         "ndcg": format_beir_result_keys(ndcg),
         "map": format_beir_result_keys(_map),
         "recall": format_beir_result_keys(recall),
@@ -188,12 +210,33 @@ if __name__ == "__main__":
         default="datasets",
         help="Directory to download datasets.",
     )
+    parser.add_argument(
+        "--mirror_dir",
+        type=str,
+        default=None,
+        help="Directory with the dataset zips and their checksums.json, to unpack datasets from instead of downloading them.",
+    )
     parser.add_argument(
         "--result_dir",
         type=str,
         default="results",
         help="Directory to save results.",
     )
+    parser.add_argument(
+        "--evaluator",
+        type=str,
+        default="beir",
+        choices=["beir", "numpy"],
+        help="Compute the metrics with BEIR's EvaluateRetrieval, or from the result arrays with utils.evaluation.",
+    )
+
+    parser.add_argument(
+        "--corpus_fraction",
+        type=float,
+        nargs="+",
+        default=[1.0],
+        help="Fractions of the corpus to benchmark on, from smallest to largest (documents of the qrels are always kept).",
+    )
 
     parser.add_argument(
         "--k1",
@@ -209,5 +252,13 @@ if __name__ == "__main__":
         help="BM25 b parameter.",
     )
 
+    parser.add_argument(
+        "--latency",
+        action="store_true",
+        help="After the batch run, issue the queries one at a time and save the percentiles of their latency.",
+    )
+
     kwargs = vars(parser.parse_args())
-    main(**kwargs)
+    # smallest first, so the peak memory of each run is not hidden by a larger one
+    for corpus_fraction in sorted(kwargs.pop("corpus_fraction")):
+        main(**kwargs, corpus_fraction=corpus_fraction)
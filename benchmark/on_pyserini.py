@@ -13,13 +13,15 @@ from typing import List, Dict
 import multiprocessing as mp
 
 from tqdm.auto import tqdm
-import beir.util
 from beir.datasets.data_loader import GenericDataLoader
-from beir.retrieval.evaluation import EvaluateRetrieval
 from pyserini.search import LuceneSearcher
 from pyserini.analysis import Analyzer, get_lucene_analyzer
 
-from utils.beir import merge_cqa_dupstack
+from utils.benchmark import measure_latency, MemorySampler, SpanTimer
+from utils.beir import DatasetRegistry, merge_cqa_dupstack
+from utils.evaluation import load_qrels_compiled
+from utils.results import RetrievalResults
+from utils.sampling import subsample_corpus
 
 def format_beir_result_keys(beir_results):
     return {
@@ -269,26 +271,27 @@ def build_pyserini_index(
     return out
 
 
-def main(dataset, save_dir="datasets", result_dir="results", n_threads=1, top_k=1000, k1=1.2, b=0.75):
+def main(dataset, save_dir="datasets", mirror_dir=None, result_dir="results", n_threads=1, top_k=1000, k1=1.2, b=0.75, evaluator="beir", corpus_fraction=1.0, latency=False):
     warnings.filterwarnings("ignore", category=UserWarning)
 
-    #### Download dataset and unzip the dataset
-    base_url = "https://public.ukp.informatik.tu-darmstadt.de/thakur/BEIR/datasets/{}.zip"
-
-    url = base_url.format(dataset)
-    data_dir = Path(save_dir)
-    data_path = beir.util.download_and_unzip(url, str(data_dir))
+    #### Resolve the dataset (downloaded, or unpacked from the mirror, on first use)
+    data_path = DatasetRegistry(save_dir, mirror_dir=mirror_dir).resolve(dataset)
     if dataset == "cqadupstack":
             merge_cqa_dupstack(data_path)
-    
+
     if dataset == "msmarco":
         split = "dev"
     else:
         split = "test"
+
+    # keeps the relevant documents of the split, and is written once per fraction
+    data_path = subsample_corpus(data_path, corpus_fraction, split=split)
+    
     
     corpus, queries, qrels = GenericDataLoader(data_folder=data_path).load(split=split)
     
     num_docs = len(corpus)
+    corpus_ids = list(corpus.keys())
     corpus_records = [
         {'id': key, 'contents': val['title'] + " " + val['text']} for key, val in corpus.items()
     ]
@@ -301,16 +304,21 @@ def main(dataset, save_dir="datasets", result_dir="results", n_threads=1, top_k=
         qids.append(key)
 
 
-    pyserini_data_dir = data_dir / dataset / "pyserini"
+    pyserini_data_dir = Path(data_path) / "pyserini"
     pyserini_data_dir.mkdir(parents=True, exist_ok=True)
     #### Convert the dataset to Pyserini's JSON format
     with open(pyserini_data_dir / "corpus.json", "w") as f:
         json.dump(corpus_records, f)
 
     del corpus_records
-    t0 = time.time()
-    build_pyserini_index(input_dir=pyserini_data_dir, n_threads=n_threads)
-    time_index = time.time() - t0
+    # the wall and CPU time of each phase are recorded, so waiting shows as wall >> cpu,
+    # along with the peak and delta memory of the phase (the index is built by a java
+    # subprocess, so only the searcher's JVM shows up here)
+    memory = MemorySampler().start()
+    timer = SpanTimer("[Pyserini]", memory=memory)
+    with timer.span("Index"):
+        build_pyserini_index(input_dir=pyserini_data_dir, n_threads=n_threads)
+    time_index = timer.elapsed("Index")
 
     print('='*50)
     print(f"[Pyserini] Index: {time_index:.4f}s ({num_docs / time_index:.2f}/s)")
@@ -327,17 +335,30 @@ def main(dataset, save_dir="datasets", result_dir="results", n_threads=1, top_k=
     # results's format: {query_id: {doc_id: score, doc_id: score, ...}, ...}
     k_values = [1,10,100,1000]
 
-    t0 = time.time()
-    hits = searcher.batch_search(queries_lst, qids=qids, k=top_k, threads=n_threads)
-    time_search = time.time() - t0
+    with timer.span("Query"):
+        hits = searcher.batch_search(queries_lst, qids=qids, k=top_k, threads=n_threads)
+    time_search = timer.elapsed("Query")
     print(f"[Pyserini] Query: {time_search:.4f}s ({len(queries_lst) / time_search:.2f}/s)")
-    print('-'*50)
 
-    results = {
-        qid: {hit.docid: hit.score for hit in hit_list} for qid, hit_list in hits.items()
-    }
+    latency_stats = None
+    if latency:
+        with timer.span("Latency", show=True, n_total=len(queries_lst)):
+            histogram = measure_latency(lambda query: searcher.search(query, k=top_k), queries_lst)
+        histogram.show("[Pyserini]")
+        latency_stats = {"mode": "one_at_a_time", **histogram.to_dict()}
+    print('-'*50)
 
-    ndcg, _map, recall, precision = EvaluateRetrieval.evaluate(qrels, results, k_values)
+    results = RetrievalResults.from_run(
+        [qid for qid, hit_list in hits.items() for _ in hit_list],
+        [hit.docid for hit_list in hits.values() for hit in hit_list],
+        [hit.score for hit_list in hits.values() for hit in hit_list],
+        query_ids=list(hits.keys()),
+        corpus_ids=corpus_ids,
+    )
+    if evaluator == "numpy":
+        qrels = load_qrels_compiled(data_path, split=split, corpus_ids=corpus_ids)
+    ndcg, _map, recall, precision = results.evaluate(qrels, k_values)
+    memory.stop()
     print(ndcg)
     print(recall)
     print(precision)
@@ -354,14 +375,14 @@ def main(dataset, save_dir="datasets", result_dir="results", n_threads=1, top_k=
         "date": time.strftime("%Y-%m-%d %H:%M:%S"),
         "n_threads": n_threads,
         "top_k": top_k,
+        "corpus_fraction": corpus_fraction,
+        "latency": latency_stats,
+        "evaluator": evaluator,
         "stats": {
             "num_docs": num_docs,
             "num_queries": len(queries_lst),
         },
-        "timing": {
-            "index": {"elapsed": round(time_index, 4)},
-            "query": {"elapsed": round(time_search, 4)},
-        },
+        "timing": timer.to_dict(underscore=True, lowercase=True),
         "ndcg": format_beir_result_keys(ndcg),
         "map": format_beir_result_keys(_map),
         "recall": format_beir_result_keys(recall),
@@ -409,12 +430,33 @@ if __name__ == "__main__":
         default="datasets",
         help="Directory to download datasets.",
     )
+    parser.add_argument(
+        "--mirror_dir",
+        type=str,
+        default=None,
+        help="Directory with the dataset zips and their checksums.json, to unpack datasets from instead of downloading them.",
+    )
     parser.add_argument(
         "--result_dir",
         type=str,
         default="results",
         help="Directory to save results.",
     )
+    parser.add_argument(
+        "--evaluator",
+        type=str,
+        default="beir",
+        choices=["beir", "numpy"],
+        help="Compute the metrics with BEIR's EvaluateRetrieval, or from the result arrays with utils.evaluation.",
+    )
+
+    parser.add_argument(
+        "--corpus_fraction",
+        type=float,
+        nargs="+",
+        default=[1.0],
+        help="Fractions of the corpus to benchmark on, from smallest to largest (documents of the qrels are always kept).",
+    )
 
     parser.add_argument(
         "--k1",
@@ -430,5 +472,12 @@ if __name__ == "__main__":
         help="BM25 b parameter.",
     )
 
+    parser.add_argument(
+        "--latency",
+        action="store_true",
+        help="After the batch run, issue the queries one at a time and save the percentiles of their latency.",
+    )
+
     kwargs = vars(parser.parse_args())
-    main(**kwargs)
+    for corpus_fraction in sorted(kwargs.pop("corpus_fraction")):
+        main(**kwargs, corpus_fraction=corpus_fraction)
@@ -1,24 +1,33 @@
 import json
 import os
 from pathlib import Path
-import random
 import time
 
-import beir.util
 from beir.datasets.data_loader import GenericDataLoader
-from beir.retrieval.evaluation import EvaluateRetrieval
 import numpy as np
 from tqdm.auto import tqdm
 import Stemmer
 import rank_bm25
 
 import utils
-from utils.benchmark import get_max_memory_usage, Timer
+from utils.tokcache import tokenize_cached
+from utils.benchmark import get_max_memory_usage, LatencyHistogram, MemorySampler, SpanTimer
+from utils.evaluation import load_qrels_compiled
+from utils.results import RetrievalResults
+from utils.sampling import (
+    doc_frequencies,
+    extrapolate_throughput,
+    query_costs,
+    stratified_sample,
+    subsample_corpus,
+)
 from utils.beir import (
-    BASE_URL,
+    DatasetRegistry,
     clean_results_keys,
+    iter_corpus,
+    load_columnar_corpus,
+    load_queries_and_qrels,
     merge_cqa_dupstack,
-    postprocess_results_for_eval,
 )
 
 
@@ -52,12 +61,24 @@ def main(
     n_threads=1,
     top_k=1000,
     save_dir="datasets",
+    mirror_dir=None,
     result_dir="results",
     samples=0,
+    n_jobs=1,
+    batched=False,
+    flat_ids=False,
+    corpus_loader="beir",
+    tokcache=False,
+    stem_cache=None,
+    token_ids=False,
+    evaluator="beir",
+    corpus_fraction=1.0,
+    tracemalloc=False,
+    latency=False,
     verbose=False,
 ):
-    #### Download dataset and unzip the dataset
-    data_path = beir.util.download_and_unzip(BASE_URL.format(dataset), save_dir)
+    #### Resolve the dataset (downloaded, or unpacked from the mirror, on first use)
+    data_path = DatasetRegistry(save_dir, mirror_dir=mirror_dir).resolve(dataset)
 
     if dataset == "cqadupstack":
         merge_cqa_dupstack(data_path)
@@ -67,21 +88,31 @@ def main(
     else:
         split = "test"
 
-    corpus, queries, qrels = GenericDataLoader(data_folder=data_path).load(split=split)
+    # keeps the relevant documents of the split, and is written once per fraction
+    data_path = subsample_corpus(data_path, corpus_fraction, split=split, verbose=verbose)
 
-    if samples > 0:
-        random.seed(42)
-        query_keys = list(queries.keys())
-        query_keys = random.sample(query_keys, samples)
-        queries = {k: queries[k] for k in query_keys}
+    if corpus_loader == "stream":
+        # the corpus is read lazily from corpus.jsonl during tokenization
+        queries, qrels = load_queries_and_qrels(data_path, split=split)
+    elif corpus_loader == "columnar":
+        # the corpus is memory-mapped, and the texts are decoded during tokenization
+        queries, qrels = load_queries_and_qrels(data_path, split=split)
+        corpus = load_columnar_corpus(data_path, verbose=verbose)
+    else:
+        corpus, queries, qrels = GenericDataLoader(data_folder=data_path).load(split=split)
 
-    num_docs = len(corpus)
-    corpus_ids, corpus_lst = [], []
-    for key, val in corpus.items():
-        corpus_ids.append(key)
-        corpus_lst.append(val["title"] + " " + val["text"])
+    if corpus_loader == "columnar":
+        num_docs = len(corpus)
+        corpus_ids = corpus.doc_ids()
+        corpus_lst = corpus.iter_texts()
+    elif corpus_loader != "stream":
+        num_docs = len(corpus)
+        corpus_ids, corpus_lst = [], []
+        for key, val in corpus.items():
+            corpus_ids.append(key)
+            corpus_lst.append(val["title"] + " " + val["text"])
 
-    del corpus
+        del corpus
 
     qids, queries_lst = [], []
     for key, val in queries.items():
@@ -90,26 +121,134 @@ def main(
 
     print("=" * 50)
     print("Dataset: ", dataset)
-    print(f"Corpus Size: {num_docs:,}")
+    if corpus_loader != "stream":
+        print(f"Corpus Size: {num_docs:,}")
     print(f"Queries Size: {len(queries_lst):,}")
 
     stemmer = Stemmer.Stemmer("english")
-    timer = Timer("[Rank-BM25]")
-    t = timer.start("Tokenize Corpus")
-    tokenized_corpus = utils.tokenize(
-        corpus_lst,
+    stem_cache_path = stem_cache
+    if stem_cache_path is not None and Path(stem_cache_path).exists():
+        stem_cache = utils.StemCache.load(stem_cache_path)
+    elif stem_cache_path is not None:
+        stem_cache = utils.StemCache()
+
+    # the peak and delta memory of each phase are saved with its timing
+    memory = MemorySampler(tracemalloc=tracemalloc).start()
+    timer = SpanTimer("[Rank-BM25]", memory=memory)
+    tokenize_kwargs = dict(
         stopwords="en",
         stemmer=stemmer,
         leave=False,
+        n_jobs=n_jobs,
+        batched=batched,
+        return_ids=flat_ids or token_ids,
+        flat=flat_ids,
+        stem_cache=stem_cache,
+        timer=timer,
+        timer_prefix="Tokenize Corpus",
     )
+    tokcache_status = None
+    t = timer.start("Tokenize Corpus")
+    if tokcache:
+        is_stream = corpus_loader == "stream"
+        tokenized_corpus, cached_ids, cache_hit = tokenize_cached(
+            (lambda: iter_corpus(data_path)) if is_stream else corpus_lst,
+            save_dir=save_dir,
+            dataset=dataset,
+            stopwords="en",
+            stemmer=stemmer,
+            stemmer_name="snowball",
+            corpus_fraction=corpus_fraction,
+            records=is_stream,
+            leave=False,
+            n_jobs=n_jobs,
+            batched=batched,
+            stem_cache=stem_cache,
+            timer=timer,
+            timer_prefix="Tokenize Corpus",
+        )
+        tokcache_status = {"corpus": "hit" if cache_hit else "miss"}
+        if is_stream:
+            corpus_ids = cached_ids
+            num_docs = len(corpus_ids)
+            corpus_lst = None
+    elif corpus_loader == "stream":
+        corpus_ids, tokenized_corpus = utils.tokenize_stream(
+            iter_corpus(data_path), **tokenize_kwargs
+        )
+        num_docs = len(corpus_ids)
+        corpus_lst = None
+    else:
+        tokenized_corpus = utils.tokenize(corpus_lst, **tokenize_kwargs)
     timer.stop(t, show=True, n_total=num_docs)
 
+    if corpus_loader == "stream":
+        print(f"Corpus Size: {num_docs:,}")
+    if tokcache_status is not None:
+        print(f"Tokenization cache: {tokcache_status['corpus']}")
+
+    ids_memory = {}
+    if flat_ids or tokcache:
+        ids_memory = {
+            "ids_nbytes": tokenized_corpus.ids.nbytes,
+            "ids_nbytes_as_lists": tokenized_corpus.ids.nbytes_as_lists(),
+        }
+        saved_gb = (ids_memory["ids_nbytes_as_lists"] - ids_memory["ids_nbytes"]) / 1024**3
+        print(f"Flat ids: {ids_memory['ids_nbytes'] / 1024**3:.4f} GB ({saved_gb:.4f} GB saved vs. lists)")
+
+    corpus_vocab = None
+    if token_ids:
+        # rank-bm25 accepts any hashable token, so it can be given the ids directly,
+        # and the queries are mapped to the same ids with the frozen corpus vocab
+        corpus_vocab = tokenized_corpus.vocab
+        tokenized_corpus = tokenized_corpus.ids
+        if isinstance(tokenized_corpus, utils.FlatIds):
+            t = timer.start("Decode Corpus")
+            tokenized_corpus = tokenized_corpus.to_lists()
+            timer.stop(t, show=True, n_total=num_docs)
+
+    elif flat_ids or tokcache:
+        # decode the ids back to the token strings used by rank-bm25
+        t = timer.start("Decode Corpus")
+        tokenized_corpus = utils.decode(tokenized_corpus)
+        timer.stop(t, show=True, n_total=num_docs)
+
     del corpus_lst
 
     t = timer.start("Tokenize Queries")
-    queries_tokenized = utils.tokenize(queries_lst, stopwords="en", stemmer=stemmer)
+    queries_tokenized = utils.tokenize(
+        queries_lst,
+        stopwords="en",
+        stemmer=stemmer,
+        stem_cache=stem_cache,
+        return_ids=token_ids,
+        vocab=corpus_vocab,
+        timer=timer,
+        timer_prefix="Tokenize Queries",
+    )
+    if token_ids:
+        queries_tokenized = queries_tokenized.ids
     timer.stop(t, show=True, n_total=len(queries_lst))
 
+    stem_stats = {}
+    if stem_cache is not None:
+        stem_stats = stem_cache.stats()
+        print(f"Stems computed: {stem_stats['stems_computed']:,}, reused: {stem_stats['stems_reused']:,}")
+        stem_cache.save(stem_cache_path)
+
+    query_sample = None
+    if 0 < samples < len(queries_lst):
+        # stratified by the cost of each query, so the throughput of the full query set
+        # can be extrapolated from the sample
+        num_query_tokens, postings = query_costs(
+            queries_tokenized, doc_frequencies(tokenized_corpus)
+        )
+        query_sample = stratified_sample(num_query_tokens, postings, samples, seed=42)
+        qids = query_sample.select(qids)
+        queries_lst = query_sample.select(queries_lst)
+        queries_tokenized = query_sample.select(queries_tokenized)
+        print(f"Sampled Queries: {len(queries_lst):,} of {query_sample.num_queries:,}")
+
     num_tokens = sum(len(doc) for doc in tokenized_corpus)
     print(f"Number of Tokens: {num_tokens:,}")
     print(f"Number of Tokens / Doc: {num_tokens / num_docs:.2f}")
@@ -131,32 +270,57 @@ def main(
 
     results = []
     scores = []
-
-    t_score = timer.start("Score")
-    timer.pause("Score")
-    t_query = timer.start("Query")
-    for q in tqdm(
-        queries_tokenized, desc="Rank-BM25 Scoring", leave=False, disable=not verbose
-    ):
-        timer.resume(t_score)
-        raw_scores = model.get_scores(q)
-        timer.pause(t_score)
-        result, score = compute_top_k_from_scores(
-            raw_scores, corpus=corpus_ids, k=top_k, with_scores=True
+    query_seconds = []
+
+    with timer.span("Query", show=True, n_total=len(queries_lst)) as t_query:
+        for q in tqdm(
+            queries_tokenized, desc="Rank-BM25 Scoring", leave=False, disable=not verbose
+        ):
+            start = time.perf_counter()
+            with timer.span("Score", memory=False):
+                raw_scores = model.get_scores(q)
+            with timer.span("Topk", memory=False):
+                result, score = compute_top_k_from_scores(
+                    raw_scores, k=top_k, with_scores=True
+                )
+            results.append(result)
+            scores.append(score)
+            query_seconds.append(time.perf_counter() - start)
+
+        queried_results = np.array(results)
+        queried_scores = np.array(scores)
+
+    timer.show(f"{t_query}/Score", n_total=len(queries_lst))
+    timer.show(f"{t_query}/Topk", n_total=len(queries_lst))
+
+    latency_stats = None
+    if latency:
+        # the queries are already issued one at a time, so their times in the loop above
+        # are the latencies, without the tokenization (negligible next to the scoring)
+        histogram = LatencyHistogram()
+        histogram.record_many(query_seconds)
+        histogram.show("[Rank-BM25]")
+        latency_stats = {"mode": "in_batch", **histogram.to_dict()}
+
+    sampling = None
+    if query_sample is not None:
+        sampling = extrapolate_throughput(query_sample, query_seconds)
+        qps_high = sampling["qps_high"]
+        qps_high = "inf" if qps_high is None else f"{qps_high:.2f}"
+        print(
+            f"Extrapolated Query (all {sampling['num_queries']:,}): {sampling['total_seconds']:.4f}s "
+            f"({sampling['qps']:.2f}/s, {sampling['confidence']:.0%} CI: "
+            f"{sampling['qps_low']:.2f}-{qps_high}/s)"
         )
-        results.append(result)
-        scores.append(score)
-
-    queried_results = np.array(results)
-    queried_scores = np.array(scores)
-
-    timer.stop(t_score, show=True, n_total=len(queries_lst))
-    timer.stop(t_query, show=True, n_total=len(queries_lst))
 
-    results_dict = postprocess_results_for_eval(queried_results, queried_scores, qids)
-    ndcg, _map, recall, precision = EvaluateRetrieval.evaluate(
-        qrels, results_dict, [1, 10, 100, 1000]
-    )
+    t = timer.start("Evaluate")
+    results = RetrievalResults(queried_results, queried_scores, qids, corpus_ids)
+    if evaluator == "numpy":
+        # compiled once per dataset and split, and memory-mapped afterwards
+        qrels = load_qrels_compiled(data_path, split=split, corpus_ids=corpus_ids)
+    ndcg, _map, recall, precision = results.evaluate(qrels, [1, 10, 100, 1000])
+    timer.stop(t, show=True, n_total=len(queries_lst))
+    memory.stop()
 
     max_mem_gb = get_max_memory_usage("GB")
 
@@ -175,13 +339,25 @@ def main(
         "method": method,
         "date": time.strftime("%Y-%m-%d %H:%M:%S"),
         "n_threads": n_threads,
+        "n_jobs": n_jobs,
+        "batched": batched,
+        "flat_ids": flat_ids,
+        "corpus_loader": corpus_loader,
+        "token_ids": token_ids,
+        "evaluator": evaluator,
+        "tokcache": tokcache_status,
         "samples": samples,
+        "sampling": sampling,
+        "latency": latency_stats,
+        "corpus_fraction": corpus_fraction,
         "top_k": top_k,
         "max_mem_gb": max_mem_gb,
         "stats": {
             "num_docs": num_docs,
             "num_queries": len(queries_lst),
             "num_tokens": num_tokens,
+            **ids_memory,
+            **stem_stats,
         },
         "timing": timer.to_dict(underscore=True, lowercase=True),
         "scores": {
@@ -231,7 +407,80 @@ if __name__ == "__main__":
         "--samples",
         type=int,
         default=0,
-        help="Number of samples to use from the dataset. If 0, use all samples.",
+        help="Number of queries to sample, stratified by query cost, to extrapolate the throughput of the full query set. If 0, use all queries.",
+    )
+
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=1,
+        help="Number of processes used to tokenize the corpus. If -1, use all cores.",
+    )
+
+    parser.add_argument(
+        "--batched",
+        action="store_true",
+        help="Split the corpus in chunks with a single regex call per chunk (ignored if n_jobs > 1).",
+    )
+
+    parser.add_argument(
+        "--flat_ids",
+        action="store_true",
+        help="Tokenize the corpus to flat int32 ids and decode them for rank-bm25.",
+    )
+
+    parser.add_argument(
+        "--corpus_loader",
+        type=str,
+        default="beir",
+        choices=["beir", "stream", "columnar"],
+        help="How to load the corpus. 'stream' reads corpus.jsonl line by line during tokenization, 'columnar' memory-maps a columnar copy of it (built on first use).",
+    )
+
+    parser.add_argument(
+        "--tokcache",
+        action="store_true",
+        help="Load the tokenized corpus from the on-disk cache under save_dir/<dataset>/tokcache (and fill it on a miss).",
+    )
+
+    parser.add_argument(
+        "--stem_cache",
+        type=str,
+        default=None,
+        help="Path of a stem table (utils.StemCache) shared by the corpus, the queries and later runs.",
+    )
+
+    parser.add_argument(
+        "--token_ids",
+        action="store_true",
+        help="Give rank-bm25 integer token ids instead of strings; queries are mapped with the frozen corpus vocab.",
+    )
+
+    parser.add_argument(
+        "--evaluator",
+        type=str,
+        default="beir",
+        choices=["beir", "numpy"],
+        help="Compute the metrics with BEIR's EvaluateRetrieval, or from the result arrays with utils.evaluation.",
+    )
+
+    parser.add_argument(
+        "--corpus_fraction",
+        type=float,
+        nargs="+",
+        default=[1.0],
+        help="Fractions of the corpus to benchmark on, from smallest to largest (documents of the qrels are always kept).",
+    )
+
+    parser.add_argument(
+        "--tracemalloc",
+        action="store_true",
+        help="Also record the memory allocated by python in each phase (slows down allocations).",
+    )
+    parser.add_argument(
+        "--latency",
+        action="store_true",
+        help="Record the latency of each query in a histogram, and save its percentiles.",
     )
 
     parser.add_argument(
@@ -257,6 +506,12 @@ if __name__ == "__main__":
         default="datasets",
         help="Directory to save datasets.",
     )
+    parser.add_argument(
+        "--mirror_dir",
+        type=str,
+        default=None,
+        help="Directory with the dataset zips and their checksums.json, to unpack datasets from instead of downloading them.",
+    )
     parser.add_argument(
         "--method",
         type=str,
@@ -267,17 +522,21 @@ if __name__ == "__main__":
     kwargs = vars(parser.parse_args())
     profile = kwargs.pop("profile")
     num_runs = kwargs.pop("num_runs")
+    # smallest first, so the peak memory of each run is not hidden by a larger one
+    corpus_fractions = sorted(kwargs.pop("corpus_fraction"))
 
     if profile:
         import cProfile
         import pstats
 
-        if num_runs > 1:
+        if num_runs > 1 or len(corpus_fractions) > 1:
             raise ValueError("Cannot profile with multiple runs.")
 
+        kwargs["corpus_fraction"] = corpus_fractions[0]
         cProfile.run("main(**kwargs)", filename="rankbm25.prof")
         p = pstats.Stats("rankbm25.prof")
         p.sort_stats("time").print_stats(50)
     else:
-        for _ in range(num_runs):
-            main(**kwargs)
+        for corpus_fraction in corpus_fractions:
+            for _ in range(num_runs):
+                main(**kwargs, corpus_fraction=corpus_fraction)
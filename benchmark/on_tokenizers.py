@@ -0,0 +1,371 @@
+"""
+Compare the tokenizers used by the engines on the same corpus, outside of any engine
+run: `utils.tokenize` (per-document loop, batched, and multi-process), `bm25s.tokenize`,
+the `bm25s.tokenization.Tokenizer` class and the huggingface fast tokenizer used by
+bm25-pt (`utils.huggingface.batch_tokenize`, to token strings or to flat ids).
+
+Each configuration runs in a forked child process, so the peak memory of one does not
+hide the others and the huggingface thread pool can be sized per run (it reads
+`RAYON_NUM_THREADS` when it is first used). The token strings produced by every run
+are hashed and compared to the reference run of the same family: the regex tokenizers
+(utils and bm25s) must all agree with the `utils.tokenize` loop, and the huggingface
+runs with each other.
+"""
+import hashlib
+from itertools import chain
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import time
+
+
+from utils.beir import DatasetRegistry, iter_corpus, merge_cqa_dupstack
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+TOKENIZERS = ["utils", "utils-batched", "bm25s", "bm25s-class", "hf", "hf-ids"]
+# tokenizers that can use more than one thread (or process)
+THREADED = {"utils", "hf", "hf-ids"}
+FAMILIES = {
+    "utils": "regex",
+    "utils-batched": "regex",
+    "bm25s": "regex",
+    "bm25s-class": "regex",
+    "hf": "hf",
+    "hf-ids": "hf",
+}
+
+
+def _get_stemmer(stemmer_name):
+    if stemmer_name is None:
+        return None
+
+    import Stemmer
+
+    return Stemmer.Stemmer("english")
+
+
+def run_utils(texts, n_threads, stopwords, stemmer_name, batched=False, **kwargs):
+    import utils
+
+    stemmer = _get_stemmer(stemmer_name)
+    start = time.perf_counter()
+    tokenized = utils.tokenize(
+        texts,
+        stopwords=stopwords,
+        stemmer=stemmer,
+        return_ids=True,
+        flat=True,
+        n_jobs=n_threads,
+        batched=batched,
+    )
+    elapsed = time.perf_counter() - start
+
+    return elapsed, lambda: utils.decode(tokenized)
+
+
+def run_utils_batched(texts, n_threads, stopwords, stemmer_name, **kwargs):
+    return run_utils(texts, n_threads, stopwords, stemmer_name, batched=True)
+
+
+def run_bm25s(texts, n_threads, stopwords, stemmer_name, **kwargs):
+    import bm25s
+    import utils
+
+    stemmer = _get_stemmer(stemmer_name)
+    start = time.perf_counter()
+    tokenized = bm25s.tokenize(
+        texts, stopwords=stopwords, stemmer=stemmer, return_ids=True, show_progress=False
+    )
+    elapsed = time.perf_counter() - start
+
+    return elapsed, lambda: utils.decode(tokenized)
+
+
+def run_bm25s_class(texts, n_threads, stopwords, stemmer_name, **kwargs):
+    import bm25s
+
+    stemmer = _get_stemmer(stemmer_name)
+    tokenizer = bm25s.tokenization.Tokenizer(stopwords=stopwords, stemmer=stemmer)
+    start = time.perf_counter()
+    ids = tokenizer.tokenize(
+        texts, update_vocab=True, return_as="ids", show_progress=False
+    )
+    elapsed = time.perf_counter() - start
+
+    return elapsed, lambda: tokenizer.decode(ids)
+
+
+def run_hf(texts, n_threads, hf_model="bert-base-uncased", return_ids=False, **kwargs):
+    # must be set before the rust thread pool is created, i.e. before the first call
+    os.environ["RAYON_NUM_THREADS"] = str(n_threads)
+    os.environ["TOKENIZERS_PARALLELISM"] = "true" if n_threads > 1 else "false"
+
+    from transformers import AutoTokenizer
+
+    import utils.huggingface
+
+    tokenizer = AutoTokenizer.from_pretrained(hf_model)
+    start = time.perf_counter()
+    tokenized = utils.huggingface.batch_tokenize(tokenizer, texts, return_ids=return_ids)
+    elapsed = time.perf_counter() - start
+
+    if return_ids:
+        return elapsed, lambda: utils.decode(tokenized)
+    return elapsed, lambda: tokenized
+
+
+def run_hf_ids(texts, n_threads, **kwargs):
+    return run_hf(texts, n_threads, return_ids=True, **kwargs)
+
+
+RUNNERS = {
+    "utils": run_utils,
+    "utils-batched": run_utils_batched,
+    "bm25s": run_bm25s,
+    "bm25s-class": run_bm25s_class,
+    "hf": run_hf,
+    "hf-ids": run_hf_ids,
+}
+
+
+def _read_status_kb(field):
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM (the peak RSS) of the process on linux
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _digest(docs):
+    h = hashlib.sha1()
+    for doc in docs:
+        h.update(" ".join(doc).encode("utf-8"))
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def _child(conn, name, texts, n_threads, kwargs):
+    try:
+        if _reset_peak_rss():
+            rss_before = _read_status_kb("VmRSS")
+        else:
+            # a forked child starts with the peak RSS of its parent, so this
+            # underestimates runs that stay below it
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        elapsed, get_tokens = RUNNERS[name](texts, n_threads, **kwargs)
+
+        peak = _read_status_kb("VmHWM")
+        if peak is None:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        docs = get_tokens()
+        n_tokens = sum(len(doc) for doc in docs)
+        vocab_size = len(set(chain.from_iterable(docs)))
+
+        conn.send(
+            {
+                "elapsed": elapsed,
+                "peak_mem_delta_gb": (peak - rss_before) / 1024**2,
+                "n_tokens": n_tokens,
+                "vocab_size": vocab_size,
+                "digest": _digest(docs),
+            }
+        )
+    except ImportError as e:
+        conn.send({"skipped": str(e)})
+    except Exception as e:
+        conn.send({"error": repr(e)})
+    finally:
+        conn.close()
+
+
+def run_in_child(name, texts, n_threads, kwargs):
+    ctx = multiprocessing.get_context("fork")
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    p = ctx.Process(target=_child, args=(child_conn, name, texts, n_threads, kwargs))
+    p.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        # the child died without sending anything, e.g. killed by the OOM killer
+        result = {"error": "child process exited unexpectedly"}
+    p.join()
+
+    if p.exitcode not in (0, None) and "error" not in result:
+        result["error"] = f"child process exited with code {p.exitcode}"
+
+    return result
+
+
+def main(
+    dataset,
+    tokenizers=TOKENIZERS,
+    n_threads=(1,),
+    stopwords="en",
+    stemmer_name="snowball",
+    hf_model="bert-base-uncased",
+    save_dir="datasets",
+    mirror_dir=None,
+    result_dir="results",
+):
+    #### Resolve the dataset (downloaded, or unpacked from the mirror, on first use)
+    data_path = DatasetRegistry(save_dir, mirror_dir=mirror_dir).resolve(dataset)
+
+    if dataset == "cqadupstack":
+        merge_cqa_dupstack(data_path)
+
+    stopwords = None if stopwords == "none" else stopwords
+    stemmer_name = None if stemmer_name == "none" else stemmer_name
+
+    corpus_lst = [text for _, text in iter_corpus(data_path)]
+    num_docs = len(corpus_lst)
+
+    print("=" * 50)
+    print("Dataset: ", dataset)
+    print(f"Corpus Size: {num_docs:,}")
+    print("-" * 50)
+
+    kwargs = dict(stopwords=stopwords, stemmer_name=stemmer_name, hf_model=hf_model)
+    runs = []
+    references = {}
+    for name in tokenizers:
+        threads_sweep = n_threads if name in THREADED else [1]
+        for n in threads_sweep:
+            result = run_in_child(name, corpus_lst, n, kwargs)
+            run = {"tokenizer": name, "n_threads": n, **result}
+            runs.append(run)
+
+            if "skipped" in result:
+                print(f"{name} (threads={n}): skipped ({result['skipped']})")
+                continue
+            if "error" in result:
+                print(f"{name} (threads={n}): failed ({result['error']})")
+                continue
+
+            family = FAMILIES[name]
+            reference = references.setdefault(family, (name, n, result["digest"]))
+            run["identical"] = result["digest"] == reference[2]
+            run["reference"] = f"{reference[0]} (threads={reference[1]})"
+            run["docs_per_sec"] = num_docs / result["elapsed"]
+            run["tokens_per_sec"] = result["n_tokens"] / result["elapsed"]
+
+            print(
+                f"{name} (threads={n}): {result['elapsed']:.2f}s, "
+                f"{run['docs_per_sec']:,.0f} docs/s, {run['tokens_per_sec']:,.0f} tokens/s, "
+                f"peak mem +{result['peak_mem_delta_gb']:.4f} GB, "
+                f"vocab size {result['vocab_size']:,}"
+            )
+            if not run["identical"]:
+                print(f"  -> output differs from {run['reference']}")
+
+    print("=" * 50)
+
+    save_dict = {
+        "model": "tokenizers",
+        "dataset": dataset,
+        "stemmer": stemmer_name,
+        "stopwords": stopwords,
+        "hf_model": hf_model,
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "stats": {"num_docs": num_docs},
+        "runs": runs,
+    }
+
+    result_dir = Path(result_dir) / save_dict["model"]
+    result_dir.mkdir(parents=True, exist_ok=True)
+    save_path = Path(result_dir) / f"{dataset}-{os.urandom(8).hex()}.json"
+    with open(save_path, "w") as f:
+        json.dump(save_dict, f, indent=2)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Compare the tokenizers of the engines on a dataset.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "-d",
+        "--dataset",
+        type=str,
+        default="fiqa",
+        help="Dataset to benchmark on.",
+    )
+    parser.add_argument(
+        "--tokenizers",
+        type=str,
+        nargs="+",
+        default=TOKENIZERS,
+        choices=TOKENIZERS,
+        help="Tokenizers to compare.",
+    )
+    parser.add_argument(
+        "-t",
+        "--n_threads",
+        type=int,
+        nargs="+",
+        default=[1],
+        help="Thread counts to sweep for the tokenizers that support it (processes for utils).",
+    )
+    parser.add_argument(
+        "--stopwords",
+        type=str,
+        default="en",
+        help="Stopwords of the regex tokenizers ('none' to disable).",
+    )
+    parser.add_argument(
+        "--stemmer_name",
+        type=str,
+        default="snowball",
+        choices=["snowball", "none"],
+        help="Stemmer of the regex tokenizers.",
+    )
+    parser.add_argument(
+        "--hf_model",
+        type=str,
+        default="bert-base-uncased",
+        help="Huggingface tokenizer to compare.",
+    )
+    parser.add_argument(
+        "--result_dir",
+        type=str,
+        default="results",
+        help="Directory to save results.",
+    )
+    parser.add_argument(
+        "--save_dir",
+        type=str,
+        default="datasets",
+        help="Directory to save datasets.",
+    )
+    parser.add_argument(
+        "--mirror_dir",
+        type=str,
+        default=None,
+        help="Directory with the dataset zips and their checksums.json, to unpack datasets from instead of downloading them.",
+    )
+
+    kwargs = vars(parser.parse_args())
+    main(**kwargs)
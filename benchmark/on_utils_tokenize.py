@@ -0,0 +1,168 @@
+"""
+Micro-benchmark of the split phase of `utils.tokenize`: the per-document loop
+(`batched=False`) against the chunked fast path (`batched=True`), which splits a whole
+chunk of documents with a single regex call and filters stopwords with a mask over
+token ids. Both paths are checked to give the same ids and vocabulary.
+"""
+import json
+import os
+from pathlib import Path
+import time
+
+import utils
+from utils.beir import DatasetRegistry, iter_corpus, merge_cqa_dupstack
+
+DATASETS = [
+    "nfcorpus",
+    "scifact",
+    "arguana",
+    "scidocs",
+    "fiqa",
+    "trec-covid",
+    "webis-touche2020",
+    "quora",
+    "cqadupstack",
+    "nq",
+    "dbpedia-entity",
+    "hotpotqa",
+    "fever",
+    "climate-fever",
+    "msmarco",
+]
+
+
+def time_tokenize(corpus_lst, num_runs=1, **kwargs):
+    best = None
+    for _ in range(num_runs):
+        start = time.perf_counter()
+        tokenized = utils.tokenize(corpus_lst, return_ids=True, flat=True, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return tokenized, best
+
+
+def main(
+    dataset,
+    save_dir="datasets",
+    mirror_dir=None,
+    result_dir="results",
+    chunk_size=10_000,
+    num_runs=1,
+    stopwords="en",
+):
+    data_path = DatasetRegistry(save_dir, mirror_dir=mirror_dir).resolve(dataset)
+
+    if dataset == "cqadupstack":
+        merge_cqa_dupstack(data_path)
+
+    corpus_lst = [text for _, text in iter_corpus(data_path)]
+    num_docs = len(corpus_lst)
+
+    print("=" * 50)
+    print("Dataset: ", dataset)
+    print(f"Corpus Size: {num_docs:,}")
+
+    loop, loop_time = time_tokenize(
+        corpus_lst, num_runs=num_runs, stopwords=stopwords, chunk_size=chunk_size
+    )
+    batched, batched_time = time_tokenize(
+        corpus_lst,
+        num_runs=num_runs,
+        stopwords=stopwords,
+        chunk_size=chunk_size,
+        batched=True,
+    )
+
+    identical = (
+        loop.vocab == batched.vocab
+        and (loop.ids.offsets == batched.ids.offsets).all()
+        and (loop.ids.data == batched.ids.data).all()
+    )
+    if not identical:
+        raise RuntimeError(f"Batched tokenization differs from the loop on {dataset}")
+
+    num_tokens = len(loop.ids.data)
+    print(f"Number of Tokens: {num_tokens:,}")
+    print(f"Loop:    {loop_time:.2f}s ({num_docs / loop_time:,.0f} docs/s)")
+    print(f"Batched: {batched_time:.2f}s ({num_docs / batched_time:,.0f} docs/s)")
+    print(f"Speedup: {loop_time / batched_time:.2f}x")
+
+    save_dict = {
+        "model": "utils-tokenize",
+        "dataset": dataset,
+        "stopwords": stopwords,
+        "chunk_size": chunk_size,
+        "num_runs": num_runs,
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "stats": {
+            "num_docs": num_docs,
+            "num_tokens": num_tokens,
+            "vocab_size": len(loop.vocab),
+        },
+        "timing": {
+            "loop": {"elapsed": loop_time, "docs_per_sec": num_docs / loop_time},
+            "batched": {"elapsed": batched_time, "docs_per_sec": num_docs / batched_time},
+        },
+        "speedup": loop_time / batched_time,
+    }
+
+    result_dir = Path(result_dir) / "tokenize"
+    result_dir.mkdir(parents=True, exist_ok=True)
+    save_path = result_dir / f"{dataset}-{os.urandom(8).hex()}.json"
+    with open(save_path, "w") as f:
+        json.dump(save_dict, f, indent=2)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Compare the per-document and batched split loops of utils.tokenize.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "-d",
+        "--datasets",
+        type=str,
+        nargs="+",
+        default=DATASETS,
+        help="Datasets to benchmark on.",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=10_000,
+        help="Number of documents split by a single regex call in the batched path.",
+    )
+    parser.add_argument(
+        "--num_runs",
+        type=int,
+        default=1,
+        help="Number of runs per path; the fastest one is reported.",
+    )
+    parser.add_argument(
+        "--result_dir",
+        type=str,
+        default="results",
+        help="Directory to save results.",
+    )
+    parser.add_argument(
+        "--save_dir",
+        type=str,
+        default="datasets",
+        help="Directory to save datasets.",
+    )
+    parser.add_argument(
+        "--mirror_dir",
+        type=str,
+        default=None,
+        help="Directory with the dataset zips and their checksums.json, to unpack datasets from instead of downloading them.",
+    )
+
+    kwargs = vars(parser.parse_args())
+    datasets = kwargs.pop("datasets")
+
+    for dataset in datasets:
+        main(dataset, **kwargs)
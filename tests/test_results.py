@@ -0,0 +1,35 @@
+import numpy as np
+
+from utils.evaluation import compile_qrels
+from utils.results import RetrievalResults
+
+CORPUS_IDS = ["d0", "d1", "d2"]
+# the first two scores only differ beyond float32 precision
+HIGH, LOW = 1.0 + 1e-12, 1.0
+
+
+def test_float64_scores_are_kept():
+    scores = np.array([[LOW, HIGH, 0.5]], dtype=np.float64)
+    results = RetrievalResults([[0, 1, 2]], scores, ["q"], CORPUS_IDS)
+
+    assert results.scores.dtype == np.float64
+    assert results.scores[0, 1] > results.scores[0, 0]
+    assert results.to_beir_dict()["q"] == {"d0": LOW, "d1": HIGH, "d2": 0.5}
+
+
+def test_from_beir_dict_orders_by_full_precision():
+    results = RetrievalResults.from_beir_dict({"q": {"d0": LOW, "d1": HIGH}}, CORPUS_IDS)
+
+    # as float32, the scores would tie and d1 would be ranked below d0
+    assert results.indices.tolist() == [[1, 0]]
+    assert results.scores.tolist() == [[HIGH, LOW]]
+
+
+def test_evaluate_ranks_by_full_precision():
+    # only d1 is relevant: it is ranked second by its score, but first if the scores
+    # tie (ties are broken by decreasing document id)
+    qrels = compile_qrels({"q": {"d1": 1}}, CORPUS_IDS)
+    results = RetrievalResults([[0, 1]], np.array([[HIGH, LOW]]), ["q"], CORPUS_IDS)
+
+    ndcg, _, _, _ = results.evaluate(qrels, k_values=[1])
+    assert ndcg["NDCG@1"] == 0.0
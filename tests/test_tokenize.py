@@ -0,0 +1,26 @@
+import json
+
+import utils
+from utils.tokcache import load_tokenized, save_tokenized
+
+TEXTS = [
+    "The quick brown fox jumps over the lazy dog",
+    "",
+    "A fox, a dog and the other dog",
+    "Quick quick QUICK",
+]
+
+
+def test_batched_vocab_is_json_serializable(tmp_path):
+    tokenized = utils.tokenize(
+        TEXTS, stopwords="en", return_ids=True, flat=True, batched=True, chunk_size=3
+    )
+    reference = utils.tokenize(TEXTS, stopwords="en", return_ids=True)
+
+    assert all(type(i) is int for i in tokenized.vocab.values())
+    assert json.loads(json.dumps(tokenized.vocab)) == reference.vocab
+
+    save_tokenized(tmp_path / "entry", tokenized)
+    loaded, _ = load_tokenized(tmp_path / "entry")
+    assert loaded.vocab == reference.vocab
+    assert loaded.ids.to_lists() == reference.ids
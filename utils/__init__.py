@@ -1,9 +1,169 @@
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
+from itertools import chain, islice
+import os
 import re
+import sys
+import time
 from typing import Any, Dict, List, Union, Callable, NamedTuple
 
+import numpy as np
+
+
+_SPLIT_STATS = ("split_time", "stopwords_time", "vocab_time", "n_tokens", "n_stopwords")
+
+
+class FlatIds:
+    """
+    Compact (CSR-style) storage of a tokenized corpus: the token ids of all documents
+    are concatenated in a single int32 array `data`, and the ids of document `i` are
+    `data[offsets[i]:offsets[i + 1]]`. Indexing and iterating return numpy views, so
+    it can be passed where a list of lists of ids is expected (e.g. `bm25s.BM25.index`).
+    """
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_lengths(cls, data, lengths) -> "FlatIds":
+        """
+        Build from the concatenated ids and the number of ids of each document, e.g.
+        the `array` buffers filled while splitting (which are not copied).
+        """
+        if isinstance(data, array):
+            data = np.frombuffer(data, dtype=np.int32)
+        else:
+            data = np.asarray(data, dtype=np.int32)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(np.asarray(lengths, dtype=np.int64), out=offsets[1:])
+        return cls(data, offsets)
+
+    @classmethod
+    def from_lists(cls, ids: List[List[int]]) -> "FlatIds":
+        lengths = np.fromiter((len(doc) for doc in ids), dtype=np.int64, count=len(ids))
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        data = np.fromiter(
+            chain.from_iterable(ids), dtype=np.int32, count=int(offsets[-1])
+        )
+        return cls(data, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i] : self.offsets[i + 1]]
+
+    def __iter__(self):
+        data, offsets = self.data, self.offsets
+        for i in range(len(self)):
+            yield data[offsets[i] : offsets[i + 1]]
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes + self.offsets.nbytes
+
+    def nbytes_as_lists(self) -> int:
+        """
+        Estimate the memory the same ids would take as a list of Python lists of ints,
+        i.e. the list objects, their pointer arrays and one int object per id (ids up to
+        256 are cached by CPython and therefore not counted).
+        """
+        n_docs, n_ids = len(self), len(self.data)
+        n_boxed = int(np.count_nonzero(self.data > 256))
+        return (
+            sys.getsizeof([]) * (n_docs + 1)
+            + 8 * (n_docs + n_ids)
+            + sys.getsizeof(2**20) * n_boxed
+        )
+
+    def to_lists(self) -> List[List[int]]:
+        data = self.data.tolist()
+        offsets = self.offsets.tolist()
+        return [data[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def masked(self, keep: np.ndarray) -> "FlatIds":
+        """
+        Return a new `FlatIds` with only the ids where the boolean array `keep` (of the
+        same length as `data`) is True, with the document boundaries updated.
+        """
+        doc_index = np.repeat(np.arange(len(self)), np.diff(self.offsets))
+        counts = np.bincount(doc_index[keep], minlength=len(self))
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return FlatIds(self.data[keep], offsets)
+
+
+class StemCache:
+    """
+    Memoization table mapping words to their stems, which can be passed to `tokenize`
+    (through `stem_cache`) to share stems between the corpus, the queries and
+    different runs (see `save` and `load`). Only words that are not yet in the table
+    are passed to the stemmer. The table is only valid for a single stemmer.
+    """
+
+    def __init__(self, stems: Dict[str, str] = None):
+        self.stems = dict(stems or {})
+        self.n_computed = 0
+        self.n_reused = 0
+
+    def __len__(self):
+        return len(self.stems)
+
+    def stem_words(self, words: List[str], stemmer_fn: Callable) -> List[str]:
+        stems = self.stems
+        missing = [word for word in words if word not in stems]
+        if missing:
+            stems.update(zip(missing, stemmer_fn(missing)))
+
+        self.n_computed += len(missing)
+        self.n_reused += len(words) - len(missing)
+
+        return [stems[word] for word in words]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "stems_computed": self.n_computed,
+            "stems_reused": self.n_reused,
+            "stem_cache_size": len(self),
+        }
+
+    def save(self, path):
+        """
+        Save the table as a text file with one word per line. Since most stems are a
+        prefix of their word, a line is either `word` (the stem is the word itself),
+        `word\t-n` (the stem is the word without its last n characters) or
+        `word\t=stem`.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            for word, stem in self.stems.items():
+                if stem == word:
+                    f.write(f"{word}\n")
+                elif word.startswith(stem):
+                    f.write(f"{word}\t-{len(word) - len(stem)}\n")
+                else:
+                    f.write(f"{word}\t={stem}\n")
+
+    @classmethod
+    def load(cls, path) -> "StemCache":
+        stems = {}
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                word, _, stem = line.rstrip("\n").partition("\t")
+                if not stem:
+                    stems[word] = word
+                elif stem[0] == "-":
+                    stems[word] = word[: len(word) - int(stem[1:])]
+                else:
+                    stems[word] = stem[1:]
+
+        return cls(stems)
+
+
 class Tokenized(NamedTuple):
-    ids: List[List[int]]
+    ids: Union[List[List[int]], FlatIds]
     vocab: Dict[str, int]
 
 def _infer_stopwords(stopwords: Union[str, List[str]]) -> List[str]:
@@ -43,7 +203,9 @@ def _infer_stopwords(stopwords: Union[str, List[str]]) -> List[str]:
         "with",
     )
 
-    if stopwords in ["english", "en", True]:
+    if stopwords is None or stopwords is False:
+        return []
+    elif stopwords in ["english", "en", True]:
         return STOPWORDS_EN
     elif isinstance(stopwords, str):
         raise ValueError(
@@ -53,6 +215,329 @@ def _infer_stopwords(stopwords: Union[str, List[str]]) -> List[str]:
     else:
         return stopwords
 
+def _split_shard(texts, lower, token_pattern, stopwords, instrument=False, flat=False):
+    """
+    Split a shard of texts into token ids using a shard-local vocabulary. This is
+    run inside the worker processes of `tokenize(..., n_jobs=...)`, so it must stay
+    a module-level function (picklable). Token ids follow the order in which the
+    tokens are first seen in the shard. If `flat` is True, the ids are appended to
+    int32 buffers as the texts are split and returned as a `FlatIds`, so the list of
+    lists of the shard is never built.
+
+    If `instrument` is True, the time spent splitting (lowercasing and regex),
+    filtering stopwords and assigning ids is accumulated per document, along with
+    the number of tokens split and dropped as stopwords. Otherwise, stats is None.
+    """
+    split_fn = re.compile(token_pattern).findall
+    stopwords_set = set(stopwords)
+    clock = time.perf_counter
+
+    shard_ids = []
+    data, lengths = array("i"), array("q")
+    token_to_index = {}
+    stats = dict.fromkeys(_SPLIT_STATS, 0) if instrument else None
+
+    for text in texts:
+        if instrument:
+            t0 = clock()
+
+        if lower:
+            text = text.lower()
+        splitted = split_fn(text)
+
+        if instrument:
+            t1 = clock()
+
+        tokens = [token for token in splitted if token not in stopwords_set]
+
+        if instrument:
+            t2 = clock()
+
+        doc_ids = []
+        for token in tokens:
+            if token not in token_to_index:
+                token_to_index[token] = len(token_to_index)
+
+            doc_ids.append(token_to_index[token])
+
+        if flat:
+            data.extend(doc_ids)
+            lengths.append(len(doc_ids))
+        else:
+            shard_ids.append(doc_ids)
+
+        if instrument:
+            stats["split_time"] += t1 - t0
+            stats["stopwords_time"] += t2 - t1
+            stats["vocab_time"] += clock() - t2
+            stats["n_tokens"] += len(splitted)
+            stats["n_stopwords"] += len(splitted) - len(tokens)
+
+    if flat:
+        shard_ids = FlatIds.from_lengths(data, lengths)
+
+    return shard_ids, token_to_index, stats
+
+
+def _iter_chunks(texts, chunk_size):
+    texts = iter(texts)
+    while True:
+        chunk = list(islice(texts, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _split_parallel(
+    texts, lower, token_pattern, stopwords, n_jobs, chunk_size, tqdm, instrument=False, flat=False
+):
+    """
+    Split the texts in a process pool, one chunk of `chunk_size` texts per task, and
+    merge the shard-local vocabularies into a single `token_to_index`. Shards are
+    merged in corpus order, and each shard vocabulary is in first-seen order, so the
+    ids are identical to the ones produced by the sequential loop. At most
+    `2 * n_jobs` chunks are in flight, so `texts` can be a generator. Stats of the
+    shards (if `instrument`) are summed, i.e. times are summed over the workers. If
+    `flat` is True, the shards return `FlatIds` and are remapped with numpy.
+    """
+    corpus_ids = []
+    data_chunks, lengths_chunks = [], []
+    token_to_index = {}
+    stats = dict.fromkeys(_SPLIT_STATS, 0) if instrument else None
+    chunks = _iter_chunks(texts, chunk_size)
+    pbar = tqdm(desc="Split strings", unit="docs")
+
+    def merge(shard_ids, shard_token_to_index, shard_stats):
+        remap = []
+        for token in shard_token_to_index:
+            if token not in token_to_index:
+                token_to_index[token] = len(token_to_index)
+            remap.append(token_to_index[token])
+
+        if flat:
+            data_chunks.append(np.array(remap, dtype=np.int32)[shard_ids.data])
+            lengths_chunks.append(np.diff(shard_ids.offsets))
+        else:
+            for doc_ids in shard_ids:
+                corpus_ids.append([remap[i] for i in doc_ids])
+
+        if instrument:
+            for key, value in shard_stats.items():
+                stats[key] += value
+
+        pbar.update(len(shard_ids))
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        pending = []
+        for chunk in chunks:
+            pending.append(
+                pool.submit(
+                    _split_shard, chunk, lower, token_pattern, stopwords, instrument, flat
+                )
+            )
+            if len(pending) >= 2 * n_jobs:
+                merge(*pending.pop(0).result())
+
+        for future in pending:
+            merge(*future.result())
+
+    pbar.close()
+
+    if flat:
+        corpus_ids = FlatIds.from_lengths(
+            np.concatenate(data_chunks) if data_chunks else np.zeros(0, dtype=np.int32),
+            np.concatenate(lengths_chunks) if lengths_chunks else np.zeros(0, dtype=np.int64),
+        )
+
+    return corpus_ids, token_to_index, stats
+
+
+_BATCH_SEP = "\x00"
+
+
+def _split_batched(texts, lower, token_pattern, stopwords, chunk_size, tqdm, instrument=False):
+    """
+    Fast path of the string splitting: the documents of a chunk are joined with a
+    separator character, lowercased and split with a single regex call, and the
+    tokens are split back by document at the separators. Every token (including
+    stopwords) gets a chunk-independent id, stopwords are then removed with a boolean
+    mask over the ids, and the vocabulary is compacted at the end, which gives the
+    same ids as `_split_shard`. Returns the ids as a `FlatIds`.
+
+    If the separator does not come out as its own token for a chunk (e.g. it appears
+    in a document, or the pattern can match it), the chunk is split document by
+    document instead.
+    """
+    pattern = re.compile(token_pattern)
+    split_fn = pattern.findall
+    # global inline flags (e.g. "(?u)") must stay at the start of the pattern
+    inner = re.sub(r"^\(\?[aiLmsux]+\)", "", token_pattern)
+    batch_split_fn = re.compile(f"(?:{inner})|{_BATCH_SEP}", pattern.flags).findall
+    stopwords_set = set(stopwords)
+    clock = time.perf_counter
+
+    # local vocabulary with the separator (id 0) and stopwords
+    token_to_index = {_BATCH_SEP: 0}
+    is_stopword = [False]
+
+    data_chunks = []
+    counts_chunks = []
+    stats = dict.fromkeys(_SPLIT_STATS, 0) if instrument else None
+    pbar = tqdm(desc="Split strings", unit="docs")
+
+    for chunk in _iter_chunks(texts, chunk_size):
+        t0 = clock()
+
+        joined = _BATCH_SEP.join(chunk)
+        if lower:
+            joined = joined.lower()
+        tokens = batch_split_fn(joined)
+
+        if tokens.count(_BATCH_SEP) != len(chunk) - 1:
+            tokens = []
+            for i, text in enumerate(chunk):
+                if i > 0:
+                    tokens.append(_BATCH_SEP)
+                tokens.extend(split_fn(text.lower() if lower else text))
+
+        t1 = clock()
+
+        # dict.fromkeys keeps the order in which the tokens are first seen
+        for token in dict.fromkeys(tokens):
+            if token not in token_to_index:
+                token_to_index[token] = len(token_to_index)
+                is_stopword.append(token in stopwords_set)
+        ids = np.fromiter(
+            map(token_to_index.__getitem__, tokens), dtype=np.int32, count=len(tokens)
+        )
+
+        t2 = clock()
+
+        is_sep = ids == 0
+        keep = ~is_sep & ~np.array(is_stopword)[ids]
+        doc_index = np.cumsum(is_sep)
+        data_chunks.append(ids[keep])
+        counts_chunks.append(np.bincount(doc_index[keep], minlength=len(chunk)))
+
+        if instrument:
+            n_tokens = len(tokens) - (len(chunk) - 1)
+            stats["split_time"] += t1 - t0
+            stats["vocab_time"] += t2 - t1
+            stats["stopwords_time"] += clock() - t2
+            stats["n_tokens"] += n_tokens
+            stats["n_stopwords"] += n_tokens - len(data_chunks[-1])
+
+        pbar.update(len(chunk))
+
+    pbar.close()
+
+    # compact the vocabulary: drop the separator and stopwords, keeping the order in
+    # which the remaining tokens were first seen
+    remap = np.full(len(token_to_index), -1, dtype=np.int32)
+    compact_token_to_index = {}
+    for token, i in token_to_index.items():
+        if not is_stopword[i] and i != 0:
+            remap[i] = len(compact_token_to_index)
+            compact_token_to_index[token] = int(remap[i])
+
+    counts = np.concatenate(counts_chunks) if counts_chunks else np.zeros(0, np.int64)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    data = (
+        remap[np.concatenate(data_chunks)]
+        if data_chunks
+        else np.zeros(0, dtype=np.int32)
+    )
+
+    return FlatIds(data, offsets), compact_token_to_index, stats
+
+
+def _get_stemmer_fn(stemmer):
+    if hasattr(stemmer, "stemWords"):
+        return stemmer.stemWords
+    elif callable(stemmer):
+        return stemmer
+    else:
+        error_msg = "Stemmer must have a `stemWord` method, or be callable. For example, you can use the PyStemmer library."
+        raise ValueError(error_msg)
+
+
+def _split_frozen(
+    texts, lower, token_pattern, stopwords, vocab, stemmer, stem_cache, drop_oov, flat, instrument=False
+):
+    """
+    Split the texts straight into the ids of an existing (frozen) `vocab`, e.g. the one
+    of the tokenized corpus: each token (or its stem) is looked up in `vocab` as it is
+    split, so no vocabulary of the texts and no reverse mapping are built. Tokens that
+    are not in `vocab` are dropped, or given the id -1 if `drop_oov` is False.
+
+    The tokens are stemmed one document at a time (PyStemmer keeps a cache of the
+    recent words), or through `stem_cache` if one is given. If `instrument` is True,
+    the stats of `_split_shard` are returned with `stem_time` and `n_stemmed`, the
+    number of words passed to the stemmer.
+    """
+    split_fn = re.compile(token_pattern).findall
+    stopwords_set = set(stopwords)
+    stemmer_fn = _get_stemmer_fn(stemmer) if stemmer is not None else None
+    lookup = vocab.get
+    clock = time.perf_counter
+
+    corpus_ids = []
+    data, lengths = array("i"), array("q")
+    stats = dict.fromkeys(_SPLIT_STATS + ("stem_time", "n_stemmed"), 0) if instrument else None
+
+    for text in texts:
+        if instrument:
+            t0 = clock()
+
+        splitted = split_fn(text.lower() if lower else text)
+
+        if instrument:
+            t1 = clock()
+
+        tokens = [token for token in splitted if token not in stopwords_set]
+
+        if instrument:
+            t2 = clock()
+
+        if stemmer_fn is not None and tokens:
+            if stem_cache is not None:
+                n_computed = stem_cache.n_computed
+                tokens = stem_cache.stem_words(tokens, stemmer_fn)
+                n_stemmed = stem_cache.n_computed - n_computed
+            else:
+                tokens = stemmer_fn(tokens)
+                n_stemmed = len(tokens)
+            if instrument:
+                stats["n_stemmed"] += n_stemmed
+
+        if instrument:
+            t3 = clock()
+
+        doc_ids = [lookup(token, -1) for token in tokens]
+        if drop_oov:
+            doc_ids = [token_id for token_id in doc_ids if token_id != -1]
+
+        if flat:
+            data.extend(doc_ids)
+            lengths.append(len(doc_ids))
+        else:
+            corpus_ids.append(doc_ids)
+
+        if instrument:
+            stats["split_time"] += t1 - t0
+            stats["stopwords_time"] += t2 - t1
+            stats["stem_time"] += t3 - t2
+            stats["vocab_time"] += clock() - t3
+            stats["n_tokens"] += len(splitted)
+            stats["n_stopwords"] += len(splitted) - len(tokens)
+
+    if flat:
+        corpus_ids = FlatIds.from_lengths(data, lengths)
+
+    return corpus_ids, stats
+
+
 def tokenize(
     texts,
     lower: bool = True,
@@ -62,56 +547,149 @@ def tokenize(
     return_ids: bool = False,
     leave: bool = False,
     verbose: bool = False,
+    n_jobs: int = 1,
+    chunk_size: int = 10_000,
+    batched: bool = False,
+    flat: bool = False,
+    stem_cache: StemCache = None,
+    vocab: Dict[str, int] = None,
+    drop_oov: bool = True,
+    timer=None,
+    timer_prefix: str = "Tokenize",
 ):
+    """
+    Tokenize a list of texts. If `n_jobs` is not 1, the texts are split into chunks of
+    `chunk_size` and the string splitting is done in a process pool (-1 uses all
+    cores); the output is identical to the one of the sequential version.
+
+    If `batched` is True, each chunk of `chunk_size` texts is lowercased and split
+    with a single regex call, and stopwords are removed with a vectorized mask; the
+    output is also identical. It is ignored if `n_jobs` is not 1, or if the
+    `token_pattern` has capturing groups.
+
+    If `flat` is True (requires `return_ids=True`), the ids are returned as a
+    `FlatIds` object instead of a list of lists. If a `StemCache` is given, words
+    already in it are not stemmed again, and new stems are added to it.
+
+    If a `vocab` (e.g. the one of a tokenized corpus) is given, it is used as is
+    instead of building a new one (requires `return_ids=True`): each token is looked
+    up in it as it is split, and out-of-vocabulary tokens are dropped (or given the id
+    -1 if `drop_oov` is False). This is meant for tokenizing queries; `n_jobs` and
+    `batched` are ignored.
+
+    If a `utils.benchmark.Timer` is given, the time of each phase is recorded under
+    `f"{timer_prefix}/<phase>"`: split (lowercasing and regex), stopwords, vocab (id
+    assignment), stem and reconstruct (ids back to strings), along with the number
+    of tokens split (`n_tokens`), dropped as stopwords (`n_stopwords`) and words
+    passed to the stemmer (`n_stemmed`, without the ones found in `stem_cache`).
+    """
     from tqdm.auto import tqdm
     if isinstance(texts, str):
         texts = [texts]
+
+    if flat and not return_ids:
+        raise ValueError("`flat=True` is only supported with `return_ids=True`.")
+
+    if vocab is not None and not return_ids:
+        raise ValueError("`vocab` is only supported with `return_ids=True`.")
     
-    token_pattern = re.compile(token_pattern)
     stopwords = _infer_stopwords(stopwords)
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
 
-    # Step 1: Split the strings using the regex pattern
-    split_fn = token_pattern.findall
+    tqdm = partial(tqdm, disable=not verbose, leave=leave)
 
-    corpus_ids = []
-    token_to_index = {}
+    # Step 1: Split the strings using the regex pattern
+    instrument = timer is not None
+    if vocab is not None:
+        corpus_ids, split_stats = _split_frozen(
+            tqdm(texts, desc="Split strings"),
+            lower=lower,
+            token_pattern=token_pattern,
+            stopwords=stopwords,
+            vocab=vocab,
+            stemmer=stemmer,
+            stem_cache=stem_cache,
+            drop_oov=drop_oov,
+            flat=flat,
+            instrument=instrument,
+        )
+        if instrument:
+            timer.add(f"{timer_prefix}/split", split_stats["split_time"], n_tokens=split_stats["n_tokens"])
+            timer.add(
+                f"{timer_prefix}/stopwords",
+                split_stats["stopwords_time"],
+                n_stopwords=split_stats["n_stopwords"],
+            )
+            if stemmer is not None:
+                timer.add(f"{timer_prefix}/stem", split_stats["stem_time"], n_stemmed=split_stats["n_stemmed"])
+            timer.add(f"{timer_prefix}/vocab", split_stats["vocab_time"])
 
-    tqdm = partial(tqdm, disable=not verbose)
-    for text in tqdm(texts, desc="Split strings", leave=leave):
-        stopwords_set = set(stopwords)
-        if lower:
-            text = text.lower()
-        
-        splitted = split_fn(text)
-        doc_ids = []
+        return Tokenized(ids=corpus_ids, vocab=vocab)
 
-        for token in splitted:
-            if token in stopwords_set:
-                continue
+    if n_jobs is not None and n_jobs > 1:
+        corpus_ids, token_to_index, split_stats = _split_parallel(
+            texts,
+            lower=lower,
+            token_pattern=token_pattern,
+            stopwords=stopwords,
+            n_jobs=n_jobs,
+            chunk_size=chunk_size,
+            tqdm=tqdm,
+            instrument=instrument,
+            flat=flat,
+        )
+    elif batched and re.compile(token_pattern).groups == 0:
+        corpus_ids, token_to_index, split_stats = _split_batched(
+            texts,
+            lower=lower,
+            token_pattern=token_pattern,
+            stopwords=stopwords,
+            chunk_size=chunk_size,
+            tqdm=tqdm,
+            instrument=instrument,
+        )
+    else:
+        corpus_ids, token_to_index, split_stats = _split_shard(
+            tqdm(texts, desc="Split strings"),
+            lower=lower,
+            token_pattern=token_pattern,
+            stopwords=stopwords,
+            instrument=instrument,
+            flat=flat,
+        )
 
-            if token not in token_to_index:
-                token_to_index[token] = len(token_to_index)
-            
-            token_id = token_to_index[token]
-            doc_ids.append(token_id)
-        
-        corpus_ids.append(doc_ids)
+    if instrument:
+        timer.add(
+            f"{timer_prefix}/split",
+            split_stats["split_time"],
+            n_tokens=split_stats["n_tokens"],
+        )
+        timer.add(
+            f"{timer_prefix}/stopwords",
+            split_stats["stopwords_time"],
+            n_stopwords=split_stats["n_stopwords"],
+        )
+        timer.add(f"{timer_prefix}/vocab", split_stats["vocab_time"])
 
     # Create a list of unique tokens that we will use to create the vocabulary
     unique_tokens = list(token_to_index.keys())
 
     # Step 2: Stem the tokens if a stemmer is provided
     if stemmer is not None:
-        if hasattr(stemmer, "stemWords"):
-            stemmer_fn = stemmer.stemWords
-        elif callable(stemmer):
-            stemmer_fn = stemmer
-        else:
-            error_msg = "Stemmer must have a `stemWord` method, or be callable. For example, you can use the PyStemmer library."
-            raise ValueError(error_msg)
+        stemmer_fn = _get_stemmer_fn(stemmer)
+        if instrument:
+            t = timer.start(f"{timer_prefix}/stem")
 
         # Now, we use the stemmer on the token_to_index dictionary to get the stemmed tokens
-        tokens_stemmed = stemmer_fn(unique_tokens)
+        if stem_cache is not None:
+            n_computed = stem_cache.n_computed
+            tokens_stemmed = stem_cache.stem_words(unique_tokens, stemmer_fn)
+            # only the words missing from the cache were passed to the stemmer
+            n_stemmed = stem_cache.n_computed - n_computed
+        else:
+            tokens_stemmed = stemmer_fn(unique_tokens)
+            n_stemmed = len(unique_tokens)
         vocab = set(tokens_stemmed)
         vocab_dict = {token: i for i, token in enumerate(vocab)}
         stem_id_to_stem = {v: k for k, v in vocab_dict.items()}
@@ -122,22 +700,83 @@ def tokenize(
         }
 
         # Now, we simply need to replace the tokens in the corpus with the stemmed tokens
-        for i, doc_ids in enumerate(tqdm(corpus_ids, desc="Stem Tokens", leave=leave)):
-            corpus_ids[i] = [doc_id_to_stem_id[doc_id] for doc_id in doc_ids]
+        # (with `flat`, the split already returned a `FlatIds`)
+        if isinstance(corpus_ids, FlatIds):
+            stem_ids = np.array(
+                [doc_id_to_stem_id[i] for i in range(len(unique_tokens))],
+                dtype=np.int32,
+            )
+            corpus_ids.data = stem_ids[corpus_ids.data]
+        else:
+            for i, doc_ids in enumerate(tqdm(corpus_ids, desc="Stem Tokens")):
+                corpus_ids[i] = [doc_id_to_stem_id[doc_id] for doc_id in doc_ids]
+
+        if instrument:
+            timer.stop(t)
+            timer.results[t]["n_stemmed"] = n_stemmed
     else:
         vocab_dict = token_to_index
     
     # Step 3: Return the tokenized IDs and the vocab dictionary or the tokenized strings
     if return_ids:
+        if not flat and isinstance(corpus_ids, FlatIds):
+            corpus_ids = corpus_ids.to_lists()
         return Tokenized(ids=corpus_ids, vocab=vocab_dict)
 
     else:
+        if instrument:
+            t = timer.start(f"{timer_prefix}/reconstruct")
         # We need a reverse dictionary to convert the token IDs back to tokens
         reverse_dict = stem_id_to_stem if stemmer is not None else unique_tokens
+        if isinstance(corpus_ids, FlatIds):
+            corpus_ids = decode(Tokenized(ids=corpus_ids, vocab=vocab_dict))
+            if instrument:
+                timer.stop(t)
+            return corpus_ids
+
         # We convert the token IDs back to tokens in-place
         for i, token_ids in enumerate(
-            tqdm(corpus_ids, desc="Reconstructing token strings", leave=leave)
+            tqdm(corpus_ids, desc="Reconstructing token strings")
         ):
             corpus_ids[i] = [reverse_dict[token_id] for token_id in token_ids]
 
+        if instrument:
+            timer.stop(t)
+
         return corpus_ids
+
+
+def tokenize_stream(records, **kwargs):
+    """
+    Tokenize an iterable of `(doc_id, text)` pairs, e.g. `utils.beir.iter_corpus`,
+    without materializing the texts. Returns the list of doc ids (in corpus order)
+    and the output of `tokenize(texts, **kwargs)`.
+    """
+    doc_ids = []
+
+    def texts():
+        for doc_id, text in records:
+            doc_ids.append(doc_id)
+            yield text
+
+    tokenized = tokenize(texts(), **kwargs)
+
+    return doc_ids, tokenized
+
+
+def decode(tokenized: Tokenized) -> List[List[str]]:
+    """
+    Convert the ids of a `Tokenized` object (as lists or `FlatIds`) back to lists of
+    token strings, e.g. for engines like rank-bm25 that only accept strings.
+    """
+    reverse_vocab = [None] * len(tokenized.vocab)
+    for token, token_id in tokenized.vocab.items():
+        reverse_vocab[token_id] = token
+
+    ids = tokenized.ids
+    if isinstance(ids, FlatIds):
+        tokens = np.array(reverse_vocab, dtype=object)[ids.data].tolist()
+        offsets = ids.offsets.tolist()
+        return [tokens[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    return [[reverse_vocab[i] for i in doc_ids] for doc_ids in ids]
@@ -1,6 +1,16 @@
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import mmap
 import os
 from pathlib import Path
+import re
+import shutil
 import time
+import zipfile
+
+import numpy as np
 from tqdm.auto import tqdm
 
 BASE_URL = "https://public.ukp.informatik.tu-darmstadt.de/thakur/BEIR/datasets/{}.zip"
@@ -35,78 +45,541 @@ def postprocess_results_for_eval(results, scores, query_ids):
     return result_dict_for_eval
 
 
-def merge_cqa_dupstack(data_path, verbose=False):
+def _import_json():
     try:
         import ujson
     except ImportError:
         import json as ujson
-    
+
+    return ujson
+
+
+def iter_corpus(data_path, sep=" "):
+    """
+    Read `corpus.jsonl` line by line and yield `(doc_id, title + sep + text)`, without
+    ever holding the whole corpus in memory. The texts are built the same way as in
+    the benchmark scripts, so the tokenized output does not change.
+    """
+    ujson = _import_json()
+
+    with open(Path(data_path) / "corpus.jsonl", "r") as f:
+        for line in f:
+            doc = ujson.loads(line)
+            yield doc["_id"], (doc.get("title") or "") + sep + (doc.get("text") or "")
+
+
+def load_qrels(data_path, split="test"):
+    """
+    Load the qrels of a BEIR dataset as `{query_id: {doc_id: score}}`, like
+    `GenericDataLoader`.
+    """
+    qrels = {}
+    with open(Path(data_path) / "qrels" / f"{split}.tsv", "r") as f:
+        # skip the header: query-id, corpus-id, score
+        next(f)
+        for line in f:
+            qid, cid, score = line.rstrip("\n").split("\t")
+            qrels.setdefault(qid, {})[cid] = int(score)
+
+    return qrels
+
+
+def load_queries_and_qrels(data_path, split="test"):
+    """
+    Load the queries and qrels of a BEIR dataset, without loading the corpus. The
+    output is the same as the last two elements of `GenericDataLoader.load(split)`,
+    i.e. only the queries that have qrels are kept, in the order of the qrels file.
+    """
+    ujson = _import_json()
+    data_path = Path(data_path)
+    qrels = load_qrels(data_path, split=split)
+
+    all_queries = {}
+    with open(data_path / "queries.jsonl", "r") as f:
+        for line in f:
+            query = ujson.loads(line)
+            all_queries[query["_id"]] = query["text"]
+
+    queries = {qid: all_queries[qid] for qid in qrels}
+
+    return queries, qrels
+
+
+COLUMNS = ("ids", "titles", "texts")
+
+
+def _source_stat(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def columnar_corpus_dir(data_path) -> Path:
+    return Path(data_path) / "columnar"
+
+
+def is_columnar_corpus_stale(data_path):
+    """
+    Return True if the columnar copy of `corpus.jsonl` is missing, or was built from a
+    corpus.jsonl with a different size or modification time.
+    """
+    meta_path = columnar_corpus_dir(data_path) / "meta.json"
+    if not meta_path.exists():
+        return True
+
+    with open(meta_path, "r") as f:
+        meta = json.load(f)
+
+    return meta["source"] != _source_stat(Path(data_path) / "corpus.jsonl")
+
+
+def convert_corpus_to_columnar(data_path, verbose=False):
+    """
+    Convert `corpus.jsonl` to a columnar layout under `<data_path>/columnar/`: for each
+    of the ids, titles and texts, a `<column>.bin` file with the UTF-8 encoded values
+    concatenated, and a `<column>_offsets.npy` int64 array of length num_docs + 1, such
+    that the i-th value is `<column>.bin[offsets[i]:offsets[i+1]]`. The corpus is read
+    line by line and the files are written to a temporary directory that is renamed at
+    the end, so a killed conversion never leaves a partial copy behind.
+    """
+    ujson = _import_json()
+    data_path = Path(data_path)
+    corpus_path = data_path / "corpus.jsonl"
+    out_dir = columnar_corpus_dir(data_path)
+    source = _source_stat(corpus_path)
+
+    tmp_dir = out_dir.with_name(f"{out_dir.name}.tmp-{os.getpid()}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    files = {col: open(tmp_dir / f"{col}.bin", "wb") for col in COLUMNS}
+    offsets = {col: array("q", [0]) for col in COLUMNS}
+    try:
+        with open(corpus_path, "rb") as f:
+            for line in tqdm(f, desc="Converting corpus to columnar", disable=not verbose):
+                doc = ujson.loads(line)
+                values = (doc["_id"], doc.get("title") or "", doc.get("text") or "")
+                for col, value in zip(COLUMNS, values):
+                    value = value.encode("utf-8")
+                    files[col].write(value)
+                    offsets[col].append(offsets[col][-1] + len(value))
+    finally:
+        for file in files.values():
+            file.close()
+
+    for col in COLUMNS:
+        np.save(tmp_dir / f"{col}_offsets.npy", np.frombuffer(offsets[col], dtype=np.int64))
+
+    with open(tmp_dir / "meta.json", "w") as f:
+        json.dump({"num_docs": len(offsets["ids"]) - 1, "source": source}, f, indent=2)
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.rename(tmp_dir, out_dir)
+
+    return out_dir
+
+
+class ColumnarCorpus:
+    """
+    Read-only view of a corpus converted with `convert_corpus_to_columnar`. The value
+    buffers are memory-mapped and the offsets are loaded with `mmap_mode="r"`, so
+    opening the corpus does not read it; pages are only loaded when documents are
+    accessed. `view` returns zero-copy memoryviews of the UTF-8 bytes, and the other
+    accessors decode them to strings.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / "meta.json", "r") as f:
+            self.meta = json.load(f)
+
+        self._buffers = {}
+        self._offsets = {}
+        for col in COLUMNS:
+            with open(self.path / f"{col}.bin", "rb") as f:
+                # mmap cannot map an empty file, e.g. a corpus without titles
+                if os.fstat(f.fileno()).st_size == 0:
+                    buffer = b""
+                else:
+                    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._buffers[col] = memoryview(buffer)
+            self._offsets[col] = np.load(self.path / f"{col}_offsets.npy", mmap_mode="r")
+
+    def __len__(self):
+        return self.meta["num_docs"]
+
+    def view(self, i, column="texts") -> memoryview:
+        offsets = self._offsets[column]
+        return self._buffers[column][int(offsets[i]) : int(offsets[i + 1])]
+
+    def get(self, i, column="texts") -> str:
+        return str(self.view(i, column), "utf-8")
+
+    def __getitem__(self, i):
+        return {"title": self.get(i, "titles"), "text": self.get(i, "texts")}
+
+    def _iter_column(self, column, chunk_size=100_000):
+        buffer = self._buffers[column]
+        offsets = self._offsets[column]
+        for start in range(0, len(self), chunk_size):
+            chunk_offsets = offsets[start : start + chunk_size + 1].tolist()
+            for begin, end in zip(chunk_offsets[:-1], chunk_offsets[1:]):
+                yield str(buffer[begin:end], "utf-8")
+
+    def doc_ids(self):
+        return list(self._iter_column("ids"))
+
+    def iter_texts(self, sep=" "):
+        """
+        Yield `title + sep + text` for each document, like `iter_corpus`.
+        """
+        for title, text in zip(self._iter_column("titles"), self._iter_column("texts")):
+            yield title + sep + text
+
+    def iter_records(self, sep=" "):
+        """
+        Yield `(doc_id, title + sep + text)` for each document, like `iter_corpus`.
+        """
+        return zip(self._iter_column("ids"), self.iter_texts(sep=sep))
+
+
+def load_columnar_corpus(data_path, verbose=False):
+    """
+    Open the columnar copy of the corpus of a BEIR dataset, converting `corpus.jsonl`
+    first if the copy is missing or stale.
+    """
+    if is_columnar_corpus_stale(data_path):
+        convert_corpus_to_columnar(data_path, verbose=verbose)
+
+    return ColumnarCorpus(columnar_corpus_dir(data_path))
+
+
+# the "_id" key of a json line, up to the opening quote of its value. A quote inside a
+# json string is always escaped, so this cannot match the content of another field.
+_ID_KEY_PATTERN = re.compile(rb'"_id"\s*:\s*"')
+
+# merged file -> glob of the sub-forum files it is built from
+CQA_MERGED_FILES = {
+    "corpus.jsonl": "*/corpus.jsonl",
+    "queries.jsonl": "*/queries.jsonl",
+    "qrels/test.tsv": "*/qrels/test.tsv",
+}
+CQA_MANIFEST = "merge_manifest.json"
+
+
+def _prefix_jsonl_ids(src, dst, name):
+    """
+    Copy the jsonl file `src` to `dst`, prefixing the `_id` of every line with
+    `<name>_`. The id is rewritten in the raw bytes of the line; only lines where the
+    `_id` value is not a plain string go through a json round-trip.
+    """
+    prefix = name.encode("utf-8") + b"_"
+    ujson = None
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        for line in fin:
+            if not line.strip():
+                continue
+
+            match = _ID_KEY_PATTERN.search(line)
+            if match is not None:
+                line = line[: match.end()] + prefix + line[match.end() :]
+            else:
+                ujson = ujson or _import_json()
+                doc = ujson.loads(line)
+                doc["_id"] = f"{name}_{doc['_id']}"
+                line = ujson.dumps(doc).encode("utf-8")
+
+            fout.write(line if line.endswith(b"\n") else line + b"\n")
+
+
+def _prefix_qrels_ids(src, dst, name):
+    """
+    Copy the qrels file `src` (without its header) to `dst`, prefixing the query and
+    corpus ids with `<name>_`.
+    """
+    prefix = name.encode("utf-8") + b"_"
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        # skip the header: query-id, corpus-id, score
+        next(fin, None)
+        for line in fin:
+            if not line.strip():
+                continue
+            qid, cid, score = line.strip().split(b"\t")
+            fout.write(prefix + qid + b"\t" + prefix + cid + b"\t" + score + b"\n")
+
+
+def _prefix_ids(merged_name, src, dst, name):
+    if merged_name.endswith(".tsv"):
+        _prefix_qrels_ids(src, dst, name)
+    else:
+        _prefix_jsonl_ids(src, dst, name)
+
+
+def _forum_name(data_path, src):
+    # cqadupstack/<name>/corpus.jsonl or cqadupstack/<name>/qrels/test.tsv
+    return Path(src).relative_to(data_path).parts[0]
+
+
+def _sources_manifest(data_path, sources):
+    return {
+        str(Path(src).relative_to(data_path)): _source_stat(src) for src in sources
+    }
+
+
+def merge_cqa_dupstack(data_path, verbose=False, n_jobs=-1):
+    """
+    Merge the corpus, queries and test qrels of the CQADupStack sub-forums into
+    `corpus.jsonl`, `queries.jsonl` and `qrels/test.tsv` under `data_path`, prefixing
+    all ids with the name of their sub-forum. The sub-forums are rewritten in parallel
+    by `n_jobs` processes (-1 for all cores) and concatenated in sorted order.
+
+    Each merged file is written to a temporary file that is renamed at the end, and
+    its size and modification time, along with those of its sources, are saved in
+    `merge_manifest.json`. A merged file is only rebuilt when it is missing or differs
+    from the manifest, e.g. after a killed run, a new download or an external edit.
+    """
     data_path = Path(data_path)
     dataset = data_path.name
     assert dataset == "cqadupstack", "Dataset must be CQADupStack"
 
-    # check if corpus.jsonl exists
-    corpus_path = data_path / "corpus.jsonl"
-    if not corpus_path.exists():
-        # combine all the corpus files into one
-        # corpus files are located under cqadupstack/<name>/corpus.jsonl
-        corpus_files = list(data_path.glob("*/corpus.jsonl"))
-        with open(corpus_path, "w") as f:
-            for file in tqdm(corpus_files, desc="Merging Corpus", disable=not verbose):
-                # get the name of the corpus
-                corpus_name = file.parent.name
-
-                with open(file, "r") as f2:
-                    for line in tqdm(f2, desc=f"Merging {corpus_name} Corpus", leave=False, disable=not verbose):
-                        # first, read with ujson    
-                        line = ujson.loads(line)
-                        # add the corpus name to _id
-                        line["_id"] = f"{corpus_name}_{line['_id']}"
-                        # write back to file
-                        f.write(ujson.dumps(line))
-                        f.write("\n")
-        
-    # now, do the same for queries.jsonl
-    queries_path = data_path / "queries.jsonl"
-    if not queries_path.exists():
-        queries_files = list(data_path.glob("*/queries.jsonl"))
-        with open(queries_path, "w") as f:
-            for file in tqdm(queries_files, desc="Merging Queries", disable=not verbose):
-                # get the name of the corpus
-                corpus_name = file.parent.name
-                
-                with open(file, "r") as f2:
-                    for line in tqdm(f2, desc=f"Merging {corpus_name} Queries", leave=False, disable=not verbose):
-                        # first, read with ujson    
-                        line = ujson.loads(line)
-                        # add the corpus name to _id
-                        line["_id"] = f"{corpus_name}_{line['_id']}"
-                        # write back to file
-                        f.write(ujson.dumps(line))
-                        f.write("\n")
-    
-    # now, do the same for qrels/test.tsv
-    qrels_path = data_path / "qrels" / "test.tsv"
-    qrels_path.parent.mkdir(parents=True, exist_ok=True)
-
-    if not qrels_path.exists():
-        qrels_files = list(data_path.glob("*/qrels/test.tsv"))
-        with open(qrels_path, "w") as f:
-            # First, write the columns: query-id	corpus-id	score
-            f.write("query-id\tcorpus-id\tscore\n")
-            for file in tqdm(qrels_files, desc="Merging Qrels", disable=not verbose):
-                # get the name of the corpus
-                corpus_name = file.parent.parent.name
-                with open(file, "r") as f2:
-                    # skip first line
-                    next(f2)
-
-                    for line in tqdm(f2, desc=f"Merging {corpus_name} Qrels", leave=False, disable=not verbose):
-                        # since it's a tsv, split by tab
-                        qid, cid, score = line.strip().split("\t")
-                        # add the corpus name to _id
-                        qid = f"{corpus_name}_{qid}"
-                        cid = f"{corpus_name}_{cid}"
-                        # write back to file
-                        f.write(f"{qid}\t{cid}\t{score}\n")
+    manifest_path = data_path / CQA_MANIFEST
+    manifest = {}
+    if manifest_path.exists():
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+
+    stale = {}
+    for merged_name, pattern in CQA_MERGED_FILES.items():
+        # skip the temporary directories of killed runs
+        sources = sorted(
+            src for src in data_path.glob(pattern)
+            if not _forum_name(data_path, src).startswith(".")
+        )
+        sources_manifest = _sources_manifest(data_path, sources)
+        merged_path = data_path / merged_name
+        if not merged_path.exists() or manifest.get(merged_name) != {
+            "sources": sources_manifest,
+            "output": _source_stat(merged_path),
+        }:
+            stale[merged_name] = (sources, sources_manifest)
+
+    if not stale:
+        return
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+
+    tmp_dir = data_path / f".merge-tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    try:
+        # rewrite every sub-forum file to its own part, in parallel
+        parts = {}
+        jobs = []
+        for merged_name, (sources, _) in stale.items():
+            parts[merged_name] = []
+            for i, src in enumerate(sources):
+                dst = tmp_dir / f"{merged_name.replace('/', '_')}.{i}"
+                parts[merged_name].append(dst)
+                jobs.append((merged_name, src, dst, _forum_name(data_path, src)))
+
+        with ProcessPoolExecutor(max_workers=max(1, min(n_jobs, len(jobs)))) as pool:
+            futures = [pool.submit(_prefix_ids, *job) for job in jobs]
+            for future in tqdm(futures, desc="Merging CQADupStack", disable=not verbose):
+                future.result()
+
+        # concatenate the parts in order, then atomically replace the merged files
+        for merged_name, (_, sources_manifest) in stale.items():
+            merged_path = data_path / merged_name
+            merged_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = tmp_dir / f"{merged_path.name}.tmp"
+
+            with open(tmp_path, "wb") as f:
+                if merged_name.endswith(".tsv"):
+                    f.write(b"query-id\tcorpus-id\tscore\n")
+                for part in parts[merged_name]:
+                    with open(part, "rb") as f2:
+                        shutil.copyfileobj(f2, f)
+
+            os.replace(tmp_path, merged_path)
+            manifest[merged_name] = {
+                "sources": sources_manifest,
+                "output": _source_stat(merged_path),
+            }
+
+        tmp_manifest_path = tmp_dir / CQA_MANIFEST
+        with open(tmp_manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_manifest_path, manifest_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+MIRROR_MANIFEST = "checksums.json"
+REGISTRY_MARKER = "registry.json"
+
+
+def _sha256(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def default_split(dataset):
+    return "dev" if dataset == "msmarco" else "test"
+
+
+class DatasetRegistry:
+    """
+    Resolve BEIR dataset names to unpacked folders under `save_dir`, without going
+    through `beir.util.download_and_unzip` on every run.
+
+    A dataset is ready when `<save_dir>/<dataset>/registry.json` exists and the files
+    it lists still have the recorded sizes; `resolve` then returns the folder without
+    any network access or zip probing. Otherwise, the zip is taken from `mirror_dir`
+    (e.g. a copy of an internal mirror), checked against the sha256 in
+    `<mirror_dir>/checksums.json` and unpacked once. Without a `mirror_dir`, the zip is
+    downloaded from `BASE_URL` as before. A dataset missing from the mirror, or whose
+    checksum does not match, raises an error immediately.
+    """
+
+    def __init__(self, save_dir="datasets", mirror_dir=None):
+        self.save_dir = Path(save_dir)
+        self.mirror_dir = Path(mirror_dir) if mirror_dir is not None else None
+
+    def dataset_dir(self, dataset) -> Path:
+        return self.save_dir / dataset
+
+    def is_ready(self, dataset):
+        marker_path = self.dataset_dir(dataset) / REGISTRY_MARKER
+        if not marker_path.exists():
+            return False
+
+        with open(marker_path, "r") as f:
+            marker = json.load(f)
+
+        for name, size in marker["files"].items():
+            path = self.dataset_dir(dataset) / name
+            if not path.exists() or path.stat().st_size != size:
+                return False
+        return True
+
+    def resolve(self, dataset) -> str:
+        """
+        Return the path of the unpacked dataset (as a string, like
+        `download_and_unzip`), unpacking or downloading it first if it is not ready.
+        """
+        if not self.is_ready(dataset):
+            if self.mirror_dir is not None:
+                self._unpack_from_mirror(dataset)
+            else:
+                self._download(dataset)
+
+        return str(self.dataset_dir(dataset))
+
+    def register(self, dataset):
+        """
+        Mark a dataset written directly to `<save_dir>/<dataset>` (e.g. by
+        `utils.synthetic.generate_dataset`) as ready, so `resolve` never tries to
+        download it.
+        """
+        self._write_marker(dataset, None)
+
+    def load_checksums(self):
+        manifest_path = self.mirror_dir / MIRROR_MANIFEST
+        if not manifest_path.exists():
+            raise FileNotFoundError(
+                f"No checksum manifest at {manifest_path}, create it with DatasetRegistry.write_checksums()"
+            )
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+
+    def write_checksums(self):
+        """
+        Compute the sha256 of every zip in `mirror_dir` and save them to
+        `<mirror_dir>/checksums.json`. Run it once where the mirror is prepared.
+        """
+        checksums = {
+            path.stem: {"sha256": _sha256(path), "size": path.stat().st_size}
+            for path in sorted(self.mirror_dir.glob("*.zip"))
+        }
+        with open(self.mirror_dir / MIRROR_MANIFEST, "w") as f:
+            json.dump(checksums, f, indent=2)
+        return checksums
+
+    def _unpack_from_mirror(self, dataset):
+        zip_path = self.mirror_dir / f"{dataset}.zip"
+        checksums = self.load_checksums()
+        if dataset not in checksums:
+            raise KeyError(f"Dataset {dataset} is not in {self.mirror_dir / MIRROR_MANIFEST}")
+        if not zip_path.exists():
+            raise FileNotFoundError(f"Dataset {dataset} is not in the mirror: {zip_path} does not exist")
+
+        sha256 = _sha256(zip_path)
+        if sha256 != checksums[dataset]["sha256"]:
+            raise ValueError(
+                f"Checksum mismatch for {zip_path}: expected {checksums[dataset]['sha256']}, got {sha256}"
+            )
+
+        self._unpack(dataset, zip_path, sha256)
+
+    def _download(self, dataset):
+        import beir.util
+
+        self.save_dir.mkdir(parents=True, exist_ok=True)
+        beir.util.download_and_unzip(BASE_URL.format(dataset), str(self.save_dir))
+        zip_path = self.save_dir / f"{dataset}.zip"
+        self._write_marker(dataset, _sha256(zip_path) if zip_path.exists() else None)
+
+    def _unpack(self, dataset, zip_path, sha256):
+        # the zips contain a single <dataset>/ folder, which is extracted to a temporary
+        # directory and moved in place, so a killed run never leaves a partial folder
+        tmp_dir = self.save_dir / f".{dataset}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+        try:
+            with zipfile.ZipFile(zip_path) as zf:
+                zf.extractall(tmp_dir)
+
+            out_dir = self.dataset_dir(dataset)
+            shutil.rmtree(out_dir, ignore_errors=True)
+            os.rename(tmp_dir / dataset, out_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self._write_marker(dataset, sha256)
+
+    def _write_marker(self, dataset, sha256):
+        out_dir = self.dataset_dir(dataset)
+        files = {
+            str(path.relative_to(out_dir)): path.stat().st_size
+            for pattern in ("corpus.jsonl", "queries.jsonl", "qrels/*.tsv", "*/corpus.jsonl", "*/queries.jsonl", "*/qrels/*.tsv")
+            for path in sorted(out_dir.glob(pattern))
+            # merged or derived files are not part of the archive
+            if not (dataset == "cqadupstack" and path.parent in (out_dir, out_dir / "qrels"))
+        }
+        if not files:
+            raise FileNotFoundError(f"{out_dir} does not contain a BEIR dataset")
+
+        with open(out_dir / REGISTRY_MARKER, "w") as f:
+            json.dump({"dataset": dataset, "sha256": sha256, "files": files}, f, indent=2)
+
+    # fast loaders
+
+    def iter_corpus(self, dataset, sep=" "):
+        return iter_corpus(self.resolve(dataset), sep=sep)
+
+    def load_columnar_corpus(self, dataset, verbose=False):
+        return load_columnar_corpus(self.resolve(dataset), verbose=verbose)
+
+    def load_queries_and_qrels(self, dataset, split=None):
+        split = split or default_split(dataset)
+        return load_queries_and_qrels(self.resolve(dataset), split=split)
+
+    def load_qrels_compiled(self, dataset, split=None, corpus_ids=None):
+        from .evaluation import load_qrels_compiled
 
+        split = split or default_split(dataset)
+        return load_qrels_compiled(self.resolve(dataset), split=split, corpus_ids=corpus_ids)
@@ -1,5 +1,12 @@
+from contextlib import contextmanager
 from copy import deepcopy
+import itertools
+import math
+import threading
 import time
+import tracemalloc as _tracemalloc
+
+import numpy as np
 
 
 try:
@@ -49,6 +56,24 @@ class Timer:
         
         return self.results[name]["elapsed"]
     
+    def add(self, name, elapsed, **extra):
+        """
+        Record a timing that was measured outside of the timer, e.g. accumulated over
+        the iterations of a loop. Extra keyword arguments (such as counts) are saved
+        alongside the elapsed time.
+        """
+        if name in self.results:
+            raise ValueError(f"Timer with name {name} already started.")
+
+        stop_time = time.time()
+        self.results[name] = {
+            "start": stop_time - elapsed,
+            "elapsed": elapsed,
+            "stopped": stop_time,
+            **extra,
+        }
+        return name
+
     def pause(self, name):
         # if self.has_stopped(name):
         #     raise ValueError(f"Timer with name {name} already stopped.")
@@ -119,4 +144,448 @@ class Timer:
         if lowercase:
             results_to_save = {k.lower(): v for k, v in results_to_save.items()}
         
-        return results_to_save
\ No newline at end of file
+        return results_to_save
+
+
+def read_memory_kb(pss=True):
+    """
+    Read the current memory of the process from /proc (linux only), in kB: the
+    resident set size `rss` and its peak `hwm` from /proc/self/status, and the
+    proportional set size `pss` from /proc/self/smaps_rollup, which counts the pages
+    shared with other processes (e.g. a memory-mapped index) only partially. Missing
+    fields are left out.
+    """
+    memory = {}
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    memory["rss"] = int(line.split()[1])
+                elif line.startswith("VmHWM:"):
+                    memory["hwm"] = int(line.split()[1])
+    except OSError:
+        pass
+
+    if pss:
+        try:
+            with open("/proc/self/smaps_rollup", "r") as f:
+                for line in f:
+                    if line.startswith("Pss:"):
+                        memory["pss"] = int(line.split()[1])
+                        break
+        except OSError:
+            pass
+
+    return memory
+
+
+class MemorySampler:
+    """
+    Background thread that samples the memory of the process every `interval`
+    seconds (RSS and PSS with `read_memory_kb`, and the memory allocated by python
+    with `tracemalloc` if `tracemalloc=True`, which slows down allocations).
+
+    Unlike `get_max_memory_usage`, which only ever goes up, it tracks the peak of
+    each window between `begin()` and `end(window)`, so every phase gets its own peak
+    and delta. A `SpanTimer(memory=sampler)` opens a window per span and saves it
+    under "memory" in its results. Use it as a context manager, or with `start()`
+    and `stop()`.
+    """
+
+    def __init__(self, interval=0.01, pss=True, tracemalloc=False):
+        self.interval = interval
+        self.pss = pss
+        self.tracemalloc = tracemalloc
+        self._windows = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.tracemalloc and not _tracemalloc.is_tracing():
+            _tracemalloc.start()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="memory-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.tracemalloc and _tracemalloc.is_tracing():
+            _tracemalloc.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """
+        Take a sample now and update the peak of every open window. Returns the sample
+        (in kB, with the python allocations under "traced").
+        """
+        memory = read_memory_kb(pss=self.pss)
+        memory.pop("hwm", None)
+        if self.tracemalloc and _tracemalloc.is_tracing():
+            memory["traced"] = _tracemalloc.get_traced_memory()[0] // 1024
+
+        with self._lock:
+            for window in self._windows.values():
+                peak = window["peak"]
+                for key, value in memory.items():
+                    peak[key] = max(peak.get(key, value), value)
+        return memory
+
+    def begin(self):
+        """
+        Open a window and return its id, to be passed to `end`.
+        """
+        memory = self.sample()
+        window_id = next(self._ids)
+        with self._lock:
+            self._windows[window_id] = {"start": memory, "peak": dict(memory)}
+        return window_id
+
+    def end(self, window_id):
+        """
+        Close a window and return, in GB, the memory at its end (e.g. "rss_gb"), its
+        peak ("peak_rss_gb"), and the change from its start to its end ("delta_rss_gb")
+        and to its peak ("peak_delta_rss_gb"), for each measure that was available.
+        """
+        end = self.sample()
+        with self._lock:
+            window = self._windows.pop(window_id)
+
+        stats = {}
+        for key, value in end.items():
+            start = window["start"].get(key, value)
+            peak = window["peak"].get(key, value)
+            stats[f"{key}_gb"] = value / 1024**2
+            stats[f"peak_{key}_gb"] = peak / 1024**2
+            stats[f"delta_{key}_gb"] = (value - start) / 1024**2
+            stats[f"peak_delta_{key}_gb"] = (peak - start) / 1024**2
+        return stats
+
+
+def _merge_memory(previous, stats):
+    # repeated spans keep the largest peak and peak increase, and the last end values
+    if previous is None:
+        return stats
+    merged = dict(stats)
+    for key, value in previous.items():
+        if key.startswith("peak_"):
+            merged[key] = max(value, stats.get(key, value))
+    return merged
+
+
+def _clock_ns():
+    return time.perf_counter_ns(), time.process_time_ns(), time.thread_time_ns()
+
+
+class SpanTimer:
+    """
+    Timer with nested, repeatable spans, measured with `perf_counter_ns` (wall time),
+    `process_time_ns` (CPU time of all the threads of the process) and `thread_time_ns`
+    (CPU time of the calling thread). A wall time much larger than the CPU time means
+    the span was waiting, e.g. on another process such as Elasticsearch or the JVM.
+
+    Spans are opened with a context manager and nest, with their names joined by "/":
+
+        with timer.span("Query"):
+            for q in queries:
+                with timer.span("Score"):  # recorded as "Query/Score"
+                    ...
+
+    A span that is entered more than once aggregates its runs (count, total, min and
+    max wall time). `start`/`stop`/`pause`/`resume`/`add` behave like `Timer`, and
+    `to_dict` exports the same format (with "elapsed" the total wall time), so the
+    result files and `analysis/combine_results.py` keep working.
+
+    With a running `MemorySampler` as `memory`, the peak and delta memory of every
+    span (and of every `start`/`stop` pair) are saved under "memory".
+    """
+
+    def __init__(self, prefix="", precision=4, memory: MemorySampler = None):
+        self.results = {}
+        self.prefix = prefix
+        self.precision = precision
+        self.memory = memory
+        self._open = {}
+        self._memory_windows = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _record(self, name, wall_ns, cpu_ns=None, thread_ns=None, memory=None, **extra):
+        elapsed = wall_ns / 1e9
+        with self._lock:
+            now = time.time()
+            r = self.results.get(name)
+            if r is None:
+                r = self.results[name] = {
+                    "start": now - elapsed,
+                    "elapsed": 0.0,
+                    "cpu": 0.0,
+                    "thread_cpu": 0.0,
+                    "count": 0,
+                    "min": elapsed,
+                    "max": elapsed,
+                }
+            r["elapsed"] += elapsed
+            if cpu_ns is not None:
+                r["cpu"] += cpu_ns / 1e9
+                r["thread_cpu"] += thread_ns / 1e9
+            r["count"] += 1
+            r["min"] = min(r["min"], elapsed)
+            r["max"] = max(r["max"], elapsed)
+            r["stopped"] = now
+            if memory is not None:
+                r["memory"] = _merge_memory(r.get("memory"), memory)
+            r.update(extra)
+        return r
+
+    @contextmanager
+    def span(self, name, show=False, n_total=None, memory=True):
+        """
+        Time the body of the `with` block as `name`, nested under the spans that are
+        open in the current thread. Yields the full name of the span. Pass
+        `memory=False` for very short spans (e.g. one per query), where reading the
+        memory would cost more than the span itself; it is read outside the timed part.
+        """
+        stack = self._stack()
+        full_name = "/".join(stack + [name])
+        stack.append(name)
+        window = self.memory.begin() if self.memory is not None and memory else None
+        wall, cpu, thread = _clock_ns()
+        try:
+            yield full_name
+        finally:
+            wall2, cpu2, thread2 = _clock_ns()
+            stack.pop()
+            memory = self.memory.end(window) if window is not None else None
+            self._record(full_name, wall2 - wall, cpu2 - cpu, thread2 - thread, memory=memory)
+            if show:
+                self.show(full_name, n_total=n_total)
+
+    def start(self, name):
+        if name in self._open:
+            raise ValueError(f"Timer with name {name} already started.")
+        if self.memory is not None:
+            self._memory_windows[name] = self.memory.begin()
+        # [wall, cpu, thread] accumulated while running, and the clocks of the last resume
+        self._open[name] = [[0, 0, 0], _clock_ns()]
+        return name
+
+    def pause(self, name):
+        totals, last = self._open[name]
+        if last is not None:
+            for i, (now, then) in enumerate(zip(_clock_ns(), last)):
+                totals[i] += now - then
+            self._open[name][1] = None
+
+    def resume(self, name):
+        self._open[name][1] = _clock_ns()
+
+    def stop(self, name, show=False, n_total=None):
+        if name not in self._open:
+            raise ValueError(f"Timer with name {name} not started.")
+
+        self.pause(name)
+        totals, _ = self._open.pop(name)
+        memory = None
+        if name in self._memory_windows:
+            memory = self.memory.end(self._memory_windows.pop(name))
+        self._record(name, *totals, memory=memory)
+
+        if show:
+            self.show(name, n_total=n_total)
+
+        return self.results[name]["elapsed"]
+
+    def add(self, name, elapsed, **extra):
+        """
+        Record a timing that was measured outside of the timer (as a run of the span
+        `name`). Extra keyword arguments (such as counts) are saved alongside it.
+        """
+        self._record(name, int(elapsed * 1e9), **extra)
+        return name
+
+    def has_started(self, name):
+        return name in self.results or name in self._open
+
+    def has_stopped(self, name):
+        return name in self.results and name not in self._open
+
+    def elapsed(self, name, precision=None):
+        if precision is None:
+            precision = self.precision
+
+        if not self.has_stopped(name):
+            raise ValueError(f"Timer with name {name} not stopped.")
+
+        return round(self.results[name]["elapsed"], precision)
+
+    def show(self, name, offset=0, n_total=None):
+        r = self.results[name]
+        t = self.elapsed(name) + offset
+        s = f"{self.prefix} {name}: {t:.4f}s"
+        if n_total is not None and t > 0:
+            s += f" ({n_total / t:.2f}/s)"
+        if r["count"] > 1:
+            s += f" [{r['count']} runs, min {r['min']:.6f}s, max {r['max']:.6f}s]"
+        s += f" [cpu {r['cpu']:.4f}s]"
+        if "peak_rss_gb" in r.get("memory", {}):
+            mem = r["memory"]
+            s += f" [peak rss {mem['peak_rss_gb']:.4f} GB, +{mem['peak_delta_rss_gb']:.4f} GB]"
+        print(s)
+
+    def show_all(self):
+        for name in self.results:
+            if self.has_stopped(name):
+                self.show(name)
+
+    def to_dict(self, underscore=False, lowercase=False):
+        results_to_save = deepcopy(self.results)
+        if underscore:
+            results_to_save = {k.replace(" ", "_"): v for k, v in results_to_save.items()}
+
+        if lowercase:
+            results_to_save = {k.lower(): v for k, v in results_to_save.items()}
+
+        return results_to_save
+
+
+PERCENTILES = (50, 90, 95, 99, 99.9)
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of latencies: the values are counted in logarithmic buckets
+    whose width is `precision` of their value (1% by default), from `min_seconds` to
+    `max_seconds`, so millions of queries take a few kB and any percentile is known
+    within `precision`. The exact minimum, maximum and mean are kept as well.
+    Histograms of several clients or runs can be merged with `merge`.
+    """
+
+    def __init__(self, precision=0.01, min_seconds=1e-6, max_seconds=3600.0):
+        self.precision = precision
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self._log_ratio = math.log1p(precision)
+        num_buckets = int(math.log(max_seconds / min_seconds) / self._log_ratio) + 2
+        self.counts = np.zeros(num_buckets, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def _bucket(self, seconds):
+        if seconds <= self.min_seconds:
+            return 0
+        index = int(math.log(seconds / self.min_seconds) / self._log_ratio) + 1
+        return min(index, len(self.counts) - 1)
+
+    def bucket_upper(self, index):
+        # upper bound of the bucket, like the values reported by HdrHistogram
+        return self.min_seconds * (1 + self.precision) ** index
+
+    def record(self, seconds):
+        self.counts[self._bucket(seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def record_many(self, seconds):
+        seconds = np.asarray(seconds, dtype=np.float64)
+        if len(seconds) == 0:
+            return
+        ratio = np.maximum(seconds / self.min_seconds, 1.0)
+        indices = np.where(
+            seconds <= self.min_seconds, 0, (np.log(ratio) / self._log_ratio).astype(np.int64) + 1
+        )
+        np.add.at(self.counts, np.minimum(indices, len(self.counts) - 1), 1)
+        self.count += len(seconds)
+        self.total += float(seconds.sum())
+        self.min = min(self.min, float(seconds.min()))
+        self.max = max(self.max, float(seconds.max()))
+
+    def merge(self, other: "LatencyHistogram"):
+        if len(other.counts) != len(self.counts) or other.precision != self.precision:
+            raise ValueError("Only histograms with the same buckets can be merged")
+        self.counts += other.counts
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        rank = max(1, math.ceil(p / 100 * self.count))
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        # the bucket bound can overshoot the largest value recorded
+        return min(self.bucket_upper(index), self.max)
+
+    def to_dict(self, percentiles=PERCENTILES):
+        """
+        Summary in milliseconds (`p50_ms`, `p99_ms`, ...), along with the non-empty
+        buckets as `[upper bound in ms, count]` pairs, so that histograms saved in
+        result files can be merged or re-plotted.
+        """
+        summary = {
+            "count": self.count,
+            "mean_ms": self.mean * 1e3,
+            "min_ms": (self.min if self.count else 0.0) * 1e3,
+            "max_ms": self.max * 1e3,
+        }
+        for p in percentiles:
+            summary[f"p{p:g}_ms"] = self.percentile(p) * 1e3
+        summary["precision"] = self.precision
+        summary["buckets"] = [
+            [self.bucket_upper(i) * 1e3, int(self.counts[i])] for i in np.flatnonzero(self.counts)
+        ]
+        return summary
+
+    def show(self, prefix=""):
+        print(
+            f"{prefix} Latency ({self.count:,} queries): mean {self.mean * 1e3:.3f}ms, "
+            + ", ".join(f"p{p:g} {self.percentile(p) * 1e3:.3f}ms" for p in PERCENTILES)
+            + f", max {self.max * 1e3:.3f}ms"
+        )
+
+
+def measure_latency(search_one, queries, warmup=10, histogram=None):
+    """
+    Issue the queries one at a time with `search_one(query)` and record the latency of
+    each call in a `LatencyHistogram`. The first `warmup` queries are run once before,
+    without being recorded, to exclude the one-time costs (e.g. jit compilation).
+    """
+    histogram = histogram if histogram is not None else LatencyHistogram()
+    for query in queries[:warmup]:
+        search_one(query)
+
+    for query in queries:
+        start = time.perf_counter_ns()
+        search_one(query)
+        histogram.record((time.perf_counter_ns() - start) / 1e9)
+
+    return histogram
@@ -0,0 +1,444 @@
+"""
+Vectorized evaluation of retrieval runs, computing the same metrics as
+`beir.retrieval.evaluation.EvaluateRetrieval.evaluate` (i.e. pytrec_eval's `ndcg_cut`,
+`map_cut`, `recall` and `P`) from the `(n_queries, k)` arrays of document indices and
+scores returned by the engines, without building a dict of dicts of the results.
+
+The trec_eval conventions are followed exactly:
+- documents are ranked by decreasing score, with ties broken by decreasing document
+  id (string comparison)
+- a document is relevant if its relevance is at least 1, and the number of relevant
+  documents of a query (the denominator of recall and MAP) counts all the relevant
+  documents in the qrels, including those missing from the corpus
+- nDCG uses the relevance as gain and `log2(rank + 1)` as discount, and the ideal
+  ranking is built from the positive relevances of the qrels
+- P@k always divides by k, even if fewer documents were retrieved
+- only the queries of the run that have qrels are evaluated, and the metrics are
+  averaged over them and rounded to 5 decimals, as BEIR does
+
+Like BEIR, documents whose id is the query id are removed from the ranking by default
+(`ignore_identical_ids=True`), and the following documents move up by one rank.
+"""
+import json
+import os
+from pathlib import Path
+import shutil
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+from .beir import (
+    _source_stat,
+    is_columnar_corpus_stale,
+    iter_corpus,
+    load_columnar_corpus,
+    load_qrels,
+)
+
+K_VALUES = (1, 10, 100, 1000)
+
+
+class CompiledQrels(NamedTuple):
+    """
+    Qrels as a sparse (queries x documents) matrix in CSR form. The relevance
+    judgments of the query at row `q` are `doc_rows[indptr[q]:indptr[q+1]]` and
+    `relevance[indptr[q]:indptr[q+1]]`. Documents of the corpus are identified by
+    their index in the corpus, and judged documents missing from the corpus by
+    `num_docs + j`, so they count as relevant but can never be retrieved.
+    """
+
+    query_ids: List[str]
+    indptr: np.ndarray  # int64, (n_queries + 1,)
+    doc_rows: np.ndarray  # int64, (nnz,)
+    relevance: np.ndarray  # int32, (nnz,)
+    num_docs: int
+    # index of the document whose id is the query id, or -1 (for ignore_identical_ids)
+    identical_rows: np.ndarray  # int64, (n_queries,)
+    # rank of each document id in string order, to break score ties like trec_eval
+    doc_id_ranks: np.ndarray  # int64, (num_docs,)
+
+    @property
+    def num_queries(self):
+        return len(self.query_ids)
+
+    def query_rows(self, query_ids) -> np.ndarray:
+        """
+        Return the row of each query id, or -1 for queries without qrels.
+        """
+        index = {qid: i for i, qid in enumerate(self.query_ids)}
+        return np.array([index.get(qid, -1) for qid in query_ids], dtype=np.int64)
+
+
+def doc_id_ranks(doc_ids) -> np.ndarray:
+    """
+    Rank of each document id in increasing string order. Numpy compares unicode
+    strings by code point, which is the byte order of their UTF-8 encoding, i.e. the
+    order of `strcmp` in trec_eval.
+    """
+    order = np.argsort(np.array(doc_ids, dtype=str), kind="stable")
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+    return ranks
+
+
+def compile_qrels(qrels: Dict[str, Dict[str, int]], corpus_ids, query_ids=None):
+    """
+    Compile BEIR qrels (`{query_id: {doc_id: relevance}}`) to a `CompiledQrels`, with
+    the documents indexed by their position in `corpus_ids`. The rows follow the order
+    of `query_ids` if given (queries without qrels get empty rows), else the order of
+    the qrels.
+    """
+    doc_index = {doc_id: i for i, doc_id in enumerate(corpus_ids)}
+    num_docs = len(doc_index)
+    if query_ids is None:
+        query_ids = list(qrels.keys())
+    else:
+        query_ids = list(query_ids)
+
+    missing = {}
+    indptr = [0]
+    doc_rows = []
+    relevance = []
+    for qid in query_ids:
+        for doc_id, rel in qrels.get(qid, {}).items():
+            row = doc_index.get(doc_id)
+            if row is None:
+                row = num_docs + missing.setdefault(doc_id, len(missing))
+            doc_rows.append(row)
+            relevance.append(rel)
+        indptr.append(len(doc_rows))
+
+    return CompiledQrels(
+        query_ids=query_ids,
+        indptr=np.array(indptr, dtype=np.int64),
+        doc_rows=np.array(doc_rows, dtype=np.int64),
+        relevance=np.array(relevance, dtype=np.int32),
+        num_docs=num_docs,
+        identical_rows=np.array([doc_index.get(qid, -1) for qid in query_ids], dtype=np.int64),
+        doc_id_ranks=doc_id_ranks(corpus_ids),
+    )
+
+
+_QRELS_ARRAYS = ("indptr", "doc_rows", "relevance", "identical_rows", "doc_id_ranks")
+
+
+def compiled_qrels_dir(data_path, split="test") -> Path:
+    return Path(data_path) / "qrels" / f"{split}.compiled"
+
+
+def save_compiled_qrels(path, compiled: CompiledQrels, sources=None):
+    """
+    Save a `CompiledQrels` to `path`: one `.npy` file per array and a `meta.json` with
+    the query ids, the number of documents and the `sources` (used to detect stale
+    entries). The files are written to a temporary directory that is renamed at the
+    end, so a killed run never leaves a partial entry behind.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+
+    for name in _QRELS_ARRAYS:
+        np.save(tmp_path / f"{name}.npy", getattr(compiled, name))
+    with open(tmp_path / "meta.json", "w") as f:
+        json.dump(
+            {
+                "num_docs": compiled.num_docs,
+                "query_ids": list(compiled.query_ids),
+                "sources": sources or {},
+            },
+            f,
+        )
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+
+def load_compiled_qrels(path, mmap=True) -> CompiledQrels:
+    """
+    Load qrels saved by `save_compiled_qrels`, with the arrays memory-mapped.
+    """
+    path = Path(path)
+    mmap_mode = "r" if mmap else None
+    with open(path / "meta.json", "r") as f:
+        meta = json.load(f)
+
+    arrays = {
+        name: np.load(path / f"{name}.npy", mmap_mode=mmap_mode) for name in _QRELS_ARRAYS
+    }
+    return CompiledQrels(query_ids=meta["query_ids"], num_docs=meta["num_docs"], **arrays)
+
+
+def _qrels_sources(data_path, split):
+    data_path = Path(data_path)
+    return {
+        "qrels": _source_stat(data_path / "qrels" / f"{split}.tsv"),
+        "corpus": _source_stat(data_path / "corpus.jsonl"),
+    }
+
+
+def load_qrels_compiled(data_path, split="test", corpus_ids=None, verbose=False):
+    """
+    Load the qrels of a BEIR dataset compiled against its corpus, from the cache under
+    `<data_path>/qrels/<split>.compiled/`. On a miss (or if `qrels/<split>.tsv` or
+    `corpus.jsonl` changed since the entry was made), the qrels are compiled and saved
+    first: the rows follow the order of the qrels file (which is also the order of the
+    queries returned by `GenericDataLoader`), and the documents are indexed by their
+    position in `corpus.jsonl`. `corpus_ids` can be given to skip reading the ids from
+    the corpus, but must then be in the order of `corpus.jsonl`.
+    """
+    path = compiled_qrels_dir(data_path, split)
+    sources = _qrels_sources(data_path, split)
+
+    if (path / "meta.json").exists():
+        with open(path / "meta.json", "r") as f:
+            if json.load(f)["sources"] == sources:
+                return load_compiled_qrels(path)
+
+    if verbose:
+        print(f"Compiling qrels to {path}")
+
+    if corpus_ids is None:
+        if not is_columnar_corpus_stale(data_path):
+            corpus_ids = load_columnar_corpus(data_path).doc_ids()
+        else:
+            corpus_ids = [doc_id for doc_id, _ in iter_corpus(data_path)]
+
+    compiled = compile_qrels(load_qrels(data_path, split=split), corpus_ids)
+    save_compiled_qrels(path, compiled, sources=sources)
+
+    return load_compiled_qrels(path)
+
+
+def _rank_order(indices, scores, doc_id_ranks):
+    """
+    Sort each row by decreasing score, then decreasing document id.
+    """
+    tie_keys = np.where(indices >= 0, doc_id_ranks[np.maximum(indices, 0)], -1)
+    # lexsort sorts by the last key first, in increasing order
+    return np.lexsort((-tie_keys, -scores.astype(np.float64)), axis=1)
+
+
+def _entry_rows(qrels: CompiledQrels):
+    # row of each qrels entry
+    counts = np.diff(qrels.indptr)
+    return np.repeat(np.arange(qrels.num_queries, dtype=np.int64), counts)
+
+
+def _lookup_relevance(qrels: CompiledQrels, rows, indices):
+    """
+    Relevance of each retrieved document (0 if unjudged), by binary search of the
+    `row * n_cols + doc` keys of the retrieved documents in those of the qrels.
+    """
+    if len(qrels.doc_rows) == 0:
+        return np.zeros(indices.shape, dtype=np.int32)
+
+    n_cols = np.int64(qrels.num_docs + len(qrels.doc_rows))
+    qrel_keys = _entry_rows(qrels) * n_cols + qrels.doc_rows
+    order = np.argsort(qrel_keys, kind="stable")
+    qrel_keys = qrel_keys[order]
+    qrel_rel = qrels.relevance[order]
+
+    keys = rows[:, None] * n_cols + np.maximum(indices, 0)
+    pos = np.minimum(np.searchsorted(qrel_keys, keys), len(qrel_keys) - 1)
+    found = (indices >= 0) & (qrel_keys[pos] == keys)
+    return np.where(found, qrel_rel[pos], 0)
+
+
+def _num_relevant(qrels: CompiledQrels):
+    is_rel = (qrels.relevance >= 1).astype(np.float64)
+    return np.bincount(_entry_rows(qrels), weights=is_rel, minlength=qrels.num_queries)
+
+
+def _ideal_dcg(qrels: CompiledQrels, rows, k_values):
+    """
+    Ideal DCG at each cutoff for the given rows, from the positive relevances of the
+    qrels sorted in decreasing order.
+    """
+    entry_rows = _entry_rows(qrels)
+    gains = qrels.relevance.astype(np.float64)
+    keep = gains > 0
+    entry_rows, gains = entry_rows[keep], gains[keep]
+
+    order = np.lexsort((-gains, entry_rows))
+    entry_rows, gains = entry_rows[order], gains[order]
+    starts = np.searchsorted(entry_rows, np.arange(qrels.num_queries))
+    positions = np.arange(len(entry_rows)) - starts[entry_rows]
+    discounted = gains / np.log2(positions + 2.0)
+
+    idcg = {}
+    for k in k_values:
+        cut = positions < k
+        per_row = np.bincount(
+            entry_rows[cut], weights=discounted[cut], minlength=qrels.num_queries
+        )
+        idcg[k] = per_row[rows]
+    return idcg
+
+
+def evaluate_per_query(
+    qrels: CompiledQrels,
+    indices,
+    scores,
+    query_rows=None,
+    k_values=K_VALUES,
+    ignore_identical_ids=True,
+):
+    """
+    Compute nDCG, MAP, recall and precision at each cutoff for every query of the run.
+    `indices` and `scores` are `(n_queries, k)` arrays (indices of -1 are padding), and
+    `query_rows` is the row of each query in `qrels` (-1 for queries without qrels);
+    by default, the queries are assumed to be in the order of the qrels rows.
+
+    Returns the rows of the evaluated queries (those with qrels) and a dict mapping
+    e.g. "ndcg_cut_10" (the pytrec_eval measure names) to an array of values per
+    evaluated query.
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    scores = np.asarray(scores)
+    if query_rows is None:
+        query_rows = np.arange(len(indices), dtype=np.int64)
+    query_rows = np.asarray(query_rows, dtype=np.int64)
+
+    # only the queries of the run that have qrels are evaluated, like pytrec_eval
+    has_qrels = np.zeros(len(query_rows), dtype=bool)
+    known = query_rows >= 0
+    has_qrels[known] = np.diff(qrels.indptr)[query_rows[known]] > 0
+    indices, scores, rows = indices[has_qrels], scores[has_qrels], query_rows[has_qrels]
+
+    order = _rank_order(indices, scores, qrels.doc_id_ranks)
+    indices = np.take_along_axis(indices, order, axis=1)
+
+    valid = indices >= 0
+    if ignore_identical_ids:
+        valid &= indices != qrels.identical_rows[rows][:, None]
+    # rank (from 0) of each document once the removed ones are skipped
+    positions = np.cumsum(valid, axis=1) - 1
+
+    gains = _lookup_relevance(qrels, rows, indices).astype(np.float64)
+    gains[~valid] = 0
+    is_rel = (gains >= 1) & valid
+    num_rel = _num_relevant(qrels)[rows]
+
+    discounted = np.where(valid, gains / np.log2(positions + 2.0), 0.0)
+    cum_rel = np.cumsum(is_rel, axis=1)
+    precisions_at_rel = np.where(is_rel, cum_rel / (positions + 1.0), 0.0)
+    idcg = _ideal_dcg(qrels, rows, k_values)
+
+    metrics = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for k in k_values:
+            in_cut = valid & (positions < k)
+            dcg = np.where(in_cut, discounted, 0.0).sum(axis=1)
+            n_rel_retrieved = (is_rel & in_cut).sum(axis=1)
+            sum_precisions = np.where(in_cut, precisions_at_rel, 0.0).sum(axis=1)
+
+            metrics[f"ndcg_cut_{k}"] = np.where(idcg[k] > 0, dcg / idcg[k], 0.0)
+            metrics[f"map_cut_{k}"] = np.where(num_rel > 0, sum_precisions / num_rel, 0.0)
+            metrics[f"recall_{k}"] = np.where(num_rel > 0, n_rel_retrieved / num_rel, 0.0)
+            metrics[f"P_{k}"] = n_rel_retrieved / k
+
+    return rows, metrics
+
+
+def evaluate(
+    qrels: CompiledQrels,
+    indices,
+    scores,
+    query_rows=None,
+    k_values=K_VALUES,
+    ignore_identical_ids=True,
+    decimals: Optional[int] = 5,
+):
+    """
+    Drop-in replacement for `EvaluateRetrieval.evaluate(qrels, results, k_values)`
+    that takes the result arrays instead of the results dict (see
+    `evaluate_per_query`). Returns the `ndcg, _map, recall, precision` dicts, with the
+    same keys (e.g. "NDCG@10", "MAP@10", "Recall@10", "P@10") and rounding.
+    """
+    rows, metrics = evaluate_per_query(
+        qrels,
+        indices,
+        scores,
+        query_rows=query_rows,
+        k_values=k_values,
+        ignore_identical_ids=ignore_identical_ids,
+    )
+
+    def _mean(values):
+        value = float(values.mean()) if len(values) else 0.0
+        return round(value, decimals) if decimals is not None else value
+
+    ndcg = {f"NDCG@{k}": _mean(metrics[f"ndcg_cut_{k}"]) for k in k_values}
+    _map = {f"MAP@{k}": _mean(metrics[f"map_cut_{k}"]) for k in k_values}
+    recall = {f"Recall@{k}": _mean(metrics[f"recall_{k}"]) for k in k_values}
+    precision = {f"P@{k}": _mean(metrics[f"P_{k}"]) for k in k_values}
+
+    return ndcg, _map, recall, precision
+
+
+def to_results_dict(indices, scores, query_ids, corpus_ids, ignore_identical_ids=True):
+    """
+    Convert result arrays to the `{query_id: {doc_id: score}}` dict expected by BEIR
+    and pytrec_eval (skipping padding, and documents whose id is the query id).
+    """
+    results = {}
+    for qid, row_indices, row_scores in zip(query_ids, indices, scores):
+        results[qid] = {
+            corpus_ids[i]: float(s)
+            for i, s in zip(row_indices, row_scores)
+            if i >= 0 and not (ignore_identical_ids and corpus_ids[i] == qid)
+        }
+    return results
+
+
+def verify_against_pytrec_eval(
+    qrels: Dict[str, Dict[str, int]],
+    indices,
+    scores,
+    query_ids,
+    corpus_ids,
+    k_values=K_VALUES,
+    ignore_identical_ids=True,
+    atol=1e-6,
+):
+    """
+    Evaluate a run with both `evaluate_per_query` and pytrec_eval, and check that every
+    per-query measure agrees to within `atol`. Returns the largest absolute difference,
+    and raises a ValueError if it is above `atol` or the evaluated queries differ.
+    """
+    import pytrec_eval
+
+    compiled = compile_qrels(qrels, corpus_ids)
+    rows, metrics = evaluate_per_query(
+        compiled,
+        indices,
+        scores,
+        query_rows=compiled.query_rows(query_ids),
+        k_values=k_values,
+        ignore_identical_ids=ignore_identical_ids,
+    )
+
+    results = to_results_dict(
+        indices, scores, query_ids, corpus_ids, ignore_identical_ids=ignore_identical_ids
+    )
+    cutoffs = ",".join(str(k) for k in k_values)
+    evaluator = pytrec_eval.RelevanceEvaluator(
+        qrels,
+        {f"map_cut.{cutoffs}", f"ndcg_cut.{cutoffs}", f"recall.{cutoffs}", f"P.{cutoffs}"},
+    )
+    expected = evaluator.evaluate(results)
+
+    evaluated_ids = [compiled.query_ids[row] for row in rows]
+    if sorted(evaluated_ids) != sorted(expected.keys()):
+        raise ValueError("The evaluated queries differ from pytrec_eval's")
+
+    max_diff = 0.0
+    for measure, values in metrics.items():
+        reference = np.array([expected[qid][measure] for qid in evaluated_ids])
+        diff = float(np.abs(values - reference).max()) if len(values) else 0.0
+        if diff > atol:
+            raise ValueError(f"{measure} differs from pytrec_eval by {diff:.2e}")
+        max_diff = max(max_diff, diff)
+
+    return max_diff
@@ -1,5 +1,59 @@
+from itertools import chain
 
-def batch_tokenize(tokenizer, texts, add_special_tokens=False, verbose=False):
+import numpy as np
+
+from . import FlatIds, Tokenized
+
+
+def _batch_tokenize_ids(tokenizer, texts, tokenizer_kwargs, batch_size, verbose):
+    from tqdm.auto import tqdm
+
+    data_chunks = []
+    lengths_chunks = []
+    for start in tqdm(
+        range(0, len(texts), batch_size),
+        desc="Tokenizing (huggingface tokenizer)",
+        leave=False,
+        disable=not verbose,
+    ):
+        encoded = tokenizer(
+            texts[start : start + batch_size], return_length=True, **tokenizer_kwargs
+        )
+        lengths = np.asarray(encoded["length"], dtype=np.int64)
+        data_chunks.append(
+            np.fromiter(
+                chain.from_iterable(encoded["input_ids"]),
+                dtype=np.int32,
+                count=int(lengths.sum()),
+            )
+        )
+        lengths_chunks.append(lengths)
+        # drop the python lists of this batch before encoding the next one
+        del encoded
+
+    data = np.concatenate(data_chunks) if data_chunks else np.zeros(0, dtype=np.int32)
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    if lengths_chunks:
+        np.cumsum(np.concatenate(lengths_chunks), out=offsets[1:])
+
+    return Tokenized(ids=FlatIds(data, offsets), vocab=tokenizer.get_vocab())
+
+
+def batch_tokenize(
+    tokenizer,
+    texts,
+    add_special_tokens=False,
+    verbose=False,
+    return_ids=False,
+    batch_size=10_000,
+):
+    """
+    Tokenize `texts` with a huggingface fast tokenizer. By default, returns the lists of
+    token strings. With `return_ids=True`, returns a `utils.Tokenized` object whose ids
+    are the `input_ids` as `FlatIds` and whose vocab is the tokenizer vocabulary; the
+    texts are encoded `batch_size` at a time and copied straight into numpy arrays, so
+    the python lists of only one batch are alive at any time.
+    """
     from tqdm.auto import tqdm
 
     tokenizer_kwargs = dict(
@@ -8,6 +62,11 @@ def batch_tokenize(tokenizer, texts, add_special_tokens=False, verbose=False):
         add_special_tokens=add_special_tokens,
         max_length=None,
     )
+    if return_ids:
+        return _batch_tokenize_ids(
+            tokenizer, texts, tokenizer_kwargs, batch_size=batch_size, verbose=verbose
+        )
+
     tokenized = tokenizer(texts, **tokenizer_kwargs)
     output = []
 
@@ -15,4 +74,3 @@ def batch_tokenize(tokenizer, texts, add_special_tokens=False, verbose=False):
         output.append(tokenized[i].tokens)
 
     return output
-
@@ -0,0 +1,307 @@
+"""
+Open-loop load generation: the queries are issued at the times of a Poisson process of
+a given rate, whether or not the previous ones have returned, like independent users
+would. An asyncio loop submits each query at its arrival time to a pool of workers, so
+a slow engine builds up a queue instead of slowing down the arrivals (as a closed loop,
+i.e. a batch run, would). The latency of a query is counted from its scheduled arrival,
+and the time it waited for a worker (queueing delay) and the time it was served are
+recorded as well.
+
+`run_clients` is the closed-loop counterpart: N clients, threads or processes, each
+issue one query at a time as fast as they can, to measure the aggregate throughput and
+the latency each client sees as N grows.
+
+The engines are given as a `search_one(query)` callable (see `benchmark/engines`).
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing as mp
+import queue
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from .benchmark import LatencyHistogram
+
+
+def poisson_arrivals(rate, num_queries, seed=42):
+    """
+    Return the arrival times (in seconds, from 0) of `num_queries` queries of a Poisson
+    process of `rate` queries per second, i.e. with exponential inter-arrival times.
+    """
+    rng = np.random.default_rng(seed)
+    return np.cumsum(rng.exponential(1 / rate, size=num_queries))
+
+
+def _timed(search_one, query):
+    begin = time.perf_counter()
+    search_one(query)
+    return begin, time.perf_counter()
+
+
+async def _replay(search_one, queries, arrivals, executor):
+    loop = asyncio.get_running_loop()
+    futures = []
+    submitted = np.empty(len(queries))
+    start = time.perf_counter()
+    for i, (query, offset) in enumerate(zip(queries, arrivals)):
+        delay = start + offset - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        submitted[i] = time.perf_counter()
+        futures.append(loop.run_in_executor(executor, _timed, search_one, query))
+
+    times = np.array(await asyncio.gather(*futures))
+    return start, submitted, times[:, 0], times[:, 1]
+
+
+def run_open_loop(
+    search_one,
+    queries,
+    rate,
+    duration=30.0,
+    num_workers=1,
+    seed=42,
+    tolerance=0.05,
+    max_queue_delay=1.0,
+):
+    """
+    Issue `rate * duration` queries (cycling through a random permutation of `queries`)
+    at Poisson arrival times, to a pool of `num_workers` threads calling `search_one`.
+
+    The run is marked as saturated if the engine completed the queries more than
+    `tolerance` slower than they arrived, or if the p99 queueing delay exceeds
+    `max_queue_delay` seconds. `generator_lag_p99_ms` is how late the generator itself
+    submitted the queries (counted in their latency); if it is large, the arrival rate
+    was limited by the generator rather than by the engine.
+    """
+    num_queries = max(1, round(rate * duration))
+    rng = np.random.default_rng(seed)
+    order = np.concatenate(
+        [rng.permutation(len(queries)) for _ in range(-(-num_queries // len(queries)))]
+    )[:num_queries]
+    replayed = [queries[i] for i in order]
+    arrivals = poisson_arrivals(rate, num_queries, seed=seed)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        start, submitted, begin, end = asyncio.run(_replay(search_one, replayed, arrivals, executor))
+
+    scheduled = start + arrivals
+    queue_delay, service_time, latency = LatencyHistogram(), LatencyHistogram(), LatencyHistogram()
+    queue_delay.record_many(begin - submitted)
+    service_time.record_many(end - begin)
+    latency.record_many(end - scheduled)
+
+    # the rate of the generated arrivals, which differs from `rate` by chance
+    offered_qps = num_queries / arrivals[-1]
+    achieved_qps = num_queries / (end.max() - start)
+    saturated = bool(
+        achieved_qps < (1 - tolerance) * offered_qps
+        or queue_delay.percentile(99) > max_queue_delay
+    )
+
+    return {
+        "rate": rate,
+        "offered_qps": offered_qps,
+        "achieved_qps": achieved_qps,
+        "num_queries": num_queries,
+        "num_workers": num_workers,
+        "duration_s": float(end.max() - start),
+        "generator_lag_p99_ms": float(np.percentile(submitted - scheduled, 99)) * 1e3,
+        "saturated": saturated,
+        "queue_delay": queue_delay.to_dict(),
+        "service_time": service_time.to_dict(),
+        "latency": latency.to_dict(),
+    }
+
+
+def show_run(run, prefix=""):
+    print(
+        f"{prefix} {run['rate']:.2f} q/s offered, {run['achieved_qps']:.2f} q/s achieved"
+        f"{' (saturated)' if run['saturated'] else ''}: "
+        f"queue p50 {run['queue_delay']['p50_ms']:.3f}ms p99 {run['queue_delay']['p99_ms']:.3f}ms, "
+        f"latency p50 {run['latency']['p50_ms']:.3f}ms p99 {run['latency']['p99_ms']:.3f}ms"
+    )
+
+
+def sweep_rates(search_one, queries, start_rate, factor=2.0, max_rate=None, refine=2, verbose=True, **kwargs):
+    """
+    Run `run_open_loop` at `start_rate`, `start_rate * factor`, ... until a run is
+    saturated (or `max_rate` is passed), then bisect `refine` times between the last
+    sustained rate and the first saturated one. Returns the runs, along with
+    `max_sustained_qps`, the highest rate the engine kept up with, and `saturation_qps`,
+    the throughput it achieved when saturated (its capacity with these workers).
+    """
+    runs = []
+
+    def run(rate):
+        result = run_open_loop(search_one, queries, rate, **kwargs)
+        if verbose:
+            show_run(result, prefix="[Load]")
+        runs.append(result)
+        return result
+
+    rate = start_rate
+    low, high = None, None
+    while max_rate is None or rate <= max_rate:
+        if run(rate)["saturated"]:
+            high = rate
+            break
+        low = rate
+        rate *= factor
+
+    if low is not None and high is not None:
+        for _ in range(refine):
+            mid = (low * high) ** 0.5
+            if run(mid)["saturated"]:
+                high = mid
+            else:
+                low = mid
+
+    sustained = [r for r in runs if not r["saturated"]]
+    saturated = [r for r in runs if r["saturated"]]
+    return {
+        "runs": sorted(runs, key=lambda r: r["rate"]),
+        "max_sustained_qps": max((r["rate"] for r in sustained), default=None),
+        "saturation_qps": max((r["achieved_qps"] for r in saturated), default=None),
+    }
+
+
+def _client_loop(search_one, queries, offset, duration, barrier):
+    # each client starts at a different query, so they do not all run the same one
+    histogram = LatencyHistogram()
+    try:
+        barrier.wait()
+        first = time.perf_counter()
+        end = first
+        i = offset
+        while end - first < duration:
+            begin = time.perf_counter()
+            search_one(queries[i % len(queries)])
+            end = time.perf_counter()
+            histogram.record(end - begin)
+            i += 1
+    except BaseException:
+        # so the other clients do not wait for this one at the barrier forever
+        barrier.abort()
+        raise
+    return {"histogram": histogram, "first": first, "last": end}
+
+
+def _client_process(search_one, queries, index, offset, duration, barrier, after_fork, results):
+    try:
+        if after_fork is not None:
+            after_fork()
+        results.put((index, _client_loop(search_one, queries, offset, duration, barrier), None))
+    except BaseException:
+        # the error is sent before the barrier is broken, so the parent sees it before
+        # the BrokenBarrierError of the other clients
+        results.put((index, None, traceback.format_exc()))
+        barrier.abort()
+
+
+def _collect_processes(processes, barrier, results, poll=1.0):
+    # read the results before joining, so no child blocks on a full queue; a child that
+    # failed, or died without reporting, stops the others instead of hanging the run
+    clients = {}
+    error = None
+    while error is None and len(clients) < len(processes):
+        try:
+            index, client, error = results.get(timeout=poll)
+        except queue.Empty:
+            for index, p in enumerate(processes):
+                if index not in clients and p.exitcode not in (None, 0):
+                    error = f"exited with code {p.exitcode}"
+                    break
+            continue
+        if error is None:
+            clients[index] = client
+
+    if error is not None:
+        barrier.abort()
+        for p in processes:
+            p.terminate()
+    for p in processes:
+        p.join()
+    if error is not None:
+        raise RuntimeError(f"Client {index} failed:\n{error}")
+
+    return [clients[index] for index in range(len(processes))]
+
+
+def run_clients(search_one, queries, num_clients, mode="thread", duration=10.0, after_fork=None):
+    """
+    Run `num_clients` clients that call `search_one` one query at a time for `duration`
+    seconds, all starting together. With `mode="thread"`, the clients are threads of
+    this process; with `mode="process"`, they are forked processes (so `search_one`
+    and the index it uses are inherited, not pickled), which call `after_fork` first.
+    If a client fails, the others are stopped and its error is raised.
+
+    Returns the aggregate queries per second (all the queries over the time from the
+    first start to the last end), the latency over all clients, and the throughput and
+    latency of each client.
+    """
+    offsets = [i * len(queries) // num_clients for i in range(num_clients)]
+    if mode == "thread":
+        barrier = threading.Barrier(num_clients)
+        with ThreadPoolExecutor(max_workers=num_clients) as executor:
+            futures = [
+                executor.submit(_client_loop, search_one, queries, offset, duration, barrier)
+                for offset in offsets
+            ]
+            errors = [f.exception() for f in futures if f.exception() is not None]
+        if errors:
+            # the error of the client that failed, not the broken barrier of the others
+            raise next((e for e in errors if not isinstance(e, threading.BrokenBarrierError)), errors[0])
+        clients = [f.result() for f in futures]
+    elif mode == "process":
+        ctx = mp.get_context("fork")
+        barrier = ctx.Barrier(num_clients)
+        results = ctx.Queue()
+        # keyed by client, as offsets repeat when there are more clients than queries
+        processes = [
+            ctx.Process(
+                target=_client_process,
+                args=(search_one, queries, index, offset, duration, barrier, after_fork, results),
+            )
+            for index, offset in enumerate(offsets)
+        ]
+        for p in processes:
+            p.start()
+        clients = _collect_processes(processes, barrier, results)
+    else:
+        raise ValueError(f"Unknown mode: {mode}, choose from ['thread', 'process']")
+
+    latency = LatencyHistogram()
+    for client in clients:
+        latency.merge(client["histogram"])
+    elapsed = max(c["last"] for c in clients) - min(c["first"] for c in clients)
+
+    return {
+        "num_clients": num_clients,
+        "mode": mode,
+        "num_queries": latency.count,
+        "qps": latency.count / elapsed,
+        "latency": latency.to_dict(),
+        "clients": [
+            {
+                "num_queries": c["histogram"].count,
+                "qps": c["histogram"].count / (c["last"] - c["first"]),
+                "mean_ms": c["histogram"].mean * 1e3,
+                "p50_ms": c["histogram"].percentile(50) * 1e3,
+                "p99_ms": c["histogram"].percentile(99) * 1e3,
+            }
+            for c in clients
+        ],
+    }
+
+
+def show_clients(result, prefix=""):
+    client_qps = [c["qps"] for c in result["clients"]]
+    print(
+        f"{prefix} {result['num_clients']} {result['mode']} clients: {result['qps']:.2f} q/s "
+        f"(per client {min(client_qps):.2f}-{max(client_qps):.2f} q/s), "
+        f"latency p50 {result['latency']['p50_ms']:.3f}ms p99 {result['latency']['p99_ms']:.3f}ms"
+    )
@@ -0,0 +1,160 @@
+"""
+Container for the results of a retrieval run, kept as arrays until the end of the
+benchmark: the evaluator (`utils.evaluation`) and the savers read the arrays directly,
+and the `{query_id: {doc_id: score}}` dict used by BEIR is only built on request.
+"""
+import json
+from pathlib import Path
+
+import numpy as np
+
+from .evaluation import K_VALUES, CompiledQrels, evaluate, to_results_dict
+
+
+def _as_float_array(scores):
+    # floating scores keep their dtype, anything else (e.g. a list of python floats or
+    # integer scores) is stored as float64
+    scores = np.asarray(scores)
+    if not np.issubdtype(scores.dtype, np.floating):
+        scores = scores.astype(np.float64)
+    return scores
+
+
+class RetrievalResults:
+    """
+    Results of `n_queries` queries with at most `k` documents each:
+    - `indices`: int32 array of shape (n_queries, k) with the index of each retrieved
+      document in `corpus_ids` (-1 for padding, when fewer documents were retrieved)
+    - `scores`: float array of shape (n_queries, k), in the dtype of the engine (e.g.
+      float32 for bm25s, float64 for rank-bm25), since casting float64 scores to
+      float32 can create ties that reorder the top-k
+    - `query_ids`: the id of each query, in the order of the rows
+    - `corpus_ids`: the document ids, used to convert the indices back to ids
+    """
+
+    def __init__(self, indices, scores, query_ids, corpus_ids):
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.scores = _as_float_array(scores)
+        self.query_ids = list(query_ids)
+        self.corpus_ids = corpus_ids
+
+        if self.indices.shape != self.scores.shape:
+            raise ValueError(
+                f"indices and scores must have the same shape, got {self.indices.shape} and {self.scores.shape}"
+            )
+        if len(self.query_ids) != len(self.indices):
+            raise ValueError("There must be one query id per row of results")
+
+    @classmethod
+    def from_run(cls, run_query_ids, run_doc_ids, run_scores, query_ids, corpus_ids):
+        """
+        Build the results from a run in "long" format, i.e. one (query id, doc id,
+        score) triple per retrieved document, as returned by engines that work with
+        document ids (e.g. a TREC run or a dataframe of hits). Each row is sorted by
+        decreasing score and padded to the longest row.
+        """
+        query_index = {qid: i for i, qid in enumerate(query_ids)}
+        doc_index = {doc_id: i for i, doc_id in enumerate(corpus_ids)}
+
+        rows = np.fromiter(
+            (query_index[qid] for qid in run_query_ids), dtype=np.int64, count=len(run_query_ids)
+        )
+        docs = np.fromiter(
+            (doc_index[doc_id] for doc_id in run_doc_ids), dtype=np.int32, count=len(run_doc_ids)
+        )
+        run_scores = _as_float_array(run_scores)
+
+        order = np.lexsort((-run_scores, rows))
+        rows, docs, run_scores = rows[order], docs[order], run_scores[order]
+        counts = np.bincount(rows, minlength=len(query_ids))
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        positions = np.arange(len(rows)) - starts[rows]
+
+        k = int(counts.max()) if len(counts) else 0
+        indices = np.full((len(query_ids), k), -1, dtype=np.int32)
+        scores = np.zeros((len(query_ids), k), dtype=run_scores.dtype)
+        indices[rows, positions] = docs
+        scores[rows, positions] = run_scores
+
+        return cls(indices, scores, query_ids, corpus_ids)
+
+    @classmethod
+    def from_beir_dict(cls, results, corpus_ids, query_ids=None):
+        """
+        Build the results from a BEIR results dict (`{query_id: {doc_id: score}}`).
+        """
+        if query_ids is None:
+            query_ids = list(results.keys())
+
+        run_query_ids, run_doc_ids, run_scores = [], [], []
+        for qid in query_ids:
+            for doc_id, score in results.get(qid, {}).items():
+                run_query_ids.append(qid)
+                run_doc_ids.append(doc_id)
+                run_scores.append(score)
+
+        return cls.from_run(run_query_ids, run_doc_ids, run_scores, query_ids, corpus_ids)
+
+    def __len__(self):
+        return len(self.indices)
+
+    @property
+    def k(self):
+        return self.indices.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.scores.nbytes
+
+    def to_beir_dict(self):
+        """
+        Convert to the `{query_id: {doc_id: score}}` dict used by BEIR, like
+        `utils.beir.postprocess_results_for_eval`. The dict is built on every call and
+        not kept, so it only takes memory while the caller holds it.
+        """
+        return to_results_dict(
+            self.indices, self.scores, self.query_ids, self.corpus_ids, ignore_identical_ids=False
+        )
+
+    def evaluate(self, qrels, k_values=K_VALUES, ignore_identical_ids=True):
+        """
+        Compute the `ndcg, _map, recall, precision` dicts of BEIR's
+        `EvaluateRetrieval.evaluate`. With `CompiledQrels` (which must be compiled
+        against the same `corpus_ids`), the metrics are computed from the arrays by
+        `utils.evaluation.evaluate`; with a qrels dict, the results are converted to a
+        BEIR dict and evaluated by BEIR.
+        """
+        if isinstance(qrels, CompiledQrels):
+            return evaluate(
+                qrels,
+                self.indices,
+                self.scores,
+                query_rows=qrels.query_rows(self.query_ids),
+                k_values=k_values,
+                ignore_identical_ids=ignore_identical_ids,
+            )
+
+        from beir.retrieval.evaluation import EvaluateRetrieval
+
+        return EvaluateRetrieval.evaluate(
+            qrels, self.to_beir_dict(), list(k_values), ignore_identical_ids=ignore_identical_ids
+        )
+
+    def save(self, path):
+        """
+        Save the indices and scores to `<path>/results.npz` and the query ids to
+        `<path>/query_ids.json` (the corpus ids are not saved).
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.savez(path / "results.npz", indices=self.indices, scores=self.scores)
+        with open(path / "query_ids.json", "w") as f:
+            json.dump(self.query_ids, f)
+
+    @classmethod
+    def load(cls, path, corpus_ids):
+        path = Path(path)
+        arrays = np.load(path / "results.npz")
+        with open(path / "query_ids.json", "r") as f:
+            query_ids = json.load(f)
+        return cls(arrays["indices"], arrays["scores"], query_ids, corpus_ids)
@@ -0,0 +1,273 @@
+"""
+Sampling for the benchmark scripts:
+- deterministic subsampling of BEIR corpora, for the corpus-size sweeps
+  (`--corpus_fraction`)
+- stratified sampling of queries (`--samples`), with the throughput of the full query
+  set extrapolated from the sample and given with a confidence interval
+"""
+from collections import Counter
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+from statistics import NormalDist
+from typing import NamedTuple
+
+import numpy as np
+from tqdm.auto import tqdm
+
+from .beir import _import_json, _source_stat
+
+FRACTION_META = "fraction.json"
+
+
+def doc_fraction_key(doc_id, seed=0):
+    """
+    Map a document id to a number in [0, 1), uniformly and deterministically. A
+    document is kept in a subsample of fraction `f` if its key is below `f`, so the
+    subsamples of a dataset are nested: every document of the 10% sample is also in
+    the 25% one.
+    """
+    digest = hashlib.blake2b(f"{seed}:{doc_id}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") / 2**64
+
+
+def qrels_doc_ids(data_path, split="test"):
+    """
+    Return the set of the documents judged relevant (score > 0) in the qrels of
+    `split`, i.e. the ones the metrics of the evaluated split depend on. The other
+    splits (e.g. the 500k documents of the msmarco train qrels) are not included.
+    """
+    doc_ids = set()
+    with open(Path(data_path) / "qrels" / f"{split}.tsv", "r") as f:
+        # skip the header: query-id, corpus-id, score
+        next(f)
+        for line in f:
+            _, doc_id, score = line.rstrip("\n").split("\t")
+            if int(score) > 0:
+                doc_ids.add(doc_id)
+    return doc_ids
+
+
+def corpus_fraction_dir(data_path, fraction, split="test", seed=0) -> Path:
+    return Path(data_path) / "fractions" / f"{fraction:g}-{split}-{seed}"
+
+
+def subsample_corpus(data_path, fraction, split="test", seed=0, verbose=False):
+    """
+    Return the path of a copy of the dataset at `data_path` that keeps a `fraction`
+    of its documents, chosen with `doc_fraction_key`, along with every relevant
+    document of the qrels of the evaluated `split`, so the metrics stay meaningful.
+    The queries and qrels are copied unchanged. The copy is written once to
+    `<data_path>/fractions/<fraction>-<split>-<seed>/` and reused until
+    `corpus.jsonl` changes. With `fraction=1`, `data_path` is returned as is.
+    """
+    if not 0 < fraction <= 1:
+        raise ValueError(f"corpus_fraction must be in (0, 1], got {fraction}")
+    if fraction == 1:
+        return str(data_path)
+
+    data_path = Path(data_path)
+    out_dir = corpus_fraction_dir(data_path, fraction, split=split, seed=seed)
+    meta = {
+        "fraction": fraction,
+        "split": split,
+        "seed": seed,
+        "source": _source_stat(data_path / "corpus.jsonl"),
+    }
+
+    meta_path = out_dir / FRACTION_META
+    if meta_path.exists():
+        with open(meta_path, "r") as f:
+            cached = json.load(f)
+        if {k: cached[k] for k in meta} == meta:
+            return str(out_dir)
+
+    ujson = _import_json()
+    relevant = qrels_doc_ids(data_path, split=split)
+
+    tmp_dir = out_dir.parent / f".{out_dir.name}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    (tmp_dir / "qrels").mkdir(parents=True)
+    try:
+        num_docs = 0
+        with open(data_path / "corpus.jsonl", "r") as src, open(tmp_dir / "corpus.jsonl", "w") as dst:
+            for line in tqdm(src, desc=f"Subsampling corpus ({fraction:g})", leave=False, disable=not verbose):
+                doc_id = ujson.loads(line)["_id"]
+                if doc_id in relevant or doc_fraction_key(doc_id, seed=seed) < fraction:
+                    dst.write(line)
+                    num_docs += 1
+
+        shutil.copy2(data_path / "queries.jsonl", tmp_dir / "queries.jsonl")
+        for path in (data_path / "qrels").glob("*.tsv"):
+            shutil.copy2(path, tmp_dir / "qrels" / path.name)
+
+        with open(tmp_dir / FRACTION_META, "w") as f:
+            json.dump({**meta, "num_docs": num_docs}, f, indent=2)
+
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.rename(tmp_dir, out_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return str(out_dir)
+
+
+class QuerySample(NamedTuple):
+    # positions of the sampled queries in the full query list, in increasing order
+    indices: np.ndarray
+    # stratum of each sampled query
+    strata: np.ndarray
+    # number of queries of the full list in each stratum
+    stratum_sizes: np.ndarray
+
+    @property
+    def num_queries(self):
+        return int(self.stratum_sizes.sum())
+
+    def select(self, items):
+        return [items[i] for i in self.indices]
+
+
+def doc_frequencies(tokenized_docs):
+    """
+    Count the number of documents that contain each token, for documents given as
+    lists of tokens (strings or ids).
+    """
+    df = Counter()
+    for doc in tokenized_docs:
+        df.update(set(doc))
+    return df
+
+
+def query_costs(tokenized_queries, df):
+    """
+    Return the two features that drive the cost of a query in an inverted index: its
+    number of tokens, and the summed length of the postings lists of its distinct
+    tokens (i.e. of their document frequencies in `df`).
+    """
+    num_tokens = np.fromiter((len(q) for q in tokenized_queries), dtype=np.int64)
+    postings = np.fromiter(
+        (sum(df.get(token, 0) for token in set(q)) for q in tokenized_queries), dtype=np.int64
+    )
+    return num_tokens, postings
+
+
+def _quantile_bins(values, num_bins):
+    edges = np.unique(np.quantile(values, np.linspace(0, 1, num_bins + 1)[1:-1]))
+    return np.searchsorted(edges, values, side="right")
+
+
+def _merge_strata(strata_of_all, stratum_sizes, max_strata):
+    # merge the smallest stratum into its smaller neighbour (the strata are ordered by
+    # number of tokens, then by postings) until there are at most `max_strata`
+    groups = [[h] for h in range(len(stratum_sizes))]
+    sizes = list(stratum_sizes)
+    while len(groups) > max_strata:
+        h = int(np.argmin(sizes))
+        if h == 0 or (h + 1 < len(groups) and sizes[h + 1] < sizes[h - 1]):
+            h += 1
+        groups[h - 1] += groups.pop(h)
+        sizes[h - 1] += sizes.pop(h)
+
+    merged = np.empty(len(stratum_sizes), dtype=np.int64)
+    for g, group in enumerate(groups):
+        merged[group] = g
+    return merged[strata_of_all], np.array(sizes, dtype=np.int64)
+
+
+def _allocate(stratum_sizes, n, min_per_stratum=2):
+    # proportional allocation (largest remainders), with at least `min_per_stratum`
+    # queries per stratum when possible, so each stratum has a variance estimate, and
+    # at least one otherwise, so each stratum is represented in the estimate
+    floor = np.minimum(stratum_sizes, min_per_stratum)
+    if floor.sum() > n:
+        floor = np.minimum(stratum_sizes, 1)
+    if floor.sum() > n:
+        raise ValueError(f"Cannot sample {n} queries from {len(stratum_sizes)} strata")
+    quota = stratum_sizes * n / stratum_sizes.sum()
+    alloc = np.maximum(np.floor(quota).astype(np.int64), floor)
+    remainders = quota - np.floor(quota)
+    for h in np.argsort(-remainders, kind="stable"):
+        if alloc.sum() >= n:
+            break
+        if alloc[h] < stratum_sizes[h]:
+            alloc[h] += 1
+    while alloc.sum() > n:
+        # the minimum per stratum pushed the sample over n: take from the largest ones
+        h = np.argmax(alloc - floor)
+        alloc[h] -= 1
+    return alloc
+
+
+def stratified_sample(num_tokens, postings, n, num_bins=4, seed=42):
+    """
+    Sample `n` queries, stratified by their number of tokens and by their summed
+    postings length (see `query_costs`), each cut into `num_bins` quantile bins. The
+    queries are allocated to the strata in proportion to their size, so the sample
+    has the same mix of cheap and expensive queries as the full set. If there are more
+    strata than `n`, adjacent strata are merged so each one gets a query.
+    """
+    num_tokens = np.asarray(num_tokens)
+    postings = np.asarray(postings)
+    strata_of_all = _quantile_bins(num_tokens, num_bins) * num_bins + _quantile_bins(
+        np.log1p(postings), num_bins
+    )
+    labels, strata_of_all = np.unique(strata_of_all, return_inverse=True)
+    stratum_sizes = np.bincount(strata_of_all, minlength=len(labels))
+    n = min(n, len(num_tokens))
+    if n < 1:
+        raise ValueError(f"The number of queries to sample must be positive, got {n}")
+    if len(stratum_sizes) > n:
+        # every stratum needs a sampled query to be counted in the extrapolation
+        strata_of_all, stratum_sizes = _merge_strata(strata_of_all, stratum_sizes, n)
+    alloc = _allocate(stratum_sizes, n)
+
+    rng = np.random.default_rng(seed)
+    indices, strata = [], []
+    for h, size in enumerate(alloc):
+        members = np.flatnonzero(strata_of_all == h)
+        indices.append(rng.choice(members, size=size, replace=False))
+        strata.append(np.full(size, h))
+
+    indices = np.concatenate(indices)
+    strata = np.concatenate(strata)
+    order = np.argsort(indices)
+    return QuerySample(indices=indices[order], strata=strata[order], stratum_sizes=stratum_sizes)
+
+
+def extrapolate_throughput(sample: QuerySample, query_seconds, confidence=0.95):
+    """
+    Estimate the time to run the full query set from the time of each sampled query
+    (in the order of `sample.indices`), with the stratified estimator of a total, and
+    return it with the extrapolated queries per second and their confidence interval.
+    Strata with a single sampled query do not contribute to the variance. The upper
+    bound of the queries per second is None if the interval includes a zero total.
+    """
+    query_seconds = np.asarray(query_seconds, dtype=np.float64)
+    total, variance = 0.0, 0.0
+    for h, size in enumerate(sample.stratum_sizes):
+        times = query_seconds[sample.strata == h]
+        if len(times) == 0:
+            # its queries would be left out of the total, overstating the throughput
+            raise ValueError(f"Stratum {h} has {size} queries but none was sampled")
+        total += size * float(times.mean())
+        if len(times) > 1:
+            variance += size**2 * (1 - len(times) / size) * float(times.var(ddof=1)) / len(times)
+
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    margin = z * variance**0.5
+    num_queries = sample.num_queries
+
+    return {
+        "num_queries": num_queries,
+        "num_sampled": len(sample.indices),
+        "num_strata": len(sample.stratum_sizes),
+        "confidence": confidence,
+        "total_seconds": total,
+        "total_seconds_std": variance**0.5,
+        "qps": num_queries / total,
+        "qps_low": num_queries / (total + margin),
+        "qps_high": num_queries / (total - margin) if total > margin else None,
+    }
@@ -0,0 +1,232 @@
+"""
+Synthetic BEIR datasets for scale testing. The words of the corpus are drawn from a
+Zipf distribution over a fixed vocabulary of pseudo-words, the document lengths from a
+log-normal distribution, and each query is made of distinct words of one document,
+which is its only relevant document. The output has the layout of a BEIR dataset
+(`corpus.jsonl`, `queries.jsonl`, `qrels/test.tsv`), so every `benchmark/on_*.py`
+script can run on it offline, at any number of documents.
+
+The parameters can be fitted from a real dataset with `fit_from_dataset`, and scaled
+to a larger corpus with `ZipfConfig.scale_to`.
+"""
+from itertools import count, islice, product
+import json
+import os
+from pathlib import Path
+import shutil
+from typing import NamedTuple
+
+import numpy as np
+from tqdm.auto import tqdm
+
+# no vowels, "s" or "y": the english stemmers leave such words unchanged, so the
+# vocabulary seen by the engines is exactly the generated one
+CONSONANTS = "bcdfghjklmnpqrtvwxz"
+# consonant-only words found in common stopword lists (e.g. nltk, used by bm25s)
+_RESERVED = {"ll"}
+SYNTHETIC_META = "synthetic.json"
+
+
+class ZipfConfig(NamedTuple):
+    num_docs: int = 100_000
+    num_queries: int = 1_000
+    vocab_size: int = 1_000_000
+    zipf_exponent: float = 1.0
+    # mean and sigma of the log-normal distribution of the number of tokens per doc
+    doc_length_mean: float = 60.0
+    doc_length_sigma: float = 0.8
+    # mean number of tokens per query (at least 1)
+    query_length_mean: float = 5.0
+    # growth of the vocabulary with the corpus size (Heaps' law), used by `scale_to`
+    heaps_exponent: float = 0.5
+    seed: int = 42
+
+    def scale_to(self, num_docs):
+        """
+        Return the config of a corpus of `num_docs` documents from the same
+        distribution: the vocabulary grows as `num_docs ** heaps_exponent`.
+        """
+        vocab_size = self.vocab_size * (num_docs / self.num_docs) ** self.heaps_exponent
+        return self._replace(num_docs=num_docs, vocab_size=max(1, round(vocab_size)))
+
+
+def pseudo_words(n):
+    """
+    Return `n` distinct pseudo-words made of consonants, shortest first, so the most
+    frequent ranks get the shortest words like in natural text.
+    """
+    def words():
+        for length in count(2):
+            for letters in product(CONSONANTS, repeat=length):
+                word = "".join(letters)
+                if word not in _RESERVED:
+                    yield word
+
+    return list(islice(words(), n))
+
+
+def zipf_cdf(vocab_size, exponent):
+    weights = np.arange(1, vocab_size + 1, dtype=np.float64) ** -exponent
+    cdf = np.cumsum(weights)
+    cdf /= cdf[-1]
+    return cdf
+
+
+def sample_doc_lengths(rng, n, mean, sigma):
+    # mu is chosen so the mean of the log-normal distribution is `mean`
+    mu = np.log(mean) - sigma**2 / 2
+    lengths = np.rint(rng.lognormal(mu, sigma, size=n)).astype(np.int64)
+    return np.maximum(lengths, 1)
+
+
+def sample_query_lengths(rng, n, mean):
+    return 1 + rng.poisson(max(mean - 1, 0), size=n)
+
+
+def _fit_zipf_exponent(counts, min_count=5):
+    # least squares fit of log(frequency) against log(rank), over the ranks seen often
+    # enough for their frequency to be meaningful
+    counts = np.sort(counts)[::-1]
+    counts = counts[counts >= min_count]
+    if len(counts) < 2:
+        return ZipfConfig().zipf_exponent
+    ranks = np.arange(1, len(counts) + 1)
+    slope, _ = np.polyfit(np.log(ranks), np.log(counts), 1)
+    return float(-slope)
+
+
+def _fit_heaps_exponent(token_ids, num_points=20):
+    # number of distinct tokens after the first n tokens, for log-spaced n
+    _, first_seen = np.unique(token_ids, return_index=True)
+    first_seen.sort()
+    n = np.unique(np.geomspace(1_000, len(token_ids), num_points).astype(np.int64))
+    n = n[n <= len(token_ids)]
+    if len(n) < 2:
+        return ZipfConfig().heaps_exponent
+    distinct = np.searchsorted(first_seen, n)
+    slope, _ = np.polyfit(np.log(n), np.log(distinct), 1)
+    return float(slope)
+
+
+def fit_from_dataset(data_path, split="test", max_docs=1_000_000, stopwords="en", stemmer=None):
+    """
+    Fit a `ZipfConfig` to a BEIR dataset: the tokens per doc and per query are the
+    ones printed by `on_bm25s.py` (with the same tokenizer settings), and the Zipf and
+    Heaps exponents are fitted on the token frequencies. Only the first `max_docs`
+    documents are read (None for all); `num_docs` and `vocab_size` are the ones of the
+    documents read, use `scale_to` for larger corpora.
+    """
+    import utils
+    from .beir import iter_corpus, load_queries_and_qrels
+
+    records = islice(iter_corpus(data_path), max_docs)
+    _, tokenized = utils.tokenize_stream(
+        records, stopwords=stopwords, stemmer=stemmer, return_ids=True, flat=True, batched=True
+    )
+    doc_lengths = np.diff(tokenized.ids.offsets)
+    doc_lengths = doc_lengths[doc_lengths > 0]
+    token_ids = tokenized.ids.data
+
+    queries, _ = load_queries_and_qrels(data_path, split=split)
+    queries_tokenized = utils.tokenize(
+        list(queries.values()), stopwords=stopwords, stemmer=stemmer, return_ids=True, flat=True
+    )
+    query_lengths = np.diff(queries_tokenized.ids.offsets)
+
+    return ZipfConfig(
+        num_docs=len(tokenized.ids.offsets) - 1,
+        num_queries=len(queries),
+        vocab_size=len(tokenized.vocab),
+        zipf_exponent=_fit_zipf_exponent(np.bincount(token_ids)),
+        doc_length_mean=float(doc_lengths.mean()),
+        doc_length_sigma=float(np.log(doc_lengths).std()),
+        query_length_mean=float(query_lengths.mean()),
+        heaps_exponent=_fit_heaps_exponent(token_ids),
+    )
+
+
+def _write_corpus_and_queries(out_dir, config, chunk_size, verbose):
+    rng = np.random.default_rng(config.seed)
+    words = np.array(pseudo_words(config.vocab_size), dtype=object)
+    cdf = zipf_cdf(config.vocab_size, config.zipf_exponent)
+
+    # each query is drawn from a distinct document, which is its only relevant one
+    num_queries = min(config.num_queries, config.num_docs)
+    source_docs = np.sort(rng.choice(config.num_docs, size=num_queries, replace=False))
+    query_lengths = sample_query_lengths(rng, num_queries, config.query_length_mean)
+    next_query = 0
+
+    with open(out_dir / "corpus.jsonl", "w") as corpus_f, open(out_dir / "queries.jsonl", "w") as queries_f:
+        for start in tqdm(
+            range(0, config.num_docs, chunk_size),
+            desc="Generating synthetic corpus",
+            leave=False,
+            disable=not verbose,
+        ):
+            stop = min(start + chunk_size, config.num_docs)
+            lengths = sample_doc_lengths(
+                rng, stop - start, config.doc_length_mean, config.doc_length_sigma
+            )
+            offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            ranks = np.searchsorted(cdf, rng.random(offsets[-1]), side="right")
+            np.minimum(ranks, config.vocab_size - 1, out=ranks)
+            tokens = words[ranks].tolist()
+
+            lines = []
+            for i in range(len(lengths)):
+                text = " ".join(tokens[offsets[i] : offsets[i + 1]])
+                # the words are ascii letters only, so the line needs no escaping
+                lines.append(f'{{"_id": "doc{start + i}", "title": "", "text": "{text}"}}\n')
+            corpus_f.writelines(lines)
+
+            while next_query < num_queries and source_docs[next_query] < stop:
+                i = source_docs[next_query] - start
+                doc_ranks = np.unique(ranks[offsets[i] : offsets[i + 1]])
+                size = min(query_lengths[next_query], len(doc_ranks))
+                query_ranks = rng.choice(doc_ranks, size=size, replace=False)
+                text = " ".join(words[query_ranks].tolist())
+                queries_f.write(f'{{"_id": "q{next_query}", "text": "{text}"}}\n')
+                next_query += 1
+
+    return [(f"q{j}", f"doc{doc}") for j, doc in enumerate(source_docs)]
+
+
+def generate_dataset(name, config=ZipfConfig(), save_dir="datasets", chunk_size=100_000, verbose=False):
+    """
+    Write a synthetic dataset to `<save_dir>/<name>` and register it in the
+    `DatasetRegistry` of `save_dir`, so the benchmark scripts can load it with
+    `-d <name>`. The files are written to a temporary folder that is moved in place
+    when complete. Nothing is done if the dataset was already generated with the same
+    config. Returns the path of the dataset.
+    """
+    from .beir import DatasetRegistry
+
+    registry = DatasetRegistry(save_dir)
+    out_dir = registry.dataset_dir(name)
+    meta = {"config": config._asdict(), "chunk_size": chunk_size}
+
+    meta_path = out_dir / SYNTHETIC_META
+    if meta_path.exists() and registry.is_ready(name):
+        with open(meta_path, "r") as f:
+            if json.load(f) == meta:
+                return str(out_dir)
+
+    tmp_dir = Path(save_dir) / f".{name}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    (tmp_dir / "qrels").mkdir(parents=True)
+    try:
+        qrels = _write_corpus_and_queries(tmp_dir, config, chunk_size, verbose)
+        with open(tmp_dir / "qrels" / "test.tsv", "w") as f:
+            f.write("query-id\tcorpus-id\tscore\n")
+            f.writelines(f"{qid}\t{doc_id}\t1\n" for qid, doc_id in qrels)
+        with open(tmp_dir / SYNTHETIC_META, "w") as f:
+            json.dump(meta, f, indent=2)
+
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.rename(tmp_dir, out_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    registry.register(name)
+    return str(out_dir)
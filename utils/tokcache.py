@@ -0,0 +1,236 @@
+"""
+On-disk cache for tokenized corpora. Each entry lives under
+`<save_dir>/<dataset>/tokcache/<hash>/`, where the hash covers the dataset, the
+corpus fraction of subsampled runs and the tokenizer configuration, and contains:
+- `ids.npy`: int32 array of the concatenated token ids of all documents
+- `offsets.npy`: int64 array of document boundaries (see `utils.FlatIds`)
+- `vocab.json`: the token to id mapping
+- `doc_ids.json`: the document ids, if they were given when the entry was created
+- `config.json`: the configuration that was hashed
+
+The arrays are loaded with `mmap_mode="r"`, so a cache hit costs almost nothing.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+
+import numpy as np
+
+from . import FlatIds, Tokenized, _iter_chunks, tokenize
+
+DEFAULT_TOKEN_PATTERN = r"(?u)\b\w\w+\b"
+
+# the options of `bm25s.tokenize` besides the hashed ones; the other `tokenize_kwargs`
+# (e.g. `n_jobs`, `batched` or `stem_cache`) only apply to `utils.tokenize`
+_BM25S_TOKENIZE_KWARGS = ("show_progress", "leave", "allow_empty")
+
+
+def _stemmer_name(stemmer, stemmer_name):
+    if stemmer_name is not None:
+        return stemmer_name
+    if stemmer is None:
+        return None
+    # PyStemmer objects do not expose their language, so callers should pass a name
+    return getattr(stemmer, "__name__", type(stemmer).__name__)
+
+
+def tokcache_config(
+    dataset,
+    tokenizer="utils",
+    lower=True,
+    token_pattern=DEFAULT_TOKEN_PATTERN,
+    stopwords=None,
+    stemmer=None,
+    stemmer_name=None,
+    corpus_fraction=1.0,
+):
+    if stopwords is not None and not isinstance(stopwords, (str, bool)):
+        stopwords = sorted(stopwords)
+
+    config = {
+        "dataset": dataset,
+        "tokenizer": tokenizer,
+        "lower": lower,
+        "token_pattern": token_pattern,
+        "stopwords": stopwords,
+        "stemmer": _stemmer_name(stemmer, stemmer_name),
+    }
+    # only subsampled corpora get the key, so the entries of full corpora keep their hash
+    if corpus_fraction != 1:
+        config["corpus_fraction"] = corpus_fraction
+
+    return config
+
+
+def tokcache_dir(save_dir, config) -> Path:
+    key = hashlib.sha1(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()
+    return Path(save_dir) / config["dataset"] / "tokcache" / key[:16]
+
+
+def save_tokenized(path, tokenized: Tokenized, doc_ids=None, config=None):
+    """
+    Save a `Tokenized` object (with lists or `FlatIds` as ids) to `path`. The files
+    are written to a temporary directory that is renamed at the end, so a killed run
+    never leaves a partial entry behind.
+    """
+    path = Path(path)
+    ids = tokenized.ids
+    if not isinstance(ids, FlatIds):
+        ids = FlatIds.from_lists(ids)
+
+    tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+
+    np.save(tmp_path / "ids.npy", ids.data.astype(np.int32, copy=False))
+    np.save(tmp_path / "offsets.npy", ids.offsets.astype(np.int64, copy=False))
+    with open(tmp_path / "vocab.json", "w") as f:
+        json.dump(tokenized.vocab, f)
+    if doc_ids is not None:
+        with open(tmp_path / "doc_ids.json", "w") as f:
+            json.dump(list(doc_ids), f)
+    with open(tmp_path / "config.json", "w") as f:
+        json.dump(config or {}, f, indent=2)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+
+def load_tokenized(path, mmap=True):
+    """
+    Load an entry saved by `save_tokenized`. Returns the `Tokenized` object (with
+    `FlatIds` as ids) and the document ids, or None if they were not saved.
+    """
+    path = Path(path)
+    mmap_mode = "r" if mmap else None
+    ids = FlatIds(
+        np.load(path / "ids.npy", mmap_mode=mmap_mode),
+        np.load(path / "offsets.npy", mmap_mode=mmap_mode),
+    )
+    with open(path / "vocab.json", "r") as f:
+        vocab = json.load(f)
+
+    doc_ids = None
+    if (path / "doc_ids.json").exists():
+        with open(path / "doc_ids.json", "r") as f:
+            doc_ids = json.load(f)
+
+    return Tokenized(ids=ids, vocab=vocab), doc_ids
+
+
+def _bm25s_tokenize_flat(texts, chunk_size=10_000, **kwargs):
+    # bm25s.tokenize builds python lists of ids, so it is called one chunk at a time,
+    # and each chunk is copied into flat arrays with its vocab merged into a global one
+    import bm25s
+
+    token_to_index = {}
+    data_chunks, lengths_chunks = [], []
+    for chunk in _iter_chunks(texts, chunk_size):
+        tokenized = bm25s.tokenize(chunk, return_ids=True, **kwargs)
+        remap = np.zeros(max(tokenized.vocab.values(), default=-1) + 1, dtype=np.int32)
+        for token, i in sorted(tokenized.vocab.items(), key=lambda item: item[1]):
+            remap[i] = token_to_index.setdefault(token, len(token_to_index))
+
+        chunk_ids = FlatIds.from_lists(tokenized.ids)
+        data_chunks.append(remap[chunk_ids.data])
+        lengths_chunks.append(np.diff(chunk_ids.offsets))
+        del tokenized, chunk_ids
+
+    ids = FlatIds.from_lengths(
+        np.concatenate(data_chunks) if data_chunks else np.zeros(0, dtype=np.int32),
+        np.concatenate(lengths_chunks) if lengths_chunks else np.zeros(0, dtype=np.int64),
+    )
+    return Tokenized(ids=ids, vocab=token_to_index)
+
+
+def tokenize_cached(
+    texts,
+    save_dir,
+    dataset,
+    tokenizer="utils",
+    lower=True,
+    token_pattern=DEFAULT_TOKEN_PATTERN,
+    stopwords=None,
+    stemmer=None,
+    stemmer_name=None,
+    corpus_fraction=1.0,
+    records=False,
+    **tokenize_kwargs,
+):
+    """
+    Tokenize `texts` with `utils.tokenize` (tokenizer="utils") or `bm25s.tokenize`
+    (tokenizer="bm25s"), going through the on-disk cache.
+
+    `texts` can be a zero-argument callable returning the texts; it is only called on
+    a cache miss, so e.g. `lambda: iter_corpus(data_path)` skips reading the corpus on
+    a hit. If `records` is True, `texts` yields `(doc_id, text)` pairs and the doc ids
+    are stored in the cache as well.
+
+    Returns `(tokenized, doc_ids, hit)`, where `tokenized.ids` is a (memory-mapped, on
+    a hit) `FlatIds`, `doc_ids` is None unless `records=True`, and `hit` tells whether
+    the entry was loaded from the cache. An entry saved without doc ids counts as a
+    miss when `records=True`.
+    """
+    config = tokcache_config(
+        dataset,
+        tokenizer=tokenizer,
+        lower=lower,
+        token_pattern=token_pattern,
+        stopwords=stopwords,
+        stemmer=stemmer,
+        stemmer_name=stemmer_name,
+        corpus_fraction=corpus_fraction,
+    )
+    path = tokcache_dir(save_dir, config)
+
+    if (path / "config.json").exists():
+        tokenized, doc_ids = load_tokenized(path)
+        # an entry made without doc ids cannot serve a records run: it is re-tokenized
+        # below and rewritten with them
+        if not records:
+            return tokenized, None, True
+        if doc_ids is not None:
+            return tokenized, doc_ids, True
+
+    if callable(texts):
+        texts = texts()
+
+    doc_ids = None
+    if records:
+        doc_ids = []
+
+        def _texts(records):
+            for doc_id, text in records:
+                doc_ids.append(doc_id)
+                yield text
+
+        texts = _texts(texts)
+
+    if tokenizer == "utils":
+        tokenized = tokenize(
+            texts,
+            lower=lower,
+            token_pattern=token_pattern,
+            stopwords=stopwords,
+            stemmer=stemmer,
+            return_ids=True,
+            flat=True,
+            **tokenize_kwargs,
+        )
+    elif tokenizer == "bm25s":
+        tokenized = _bm25s_tokenize_flat(
+            texts,
+            lower=lower,
+            token_pattern=token_pattern,
+            stopwords=stopwords,
+            stemmer=stemmer,
+            **{k: v for k, v in tokenize_kwargs.items() if k in _BM25S_TOKENIZE_KWARGS},
+        )
+    else:
+        raise ValueError(f"Unknown tokenizer: {tokenizer}")
+
+    save_tokenized(path, tokenized, doc_ids=doc_ids, config=config)
+
+    return tokenized, doc_ids, False